@@ -0,0 +1,127 @@
+"""Микробенчмарк сериализации списка задач.
+
+Сравнивает прежний путь /api/tasks (рекурсивный convert_db_objects +
+json.dumps) с serializers.encode_tasks на стандартном json и на orjson.
+Строки генерируются в памяти, БД не нужна.
+
+    python benchmarks/bench_serializer.py [--sizes 10 1000 50000] [--json]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta
+from datetime import time as dtime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import serializers
+
+def legacy_convert_db_objects(obj):
+    """Прежняя реализация из bot.py (для сравнения)"""
+    if isinstance(obj, dict):
+        return {k: legacy_convert_db_objects(v) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        return [legacy_convert_db_objects(item) for item in obj]
+    elif isinstance(obj, datetime):
+        return obj.isoformat()
+    elif hasattr(obj, 'isoformat'):
+        return obj.isoformat()
+    elif hasattr(obj, 'strftime'):
+        try:
+            return obj.strftime('%H:%M') if hasattr(obj, 'hour') else obj.strftime('%Y-%m-%d')
+        except:
+            return str(obj)
+    else:
+        return obj
+
+def legacy_encode(tasks):
+    tasks_list = [legacy_convert_db_objects(dict(task)) for task in tasks]
+    return json.dumps({"status": "ok", "tasks": tasks_list}).encode()
+
+def make_rows(count, seed=42):
+    rnd = random.Random(seed)
+    now = datetime(2026, 10, 1, 12, 0, 0)
+    rows = []
+    for i in range(count):
+        has_date = rnd.random() > 0.2
+        completed = rnd.random() > 0.7
+        rows.append({
+            'id': i + 1,
+            'user_id': 100000 + i % 50,
+            'text': f"Задача номер {i}: " + 'x' * rnd.randint(5, 80),
+            'category': rnd.choice(['personal', 'work', 'study']),
+            'priority': rnd.choice(['low', 'medium', 'high']),
+            'date': date(2026, 10, 1) + timedelta(days=rnd.randint(0, 60)) if has_date else None,
+            'time': dtime(rnd.randint(0, 23), rnd.choice([0, 15, 30, 45])) if has_date else None,
+            'reminder': rnd.choice([0, 5, 15]),
+            'completed': completed,
+            'deleted': False,
+            'created_at': now - timedelta(seconds=rnd.randint(0, 10 ** 7), microseconds=rnd.randint(0, 999999)),
+            'completed_at': now if completed else None,
+            'deleted_at': None,
+            'emoji': '📝',
+            'is_reminder': rnd.random() > 0.8,
+            'archived': False,
+            'task_type': rnd.choice(['task', 'note']),
+        })
+    return rows
+
+def measure(func, rows, min_time=0.5):
+    runs, started = 0, time.perf_counter()
+    best = float('inf')
+    while True:
+        t0 = time.perf_counter()
+        func(rows)
+        best = min(best, time.perf_counter() - t0)
+        runs += 1
+        if time.perf_counter() - started >= min_time and runs >= 3:
+            return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 50000])
+    parser.add_argument('--json', action='store_true', help='вывод в JSON')
+    args = parser.parse_args()
+
+    candidates = [('legacy', legacy_encode)]
+    backend = serializers.BACKEND
+    serializers.BACKEND = 'json'
+    candidates.append(('typed+json', lambda rows: serializers.encode_tasks(rows)))
+    if serializers.orjson is not None:
+        def typed_orjson(rows):
+            serializers.BACKEND = 'orjson'
+            try:
+                return serializers.encode_tasks(rows)
+            finally:
+                serializers.BACKEND = 'json'
+        candidates.append(('typed+orjson', typed_orjson))
+
+    results = []
+    for size in args.sizes:
+        rows = make_rows(size)
+        reference = json.loads(legacy_encode(rows))
+        baseline = None
+        for name, func in candidates:
+            assert json.loads(func(rows)) == reference, f"{name}: результат отличается от прежнего"
+            seconds = measure(func, rows)
+            baseline = baseline or seconds
+            results.append({
+                'rows': size,
+                'serializer': name,
+                'best_ms': round(seconds * 1000, 3),
+                'speedup': round(baseline / seconds, 2),
+            })
+    serializers.BACKEND = backend
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'rows':>7}  {'serializer':<14}{'best, ms':>10}{'speedup':>9}")
+        for r in results:
+            print(f"{r['rows']:>7}  {r['serializer']:<14}{r['best_ms']:>10}{r['speedup']:>8}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+"""Проверка планов горячих запросов на заполненной БД.
+
+Наполняет таблицу tasks синтетическими данными, выполняет EXPLAIN для
+запросов списка задач и выборки уведомлений и проверяет, что планировщик
+использует нужные индексы (или их копии в секциях tasks), а для
+постраничных запросов получает порядок прямо из индекса, без отдельной
+сортировки. Все изменения выполняются в одной транзакции и откатываются в конце.
+
+    DATABASE_URL=postgresql://... python benchmarks/explain_indexes.py --users 2000 --tasks 100
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+
+SEED_SQL = '''
+    INSERT INTO tasks (user_id, text, date, time, task_type, is_reminder,
+                       remind_at, reminder_sent, archived, completed, deleted)
+    SELECT u, 'seed ' || n,
+           CASE WHEN n %% 10 = 0 THEN NULL ELSE CURRENT_DATE + (n %% 60 - 30) END,
+           CASE WHEN n %% 7 = 0 THEN NULL ELSE TIME '08:00' + (n %% 50) * INTERVAL '15 minutes' END,
+           CASE WHEN n %% 5 = 0 THEN 'note' ELSE 'task' END,
+           n %% 9 = 0,
+           NOW() AT TIME ZONE 'UTC' + (n %% 60 - 30) * INTERVAL '1 day',
+           n %% 20 <> 0,
+           n %% 3 = 0,
+           n %% 4 = 0,
+           n %% 50 = 0
+    FROM generate_series(%(first_user)s, %(first_user)s + %(users)s - 1) AS u,
+         generate_series(1, %(tasks)s) AS n
+'''
+
+def checks(user_id):
+    list_columns = 'id, user_id, text, category, priority, date, time'
+    # (название, запрос, ожидаемый индекс, порядок должен идти из индекса)
+    return [
+        (
+            'активный список пользователя',
+            f'''SELECT {list_columns} FROM tasks
+                WHERE user_id = {user_id} AND deleted = FALSE AND archived = FALSE
+                ORDER BY {database._TASK_ORDER}''',
+            'idx_tasks_user_active_order',
+            False,
+        ),
+        (
+            'первая страница активного списка',
+            f'''SELECT {list_columns} FROM tasks
+                WHERE user_id = {user_id} AND deleted = FALSE AND archived = FALSE
+                ORDER BY {database._TASK_ORDER} LIMIT 20''',
+            'idx_tasks_user_active_order',
+            True,
+        ),
+        (
+            'следующая страница активного списка (keyset)',
+            f'''SELECT {list_columns} FROM tasks
+                WHERE user_id = {user_id} AND deleted = FALSE AND archived = FALSE
+                AND ({database._TASK_ORDER}) > ('2026-01-01'::date, '12:00'::time, 0)
+                ORDER BY {database._TASK_ORDER} LIMIT 20''',
+            'idx_tasks_user_active_order',
+            True,
+        ),
+        (
+            'список пользователя с архивом',
+            f'''SELECT {list_columns} FROM tasks
+                WHERE user_id = {user_id} AND deleted = FALSE
+                ORDER BY {database._TASK_ORDER}''',
+            'idx_tasks_user_order',
+            False,
+        ),
+        (
+            'захват наступивших уведомлений',
+            f'''SELECT id FROM tasks
+                WHERE {database._DUE_NOTIFICATIONS_WHERE}
+                AND (claimed_until IS NULL OR claimed_until <= NOW() AT TIME ZONE 'UTC')
+                ORDER BY remind_at LIMIT 100''',
+            'idx_tasks_due_notifications',
+            True,
+        ),
+        (
+            'окно движка напоминаний',
+            f'''SELECT id FROM tasks
+                WHERE {database._NOTIFIABLE_WHERE}
+                AND remind_at <= NOW() AT TIME ZONE 'UTC' + INTERVAL '10 minutes'
+                ORDER BY remind_at LIMIT 10000''',
+            'idx_tasks_due_notifications',
+            False,
+        ),
+        (
+            'дельта изменений после курсора',
+            f'''SELECT {list_columns} FROM tasks
+                WHERE user_id = {user_id}
+                AND updated_at <= '2100-01-01'::timestamp
+                AND (updated_at, id) > (NOW() AT TIME ZONE 'UTC' - INTERVAL '1 hour', 0)
+                ORDER BY updated_at, id LIMIT 50''',
+            'idx_tasks_user_updated',
+            True,
+        ),
+        (
+            'пачка архивации просроченных',
+            f'''SELECT id FROM tasks WHERE {database._OVERDUE_WHERE}
+                ORDER BY date LIMIT 1000 FOR UPDATE SKIP LOCKED''',
+            'idx_tasks_overdue',
+            True,
+        ),
+        (
+            'пачка очистки старых напоминаний',
+            f'''SELECT id FROM tasks WHERE {database._OLD_REMINDERS_WHERE}
+                ORDER BY remind_at LIMIT 1000 FOR UPDATE SKIP LOCKED''',
+            'idx_tasks_sent_reminders',
+            True,
+        ),
+    ]
+
+def index_family(cur, index):
+    """Индекс и его копии в секциях tasks (в плане видны имена секционных индексов)"""
+    cur.execute('''
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s)
+    ''', (index,))
+    return {index} | {row['relname'] for row in cur.fetchall()}
+
+def walk(plan):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from walk(child)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--tasks', type=int, default=100, help='задач на пользователя')
+    args = parser.parse_args()
+
+    database.init_db()
+    conn = database.get_connection()
+    failed = 0
+    try:
+        cur = conn.cursor()
+        first_user = 9_000_000_000
+        cur.execute(SEED_SQL, {'first_user': first_user, 'users': args.users, 'tasks': args.tasks})
+        print(f"Добавлено строк: {cur.rowcount}")
+        cur.execute('ANALYZE tasks')
+
+        for title, sql, index, ordered in checks(first_user + args.users // 2):
+            cur.execute('EXPLAIN (FORMAT JSON) ' + sql)
+            plan = cur.fetchone()['QUERY PLAN'][0]['Plan']
+            nodes = list(walk(plan))
+            indexes = {node.get('Index Name') for node in nodes} - {None}
+            sorted_ = any(node['Node Type'] in ('Sort', 'Incremental Sort') for node in nodes)
+            ok = bool(index_family(cur, index) & indexes) and not (ordered and sorted_)
+            failed += not ok
+            print(f"{'PASS' if ok else 'FAIL'}  {title}: индексы={sorted(indexes)} сортировка={sorted_}")
+    finally:
+        conn.rollback()
+        conn.close()
+        database.close_pool()
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
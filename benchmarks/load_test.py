@@ -0,0 +1,421 @@
+"""Нагрузочный бенчмарк бота целиком.
+
+Поднимает настоящее aiohttp-приложение из bot.py (маршруты, кэш,
+очередь исходящих, движок напоминаний) на локальном порту, а Bot API
+подменяет фейковым сервером: сессия бота направляется на него через
+TELEGRAM_API_URL. В Postgres заводятся синтетические пользователи и
+задачи, затем смешанная нагрузка идет на /webhook (команды и нажатия
+кнопок), GET /api/tasks и POST /api/new_task. Отдельной фазой
+разбирается очередь просроченных уведомлений через
+check_and_send_pending_notifications. Результат - пропускная
+способность и p50/p95/p99 по операциям, с --json в машиночитаемом виде
+для сравнения коммитов. Засеянные данные удаляются в конце.
+
+Клиент и сервер работают в одном процессе и делят event loop, поэтому
+абсолютные цифры занижены; сравнивать имеет смысл прогоны с одинаковыми
+параметрами на одной машине.
+
+    DATABASE_URL=postgresql://... python benchmarks/load_test.py \\
+        --users 1000 --tasks 50 --duration 30 --concurrency 50 --backlog 2000 --json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+
+from aiohttp import ClientSession, TCPConnector, web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+FIRST_USER = 8_000_000_000
+BOT_TOKEN = '123456:BENCHMARK'
+DEFAULT_MIX = 'get_tasks=60,new_task=20,webhook_message=10,webhook_callback=10'
+
+SEED_SQL = '''
+    INSERT INTO tasks (user_id, text, category, priority, date, time, task_type,
+                       is_reminder, archived, completed)
+    SELECT u, 'bench ' || n,
+           (ARRAY['personal', 'work', 'study'])[1 + n %% 3],
+           (ARRAY['low', 'medium', 'high'])[1 + n %% 3],
+           CASE WHEN n %% 10 = 0 THEN NULL ELSE CURRENT_DATE + (n %% 60) END,
+           CASE WHEN n %% 7 = 0 THEN NULL ELSE TIME '08:00' + (n %% 50) * INTERVAL '15 minutes' END,
+           CASE WHEN n %% 5 = 0 THEN 'note' ELSE 'task' END,
+           FALSE,
+           n %% 4 = 0,
+           n %% 4 = 0
+    FROM generate_series(%(first_user)s, %(first_user)s + %(users)s - 1) AS u,
+         generate_series(1, %(tasks)s) AS n
+'''
+
+# Просроченные напоминания: их разбирает check_and_send_pending_notifications
+BACKLOG_SQL = '''
+    INSERT INTO tasks (user_id, text, date, time, task_type, is_reminder, remind_at)
+    SELECT %(first_user)s + n %% %(users)s, 'backlog ' || n, CURRENT_DATE, TIME '09:00',
+           'reminder', TRUE,
+           NOW() AT TIME ZONE 'UTC' - (1 + n %% 120) * INTERVAL '1 minute'
+    FROM generate_series(1, %(backlog)s) AS n
+'''
+
+CLEANUP_SQL = [
+    'DELETE FROM tasks WHERE user_id BETWEEN %(first_user)s AND %(last_user)s',
+    'DELETE FROM task_tombstones WHERE user_id BETWEEN %(first_user)s AND %(last_user)s',
+    'DELETE FROM task_versions WHERE user_id BETWEEN %(first_user)s AND %(last_user)s',
+]
+
+# ---------- Фейковый Bot API ----------
+class FakeTelegram:
+    """Отвечает на методы Bot API как Telegram, с настраиваемой задержкой"""
+
+    def __init__(self, latency_ms=0):
+        self.latency = latency_ms / 1000
+        self.calls = Counter()
+        self._message_id = 0
+
+    def _message(self, form):
+        self._message_id += 1
+        chat_id = int(form.get('chat_id', 0))
+        return {
+            'message_id': self._message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': form.get('text', ''),
+        }
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        form = await request.post()
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method == 'getMe':
+            result = {'id': 123456, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        elif method == 'getWebhookInfo':
+            result = {'url': '', 'has_custom_certificate': False, 'pending_update_count': 0}
+        elif method in ('sendMessage', 'editMessageText'):
+            result = self._message(form)
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        return app
+
+# ---------- Нагрузка ----------
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+
+    def add(self, name, seconds, ok):
+        self.latencies[name].append(seconds)
+        if not ok:
+            self.errors[name] += 1
+
+def percentile(ordered, q):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered))) - 1))]
+
+def summarize(recorder, duration):
+    operations = {}
+    total = errors = 0
+    for name, values in sorted(recorder.latencies.items()):
+        ordered = sorted(values)
+        total += len(ordered)
+        errors += recorder.errors[name]
+        operations[name] = {
+            'count': len(ordered),
+            'errors': recorder.errors[name],
+            'throughput_rps': round(len(ordered) / duration, 2),
+            'p50_ms': round(percentile(ordered, 0.50) * 1000, 2),
+            'p95_ms': round(percentile(ordered, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(ordered, 0.99) * 1000, 2),
+            'max_ms': round(ordered[-1] * 1000, 2),
+        }
+    return {
+        'duration_s': round(duration, 3),
+        'requests': total,
+        'errors': errors,
+        'throughput_rps': round(total / duration, 2),
+        'operations': operations,
+    }
+
+class Workload:
+    """Генерирует запросы смешанной нагрузки к поднятому приложению"""
+
+    def __init__(self, base_url, secret_token, users, task_ids, mix, seed=1):
+        self.base_url = base_url
+        self.secret_token = secret_token
+        self.users = users
+        self.task_ids = task_ids
+        self.rnd = random.Random(seed)
+        self.names = [name for name, _ in mix]
+        self.weights = [weight for _, weight in mix]
+        self._update_id = 0
+
+    def _user(self):
+        return FIRST_USER + self.rnd.randrange(self.users)
+
+    def _update(self, payload):
+        self._update_id += 1
+        return {'update_id': self._update_id, **payload}
+
+    def _sender(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': 'Bench'}
+
+    def request(self):
+        """(операция, метод, путь, kwargs для ClientSession.request)"""
+        name = self.rnd.choices(self.names, self.weights)[0]
+        user_id = self._user()
+        if name == 'get_tasks':
+            return name, 'GET', f'/api/tasks?user_id={user_id}', {}
+        if name == 'new_task':
+            day = datetime.now(timezone.utc).date().toordinal() + self.rnd.randint(1, 30)
+            body = {
+                'user_id': user_id,
+                'text': f'load {self.rnd.random():.6f}',
+                'date': datetime.fromordinal(day).strftime('%Y-%m-%d'),
+                'time': f'{self.rnd.randint(8, 20):02d}:{self.rnd.choice((0, 15, 30, 45)):02d}',
+                'task_type': 'task',
+            }
+            return name, 'POST', '/api/new_task', {'json': body}
+
+        headers = {'X-Telegram-Bot-Api-Secret-Token': self.secret_token}
+        chat = {'id': user_id, 'type': 'private'}
+        if name == 'webhook_callback' and self.task_ids:
+            task_user, task_id = self.rnd.choice(self.task_ids)
+            chat = {'id': task_user, 'type': 'private'}
+            update = self._update({'callback_query': {
+                'id': str(self._update_id),
+                'from': self._sender(task_user),
+                'chat_instance': str(task_user),
+                'data': f"task_{self.rnd.choice(('done', 'progress'))}_{task_id}",
+                'message': {
+                    'message_id': self._update_id,
+                    'date': int(time.time()),
+                    'chat': chat,
+                    'text': '📋 Задача!\n\nbench\n\n_Выберите действие:_',
+                },
+            }})
+        else:
+            name = 'webhook_message'
+            command = self.rnd.choice(('/start', '/myid'))
+            update = self._update({'message': {
+                'message_id': self._update_id,
+                'date': int(time.time()),
+                'chat': chat,
+                'from': self._sender(user_id),
+                'text': command,
+                'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}],
+            }})
+        return name, 'POST', '/webhook', {'json': update, 'headers': headers}
+
+async def drive(workload, recorder, concurrency, duration):
+    deadline = time.perf_counter() + duration
+
+    async def worker(session):
+        while time.perf_counter() < deadline:
+            name, method, path, kwargs = workload.request()
+            started = time.perf_counter()
+            ok = False
+            try:
+                async with session.request(method, workload.base_url + path, **kwargs) as response:
+                    await response.read()
+                    ok = response.status < 400
+            except Exception:
+                pass
+            recorder.add(name, time.perf_counter() - started, ok)
+
+    started = time.perf_counter()
+    async with ClientSession(connector=TCPConnector(limit=concurrency)) as session:
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+    return time.perf_counter() - started
+
+# ---------- Подготовка БД ----------
+def run_sql(database, statements, params):
+    conn = database.get_connection()
+    try:
+        cur = conn.cursor()
+        rows = 0
+        for statement in statements:
+            cur.execute(statement, params)
+            rows += max(cur.rowcount, 0)
+        conn.commit()
+        return rows
+    finally:
+        conn.close()
+
+def sample_tasks(database, params, limit=1000):
+    conn = database.get_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute('''
+            SELECT id, user_id FROM tasks
+            WHERE user_id BETWEEN %(first_user)s AND %(last_user)s
+            AND task_type = 'task' AND deleted = FALSE
+            ORDER BY random()
+            LIMIT %(limit)s
+        ''', {**params, 'limit': limit})
+        return [(row['user_id'], row['id']) for row in cur.fetchall()]
+    finally:
+        conn.close()
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+def parse_mix(value):
+    mix = []
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ('get_tasks', 'new_task', 'webhook_message', 'webhook_callback'):
+            raise argparse.ArgumentTypeError(f"неизвестная операция: {name}")
+        mix.append((name, float(weight or 1)))
+    return mix
+
+async def run(args):
+    fake = FakeTelegram(args.tg_latency_ms)
+    fake_runner = web.AppRunner(fake.app())
+    await fake_runner.setup()
+    await web.TCPSite(fake_runner, '127.0.0.1', args.tg_port).start()
+
+    # Окружение задается до импорта bot: конфигурация читается при импорте
+    os.environ.update({
+        'BOT_TOKEN': BOT_TOKEN,
+        'TELEGRAM_API_URL': f'http://127.0.0.1:{args.tg_port}',
+        'OUTBOUND_RATE': str(args.outbound_rate),
+        'OUTBOUND_PER_CHAT_RATE': str(args.outbound_rate),
+        'OUTBOUND_PER_CHAT_BURST': str(args.outbound_rate),
+    })
+    for name in ('RENDER_EXTERNAL_HOSTNAME', 'ADMIN_ID'):
+        os.environ.pop(name, None)
+
+    import database
+    import bot
+    from aiogram.webhook.aiohttp_server import setup_application
+
+    logging.getLogger().setLevel(args.log_level)
+
+    params = {
+        'first_user': FIRST_USER,
+        'last_user': FIRST_USER + args.users - 1,
+        'users': args.users,
+        'tasks': args.tasks,
+        'backlog': args.backlog,
+    }
+    result = {
+        'commit': git_commit(),
+        'started_at': datetime.now(timezone.utc).isoformat(),
+        'config': {key: value for key, value in vars(args).items() if key != 'json'},
+    }
+
+    database.init_db()
+    run_sql(database, CLEANUP_SQL, params)
+    seeded_at = time.perf_counter()
+    result['seed'] = {
+        'tasks': run_sql(database, [SEED_SQL, 'ANALYZE tasks'], params),
+        'duration_s': round(time.perf_counter() - seeded_at, 3),
+    }
+    task_ids = sample_tasks(database, params)
+
+    runner = None
+    try:
+        # Тот же порядок, что в bot.main(): маршруты, порт, затем прогрев
+        bot.setup_routes()
+        bot.register_webhook(bot.app)
+        setup_application(bot.app, bot.dp, bot=bot.bot)
+        runner = web.AppRunner(bot.app)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', args.port).start()
+        await bot.on_startup()
+
+        workload = Workload(f'http://127.0.0.1:{args.port}', bot.SECRET_TOKEN, args.users, task_ids, args.mix)
+        if args.warmup:
+            await drive(workload, Recorder(), args.concurrency, args.warmup)
+        fake.calls.clear()
+        recorder = Recorder()
+        duration = await drive(workload, recorder, args.concurrency, args.duration)
+        result['http'] = summarize(recorder, duration)
+        result['http']['telegram_calls'] = dict(fake.calls)
+
+        if args.backlog:
+            # Движок напоминаний останавливается, чтобы очередь разбирал только замеряемый путь
+            await bot.reminder_engine.stop()
+            run_sql(database, [BACKLOG_SQL], params)
+            fake.calls.clear()
+            started = time.perf_counter()
+            await bot.check_and_send_pending_notifications()
+            drained = time.perf_counter() - started
+            sent = fake.calls['sendMessage']
+            result['backlog'] = {
+                'notifications': args.backlog,
+                'sent': sent,
+                'duration_s': round(drained, 3),
+                'throughput_per_s': round(sent / drained, 2) if drained else None,
+            }
+    finally:
+        if not args.keep:
+            run_sql(database, CLEANUP_SQL, params)
+        if runner is not None:
+            await runner.cleanup()
+        await bot.on_shutdown()
+        await bot.bot.session.close()
+        await fake_runner.cleanup()
+    return result
+
+def print_table(result):
+    http = result['http']
+    print(f"commit {result['commit']}: {http['requests']} запросов за {http['duration_s']} с, "
+          f"{http['throughput_rps']} rps, ошибок {http['errors']}")
+    print(f"{'operation':<18}{'count':>8}{'errors':>8}{'rps':>9}{'p50, ms':>10}{'p95, ms':>10}{'p99, ms':>10}")
+    for name, op in http['operations'].items():
+        print(f"{name:<18}{op['count']:>8}{op['errors']:>8}{op['throughput_rps']:>9}"
+              f"{op['p50_ms']:>10}{op['p95_ms']:>10}{op['p99_ms']:>10}")
+    backlog = result.get('backlog')
+    if backlog:
+        print(f"backlog: {backlog['sent']}/{backlog['notifications']} уведомлений за "
+              f"{backlog['duration_s']} с ({backlog['throughput_per_s']}/с)")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--tasks', type=int, default=50, help='задач на пользователя')
+    parser.add_argument('--duration', type=float, default=30, help='длительность нагрузки, с')
+    parser.add_argument('--warmup', type=float, default=3, help='прогрев перед замером, с')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f'веса операций (по умолчанию {DEFAULT_MIX})')
+    parser.add_argument('--backlog', type=int, default=1000, help='просроченных уведомлений; 0 - без фазы')
+    parser.add_argument('--outbound-rate', type=float, default=1000,
+                        help='лимит очереди исходящих, сообщ/с (в проде 30)')
+    parser.add_argument('--tg-latency-ms', type=float, default=20, help='задержка фейкового Bot API')
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--tg-port', type=int, default=18081)
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--keep', action='store_true', help='не удалять засеянные данные')
+    parser.add_argument('--json', action='store_true', help='вывод в JSON')
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(result, indent=2, ensure_ascii=False))
+    else:
+        print_table(result)
+
+if __name__ == '__main__':
+    main()
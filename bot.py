@@ -1,9 +1,13 @@
 import os
+import time
 import asyncio
 import logging
 from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 
+# Точка отсчета для замера времени запуска (startup_times)
+STARTED_AT = time.monotonic()
+
 load_dotenv()
 
 # ========== НАСТРОЙКА ЛОГГИРОВАНИЯ (ПЕРВЫМ ДЕЛОМ) ==========
@@ -20,6 +24,12 @@ WEB_APP_URL = "https://dar-of-the-flame.github.io/tg-task-frontend/"
 WEBHOOK_HOST = os.getenv('RENDER_EXTERNAL_HOSTNAME')
 WEBHOOK_PATH = "/webhook"
 WEBHOOK_URL = f"https://{WEBHOOK_HOST}{WEBHOOK_PATH}"
+# Токен для служебных эндпоинтов (/api/admin/*); без него они недоступны
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+# Обновления webhook обрабатываются в фоне после ответа Telegram (0 - внутри запроса)
+WEBHOOK_BACKGROUND = os.getenv('WEBHOOK_BACKGROUND', '1').lower() in ('1', 'true', 'yes')
+# Альтернативный Bot API сервер (локальный telegram-bot-api или фейковый для тестов)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
 
 # Генерация SECRET_TOKEN для webhook
 SECRET_TOKEN = os.getenv('SECRET_TOKEN')
@@ -39,51 +49,143 @@ if not WEBHOOK_HOST:
 
 # ========== ИМПОРТЫ ПОСЛЕ НАСТРОЙКИ ЛОГГЕРА ==========
 from aiogram import Bot, Dispatcher, Router, F
-from aiogram.types import Message, CallbackQuery, WebAppInfo, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import Update, Message, CallbackQuery, WebAppInfo, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.enums import ParseMode
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import Command
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiohttp import web
 from aiohttp.web import middleware
 import database
+import database_async
+import sender
+import reminders
+import task_cache
+import serializers
+import push
+import maintenance
+import metrics
+import webhook_queue
+import retries
+import fsm_storage
 from aiohttp import hdrs
+from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_EXECUTED, EVENT_JOB_MISSED
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.date import DateTrigger
 import json
+import zlib
+import hmac
 
 # ========== ИНИЦИАЛИЗАЦИЯ ==========
-bot = Bot(token=API_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN))
-dp = Dispatcher()
+session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(token=API_TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN))
+
+# Все исходящие сообщения идут через общую очередь с ограничением скорости
+outbound = sender.OutboundQueue.from_env()
+bot.session.middleware(outbound)
+
+# Кэш списков задач; сбрасывается при любом изменении задач пользователя
+tasks_cache = task_cache.TaskListCache.from_env()
+database.add_change_listener(tasks_cache.invalidate_users)
+# Состояния FSM в Postgres, чтобы их видели все реплики (FSM_STORAGE=memory - в памяти процесса)
+fsm = fsm_storage.PostgresStorage.from_env() if os.getenv('FSM_STORAGE', 'postgres') == 'postgres' else None
+dp = Dispatcher(storage=fsm) if fsm else Dispatcher()
 router = Router()
 dp.include_router(router)
 
 scheduler = AsyncIOScheduler(timezone="Europe/Moscow")
+maintenance_engine = maintenance.MaintenanceEngine.from_env()
+
+# ========== МЕТРИКИ ==========
+HTTP_REQUEST_SECONDS = metrics.REGISTRY.histogram(
+    'http_request_duration_seconds', 'Длительность обработки HTTP-запроса', ('method', 'route', 'status'))
+SCHEDULER_JOB_RUNS = metrics.REGISTRY.counter(
+    'scheduler_job_runs_total', 'Запуски периодических задач планировщика', ('job', 'outcome'))
+NOTIFICATION_FIRE_LAG = metrics.REGISTRY.histogram(
+    'notification_fire_lag_seconds', 'Опоздание отправки уведомления относительно remind_at', ('path',),
+    buckets=metrics.LAG_BUCKETS)
+NOTIFICATION_FAILURES = metrics.REGISTRY.counter(
+    'notification_failures_total', 'Неудачные отправки уведомлений по принятому решению', ('action',))
+NOTIFICATION_BACKLOG = metrics.REGISTRY.gauge(
+    'notifications_due_pending', 'Наступившие, но еще не отправленные уведомления')
+metrics.REGISTRY.gauge(
+    'scheduler_jobs', 'Задачи в планировщике APScheduler',
+    callback=lambda: len(scheduler.get_jobs()))
+metrics.REGISTRY.gauge(
+    'outbound_queue_depth', 'Сообщения в очереди исходящих по полосам', ('lane',),
+    callback=lambda: outbound.stats()['depth'])
+metrics.REGISTRY.gauge(
+    'webhook_queue_depth', 'Обновления в очереди webhook (включая обрабатываемые)',
+    callback=lambda: update_queue.stats()['depth'])
+metrics.REGISTRY.gauge(
+    'webhook_queue_chats', 'Чаты с обновлениями в очереди webhook',
+    callback=lambda: update_queue.stats()['chats'])
+metrics.REGISTRY.gauge(
+    'reminder_engine_loaded', 'Срабатывания в загруженном окне движка напоминаний',
+    callback=lambda: reminder_engine.stats()['loaded'])
+
+_SCHEDULER_OUTCOMES = {EVENT_JOB_EXECUTED: 'ok', EVENT_JOB_ERROR: 'error', EVENT_JOB_MISSED: 'missed'}
+
+def on_scheduler_event(event):
+    SCHEDULER_JOB_RUNS.inc(job=event.job_id, outcome=_SCHEDULER_OUTCOMES[event.code])
+
+scheduler.add_listener(on_scheduler_event, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED)
+
+def record_fire_lag(notifications, path):
+    """Опоздание отправки: текущее время минус remind_at (оба naive UTC)"""
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    for notification in notifications:
+        if notification['remind_at'] is not None:
+            NOTIFICATION_FIRE_LAG.observe(max(0.0, (now - notification['remind_at']).total_seconds()), path=path)
 
 # ========== CORS MIDDLEWARE ==========
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, Authorization, If-None-Match',
+    'Access-Control-Expose-Headers': 'ETag',
+    'Access-Control-Allow-Credentials': 'true'
+}
+
 @middleware
 async def cors_middleware(request, handler):
     if request.method == hdrs.METH_OPTIONS:
-        response = web.Response()
-    else:
+        return web.Response()
+    return await handler(request)
+
+@middleware
+async def metrics_middleware(request, handler):
+    # Метка маршрута - шаблон пути, а не сам путь, чтобы не плодить серии
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource is not None else 'unmatched'
+    started = time.perf_counter()
+    status = 500
+    try:
         response = await handler(request)
-    
-    response.headers.update({
-        'Access-Control-Allow-Origin': '*',
-        'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-        'Access-Control-Allow-Headers': 'Content-Type, Authorization',
-        'Access-Control-Allow-Credentials': 'true'
-    })
-    
-    return response
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - started, method=request.method, route=route, status=str(status))
+
+async def add_cors_headers(request, response):
+    # Через on_response_prepare заголовки попадают и в потоковые ответы (экспорт, SSE),
+    # которые отправляются раньше, чем отработает middleware
+    response.headers.update(CORS_HEADERS)
 
 # ========== КОМАНДА START ==========
 @router.message(Command("start"))
 async def start_command(message: Message):
     user_id = message.from_user.id
     logger.info(f"👤 Пользователь {user_id} запустил бота")
+    # Пользователь снова пишет боту: уведомления в этот чат можно отправлять
+    await database_async.unblock_chat(user_id)
     
     web_app = WebAppInfo(url=f"{WEB_APP_URL}?startapp={user_id}")
     keyboard = ReplyKeyboardMarkup(
@@ -162,53 +264,287 @@ async def handle_web_app_data(message: Message):
         await message.answer(f"❌ Ошибка: {str(e)}")
 
 # ========== HTTP СЕРВЕР ДЛЯ API ==========
-app = web.Application(middlewares=[cors_middleware])
+app = web.Application(middlewares=[metrics_middleware, cors_middleware])
+app.on_response_prepare.append(add_cors_headers)
 
-# Эндпоинт для проверки здоровья
+# Эндпоинт для проверки здоровья: процесс жив (liveness), готовность - в поле ready
 async def health_check(request):
-    return web.json_response({"status": "ok", "time": datetime.now(timezone.utc).isoformat()})
-
-# Функция для преобразования объектов даты/времени в строки
-def convert_db_objects(obj):
-    """Рекурсивно преобразует объекты БД в строки для JSON"""
-    if isinstance(obj, dict):
-        return {k: convert_db_objects(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [convert_db_objects(item) for item in obj]
-    elif isinstance(obj, datetime):
-        return obj.isoformat()
-    elif hasattr(obj, 'isoformat'):  # Для time/date объектов
-        return obj.isoformat()
-    elif hasattr(obj, 'strftime'):  # Для других объектов с strftime
-        try:
-            return obj.strftime('%H:%M') if hasattr(obj, 'hour') else obj.strftime('%Y-%m-%d')
-        except:
-            return str(obj)
-    else:
-        return obj
+    return web.json_response({
+        "status": "ok",
+        "ready": startup_event().is_set(),
+        "startup": startup_times,
+        "time": datetime.now(timezone.utc).isoformat(),
+        "db_pool": database.get_pool_stats(),
+        "outbound": outbound.stats(),
+        "reminders": reminder_engine.stats(),
+        "tasks_cache": tasks_cache.stats(),
+        "push": push_hub.stats(),
+        "maintenance": maintenance_engine.stats(),
+        "webhook_queue": update_queue.stats(),
+        "fsm": fsm.stats() if fsm else None
+    })
+
+async def metrics_handler(request):
+    """Метрики в формате Prometheus; очередь уведомлений считается при каждом запросе"""
+    NOTIFICATION_BACKLOG.set(await database_async.count_due_notifications())
+    return web.Response(
+        body=metrics.REGISTRY.render().encode(),
+        headers={hdrs.CONTENT_TYPE: metrics.CONTENT_TYPE}
+    )
+
+async def readiness_check(request):
+    """200, когда запуск завершен (миграции, webhook, фоновые компоненты), иначе 503"""
+    ready = startup_event().is_set()
+    return web.json_response(
+        {"status": "ready" if ready else "starting", "startup": startup_times},
+        status=200 if ready else 503
+    )
+
+def parse_etags(header):
+    """Список ETag из заголовка If-None-Match (слабые сравниваются как сильные)"""
+    if not header:
+        return []
+    if header.strip() == '*':
+        return ['*']
+    return [tag.strip().removeprefix('W/') for tag in header.split(',')]
+
+TRUE_VALUES = ('1', 'true', 'yes')
+
+def error_response(message, status=400):
+    return web.json_response({"status": "error", "message": message}, status=status)
+
+def is_admin(request):
+    """Запрос несет Authorization: Bearer ADMIN_TOKEN"""
+    if not ADMIN_TOKEN:
+        return False
+    scheme, _, token = request.headers.get(hdrs.AUTHORIZATION, '').partition(' ')
+    return scheme.lower() == 'bearer' and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+async def query_stats(request):
+    """Статистика профилировщика запросов: GET - снимок, DELETE - сброс"""
+    if not is_admin(request):
+        return error_response("forbidden", status=403)
+    if request.method == hdrs.METH_DELETE:
+        database.profiler.reset()
+        return web.json_response({"status": "ok"})
+    order_by = request.query.get('order_by', 'total_ms')
+    if order_by not in ('total_ms', 'avg_ms', 'max_ms', 'calls', 'slow', 'errors', 'rows'):
+        return error_response("invalid order_by")
+    try:
+        limit = int(request.query.get('limit', 50))
+    except ValueError:
+        return error_response("invalid limit")
+    return web.json_response(database.profiler.stats(limit=max(1, limit), order_by=order_by))
 
 # Эндпоинт для получения задач
 async def get_tasks(request):
+    """Список задач пользователя.
+
+    Без limit/cursor/фильтров отдает весь список (из кэша, если он актуален).
+    С limit - страницу в порядке (date, time, id) и next_cursor для следующей.
+    Фильтры category, priority, task_type и archived (true/false/all)
+    применяются в SQL.
+    """
     try:
-        user_id = request.query.get('user_id')
+        query = request.query
+        user_id = query.get('user_id')
         if not user_id:
-            return web.json_response({"status": "error", "message": "user_id required"}, status=400)
+            return error_response("user_id required")
         
-        tasks = database.get_tasks_by_user(int(user_id))
+        user_id = int(user_id)
+        include_archived = query.get('include_archived', '').lower() in TRUE_VALUES
+        archived_param = query.get('archived', '').lower()
+        if not archived_param:
+            archived = None if include_archived else False
+        elif archived_param == 'all':
+            archived = None
+        else:
+            archived = archived_param in TRUE_VALUES
+        filters = {field: query[field] for field in database.TASK_FILTERS if query.get(field)}
         
-        # Преобразуем все задачи в формат, подходящий для JSON
-        tasks_list = []
-        for task in tasks:
-            task_dict = dict(task)
-            task_dict = convert_db_objects(task_dict)
-            tasks_list.append(task_dict)
+        limit = query.get('limit')
+        if limit is not None:
+            if not limit.isdigit() or not 1 <= int(limit) <= database.MAX_PAGE_SIZE:
+                return error_response(f"limit must be 1..{database.MAX_PAGE_SIZE}")
+            limit = int(limit)
+        cursor = query.get('cursor')
+        if cursor:
+            try:
+                database.decode_task_cursor(cursor)
+            except ValueError:
+                return error_response("invalid cursor")
+        paged = limit is not None or bool(cursor) or bool(filters) or archived is True
         
-        logger.info(f"📊 Отправлено {len(tasks_list)} задач для user_id={user_id}")
-        return web.json_response({"status": "ok", "tasks": tasks_list})
+        # Версия набора задач - одно чтение по первичному ключу, без самих задач
+        version = await database_async.get_task_version(user_id)
+        if version is None:
+            etag = None
+        elif paged:
+            params = sorted((k, v) for k, v in query.items() if k != 'user_id')
+            etag = f'"{version}-{zlib.crc32(repr(params).encode()):08x}"'
+        else:
+            etag = f'"{version}-{int(archived is None)}"'
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache'} if etag else None
+        
+        if etag and etag in parse_etags(request.headers.get(hdrs.IF_NONE_MATCH)):
+            return web.Response(status=304, headers=headers)
+        
+        if paged:
+            tasks, next_cursor = await database_async.get_tasks_page(
+                user_id, limit=limit, cursor=cursor, archived=archived, **filters
+            )
+            body = serializers.encode_tasks(tasks, next_cursor=next_cursor)
+            logger.info(f"📊 Отправлено {len(tasks)} задач (страница) для user_id={user_id}")
+            return web.Response(body=body, content_type='application/json', headers=headers)
+        
+        include_archived = archived is None
+        body = tasks_cache.get(user_id, include_archived, etag)
+        if body is not None:
+            logger.info(f"📊 Список задач user_id={user_id} отдан из кэша")
+            return web.Response(body=body, content_type='application/json', headers=headers)
+        
+        generation = tasks_cache.generation(user_id)
+        tasks = await database_async.get_tasks_by_user(user_id, include_archived)
+        body = serializers.encode_tasks(tasks)
+        # Пустой список не кэшируем: get_tasks_by_user возвращает [] и при ошибке БД
+        if tasks:
+            tasks_cache.put(user_id, include_archived, body, generation, etag)
+        
+        logger.info(f"📊 Отправлено {len(tasks)} задач для user_id={user_id}")
+        return web.Response(body=body, content_type='application/json', headers=headers)
     except Exception as e:
         logger.error(f"❌ Ошибка получения задач: {e}")
         return web.json_response({"status": "error", "message": str(e)}, status=500)
 
+# Эндпоинт дельта-синхронизации
+async def get_task_changes(request):
+    """Изменения задач пользователя после курсора since.
+
+    Без since отдает всю историю постранично. Ответ: tasks (измененные),
+    deleted (id удаленных), cursor для следующего запроса, has_more.
+    reset=true - курсор слишком старый, список нужно загрузить заново
+    через /api/tasks.
+    """
+    query = request.query
+    user_id = query.get('user_id')
+    if not user_id or not user_id.lstrip('-').isdigit():
+        return error_response("user_id required")
+    limit = query.get('limit', str(database.MAX_PAGE_SIZE))
+    if not limit.isdigit() or not 1 <= int(limit) <= database.MAX_PAGE_SIZE:
+        return error_response(f"limit must be 1..{database.MAX_PAGE_SIZE}")
+
+    try:
+        changes = await database_async.get_task_changes(int(user_id), query.get('since') or None, int(limit))
+    except ValueError:
+        return error_response("invalid cursor")
+    if changes is None:
+        return web.json_response({"status": "error", "message": "Failed to load changes"}, status=500)
+
+    tasks = changes.pop('tasks')
+    logger.info(f"🔄 Дельта для user_id={user_id}: {len(tasks)} изменено, {len(changes['deleted'])} удалено")
+    return web.Response(
+        body=serializers.encode_tasks(tasks, **changes),
+        content_type='application/json',
+        headers={'Cache-Control': 'no-store'}
+    )
+
+push_hub = push.PushHub.from_env()
+
+# Эндпоинт push-событий (Server-Sent Events)
+async def task_events(request):
+    """Поток событий об изменении задач пользователя.
+
+    Событие tasks приходит после любого изменения (из WebApp, из чата,
+    фоновых задач); клиент догружает изменения через /api/tasks/changes.
+    Комментарии-пинги не дают прокси закрыть простаивающее соединение.
+    """
+    user_id = request.query.get('user_id', '')
+    if not user_id.lstrip('-').isdigit():
+        return error_response("user_id required")
+    user_id = int(user_id)
+    if push_hub.full():
+        return error_response("too many connections", status=503)
+
+    response = web.StreamResponse(headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+    response.content_type = 'text/event-stream'
+    await response.prepare(request)
+
+    event = f'event: tasks\ndata: {{"type": "tasks_changed", "user_id": {user_id}}}\n\n'.encode()
+    with push_hub.subscribe(user_id) as subscription:
+        try:
+            # retry - пауза переподключения EventSource; ready - клиент может синхронизироваться
+            await response.write(b'retry: 5000\nevent: ready\ndata: {}\n\n')
+            while not subscription.closed:
+                changed = await subscription.wait()
+                await response.write(event if changed else b': ping\n\n')
+        except ConnectionResetError:
+            pass
+    return response
+
+EXPORT_FORMATS = {
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'json': ('application/json', 'json'),
+    'csv': ('text/csv', 'csv'),
+}
+
+# Эндпоинт потоковой выгрузки задач
+async def export_tasks(request):
+    """Все задачи пользователя потоком: ndjson (по умолчанию), json или csv.
+
+    Задачи читаются из БД пачками через серверный курсор (csv - через
+    COPY TO STDOUT) и сразу пишутся в ответ, поэтому память не зависит
+    от числа задач. Архивные включаются, если не передано include_archived=0.
+    """
+    query = request.query
+    user_id = query.get('user_id')
+    if not user_id or not user_id.lstrip('-').isdigit():
+        return error_response("user_id required")
+    user_id = int(user_id)
+    fmt = query.get('format', 'ndjson').lower()
+    if fmt not in EXPORT_FORMATS:
+        return error_response(f"format must be one of: {', '.join(EXPORT_FORMATS)}")
+    include_archived = query.get('include_archived', '1').lower() in TRUE_VALUES
+    content_type, extension = EXPORT_FORMATS[fmt]
+
+    response = web.StreamResponse(headers={
+        'Content-Disposition': f'attachment; filename="tasks-{user_id}.{extension}"',
+        'Cache-Control': 'no-store',
+    })
+    response.content_type = content_type
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+
+    count = 0
+    if fmt == 'csv':
+        chunks = database_async.copy_tasks_csv(user_id, include_archived)
+        try:
+            async for chunk in chunks:
+                await response.write(chunk)
+        finally:
+            await chunks.aclose()
+    else:
+        batches = database_async.iter_task_batches(user_id, include_archived)
+        try:
+            if fmt == 'json':
+                await response.write(b'[')
+            async for tasks in batches:
+                if fmt == 'json':
+                    await response.write((b',' if count else b'') + serializers.encode_items(tasks))
+                else:
+                    await response.write(serializers.encode_ndjson(tasks))
+                count += len(tasks)
+            if fmt == 'json':
+                await response.write(b']')
+        finally:
+            await batches.aclose()
+
+    await response.write_eof()
+    logger.info(f"📦 Экспорт задач user_id={user_id} в {fmt} завершен")
+    return response
+
 # Эндпоинт для создания задачи
 async def create_task(request):
     try:
@@ -227,7 +563,7 @@ async def create_task(request):
             data['time'] = None
             data['is_reminder'] = False
         
-        task_id = database.add_task(
+        task_id = await database_async.add_task(
             user_id=data['user_id'],
             text=data['text'],
             date=data.get('date'),
@@ -258,6 +594,170 @@ async def create_task(request):
         logger.error(f"❌ Ошибка создания задачи: {e}")
         return web.json_response({"status": "error", "message": str(e)}, status=500)
 
+def validate_schedule(date, time):
+    """Проверяет формат даты (YYYY-MM-DD) и времени (HH:MM) из WebApp"""
+    try:
+        if date:
+            datetime.strptime(date, "%Y-%m-%d")
+        if time:
+            datetime.strptime(time, "%H:%M")
+    except (TypeError, ValueError):
+        raise ValueError("invalid date or time")
+
+def register_notifications(rows):
+    """Передает движку напоминаний новые remind_at задач одним проходом.
+
+    Наступившие уведомления ставятся на текущий момент; задачи без
+    remind_at снимаются из окна. Уведомления за пределами окна движок
+    подхватит из БД сам.
+    """
+    now_utc = datetime.now(timezone.utc).replace(tzinfo=None)
+    reminder_engine.schedule_many(
+        (row['id'], max(row['remind_at'], now_utc) if row['remind_at'] else None)
+        for row in rows
+    )
+
+def normalize_task(item, user_id):
+    """Проверяет задачу из пакета и приводит ее к полям database.add_tasks"""
+    if not isinstance(item, dict):
+        raise ValueError("task must be an object")
+    text = item.get('text')
+    if not isinstance(text, str) or not text.strip():
+        raise ValueError("text required")
+    task_type = item.get('task_type', 'task')
+    is_reminder = bool(item.get('is_reminder', False))
+    date, time = item.get('date'), item.get('time')
+    # Для заметки не требуем дату и время
+    if task_type == 'note':
+        date, time, is_reminder = None, None, False
+    validate_schedule(date, time)
+    try:
+        reminder = int(item.get('reminder', 0))
+    except (TypeError, ValueError):
+        raise ValueError("invalid reminder")
+    return {
+        'user_id': user_id,
+        'text': text,
+        'category': item.get('category', 'personal'),
+        'priority': item.get('priority', 'medium'),
+        'date': date or None,
+        'time': time or None,
+        'reminder': reminder,
+        'emoji': item.get('emoji', '📝'),
+        'is_reminder': is_reminder,
+        'task_type': task_type,
+    }
+
+# Эндпоинт пакетного создания задач
+async def create_tasks_batch(request):
+    """Создает до MAX_BATCH_SIZE задач одним запросом к БД.
+
+    Тело: {"user_id": ID, "tasks": [{...}, ...]}. Задачи с ошибками
+    валидации пропускаются, остальные вставляются одной командой.
+    В results - статус каждой задачи в порядке запроса.
+    """
+    try:
+        data = await request.json()
+    except ValueError:
+        return error_response("invalid JSON")
+    if not isinstance(data, dict) or not data.get('user_id'):
+        return error_response("user_id required")
+    items = data.get('tasks')
+    if not isinstance(items, list) or not items:
+        return error_response("tasks must be a non-empty list")
+    if len(items) > database.MAX_BATCH_SIZE:
+        return error_response(f"at most {database.MAX_BATCH_SIZE} tasks per batch")
+    try:
+        user_id = int(data['user_id'])
+    except (TypeError, ValueError):
+        return error_response("invalid user_id")
+
+    results = [None] * len(items)
+    valid, positions = [], []
+    for index, item in enumerate(items):
+        try:
+            valid.append(normalize_task(item, user_id))
+            positions.append(index)
+        except ValueError as e:
+            results[index] = {"index": index, "status": "error", "message": str(e)}
+
+    created = await database_async.add_tasks(valid) if valid else []
+    if created is None:
+        return web.json_response({"status": "error", "message": "Failed to create tasks"}, status=500)
+
+    for index, row in zip(positions, created):
+        results[index] = {"index": index, "status": "ok", "task_id": row['id']}
+    register_notifications(created)
+
+    logger.info(f"✅ Пакет задач для user_id={user_id}: создано {len(created)} из {len(items)}")
+    return web.json_response({"status": "ok", "created": len(created), "results": results})
+
+# Эндпоинт изменения задач
+async def update_task(request):
+    """Изменяет одну задачу или выполняет массовое действие.
+
+    {"user_id": ID, "task_id": ID, "updates": {...}} - правка полей из
+    database.UPDATABLE_COLUMNS. {"user_id": ID, "task_ids": [...],
+    "action": "complete|archive|delete|reschedule"[, "date", "time"]} -
+    одно UPDATE по всем задачам. Уведомления перенесенных задач
+    перерегистрируются одним проходом.
+    """
+    try:
+        data = await request.json()
+    except ValueError:
+        return error_response("invalid JSON")
+    if not isinstance(data, dict) or not data.get('user_id'):
+        return error_response("user_id required")
+    try:
+        user_id = int(data['user_id'])
+        if 'action' in data:
+            task_ids = data.get('task_ids', [data.get('task_id')])
+            if not isinstance(task_ids, list) or not task_ids or len(task_ids) > database.MAX_BULK_IDS:
+                return error_response(f"task_ids must be a list of 1..{database.MAX_BULK_IDS} ids")
+            task_ids = [int(task_id) for task_id in task_ids]
+        else:
+            task_id = int(data['task_id'])
+    except (KeyError, TypeError, ValueError):
+        return error_response("user_id and task_id(s) must be integers")
+
+    try:
+        if 'action' in data:
+            action = data['action']
+            if action == 'reschedule':
+                validate_schedule(data.get('date'), data.get('time'))
+            updated = await database_async.bulk_update_tasks(
+                user_id, task_ids, action, date=data.get('date'), time=data.get('time')
+            )
+            if updated is None:
+                return web.json_response({"status": "error", "message": "Failed to update tasks"}, status=500)
+            if action == 'reschedule':
+                register_notifications(updated)
+            updated_ids = {row['id'] for row in updated}
+            return web.json_response({
+                "status": "ok",
+                "action": action,
+                "updated": sorted(updated_ids),
+                "not_found": [task_id for task_id in task_ids if task_id not in updated_ids],
+            })
+
+        updates = data.get('updates')
+        if not isinstance(updates, dict):
+            return error_response("updates must be an object")
+        updates = dict(updates)
+        if updates.get('task_type') == 'note':
+            updates.update(date=None, time=None, is_reminder=False)
+        validate_schedule(updates.get('date'), updates.get('time'))
+        row = await database_async.update_task(task_id, user_id, updates)
+    except ValueError as e:
+        return error_response(str(e))
+
+    if row is None:
+        return error_response("Task not found", status=404)
+    if set(updates) & {'date', 'time', 'is_reminder', 'task_type'}:
+        register_notifications([row])
+    logger.info(f"✅ Задача {task_id} обновлена для user_id={user_id}: {', '.join(updates)}")
+    return web.json_response({"status": "ok", "task_id": task_id})
+
 # ========== ФУНКЦИЯ ПЛАНИРОВАНИЯ УВЕДОМЛЕНИЙ ==========
 async def schedule_notification(task_id, user_id, text, date_str, time_str, task_type):
     """Планирует отправку уведомления на указанное время (в часовом поясе Москвы)"""
@@ -273,17 +773,12 @@ async def schedule_notification(task_id, user_id, text, date_str, time_str, task
         now_utc = datetime.now(timezone.utc).replace(tzinfo=None)
         if notification_datetime_utc <= now_utc:
             logger.warning(f"⚠️ Уведомление {task_id} в прошлом, отправляем сразу")
-            await send_notification(task_id, user_id, text, task_type)
+            reminder_engine.schedule(task_id, now_utc)
             return False
         
-        # Добавляем задачу в планировщик (время в UTC)
-        scheduler.add_job(
-            send_notification,
-            trigger=DateTrigger(run_date=notification_datetime_utc),
-            args=[task_id, user_id, text, task_type],
-            id=f"notification_{task_id}",
-            replace_existing=True
-        )
+        # Регистрируем срабатывание в движке напоминаний (время в UTC).
+        # Если оно дальше загруженного окна, движок сам подхватит его из БД.
+        reminder_engine.schedule(task_id, notification_datetime_utc)
         
         moscow_time_str = notification_datetime.strftime("%d.%m.%Y %H:%M")
         logger.info(f"⏰ Уведомление {task_id} запланировано на {moscow_time_str} MSK (UTC+3)")
@@ -294,21 +789,57 @@ async def schedule_notification(task_id, user_id, text, date_str, time_str, task
         return False
 
 # ========== ФУНКЦИЯ ОТПРАВКИ УВЕДОМЛЕНИЯ ==========
-async def send_notification(task_id, user_id, text, task_type):
-    """Отправляет уведомление пользователю в зависимости от типа задачи"""
+# Пауза перед повтором, число попыток и постоянные ошибки (см. retries.py)
+retry_policy = retries.RetryPolicy.from_env()
+# Размер пачки уведомлений, забираемой из БД за раз
+NOTIFICATION_BATCH_SIZE = 100
+
+def notification_type(notification):
+    """Тип уведомления по строке из БД: 'reminder' или 'task'"""
+    if notification['task_type']:
+        return notification['task_type']
+    return 'reminder' if notification['is_reminder'] else 'task'
+
+async def send_claimed(notifications):
+    """Отправляет взятые уведомления; адресованные недоступным чатам - сразу в dead-letter"""
+    blocked = [n['id'] for n in notifications if n['blocked']]
+    if blocked:
+        await database_async.dead_letter_notifications(blocked, 'chat blocked')
+        NOTIFICATION_FAILURES.inc(len(blocked), action='suppressed')
+    await asyncio.gather(*(
+        send_notification(n['id'], n['user_id'], n['text'], notification_type(n), n['send_attempts'])
+        for n in notifications if not n['blocked']
+    ))
+
+async def fire_notifications(task_ids):
+    """Срабатывание движка напоминаний: забирает уведомления в работу и отправляет их"""
+    notifications = await database_async.claim_notifications(task_ids)
+    record_fire_lag(notifications, 'engine')
+    if len(notifications) < len(task_ids):
+        logger.info(f"ℹ️ Уведомлений уже отправлено или взято другим воркером: {len(task_ids) - len(notifications)}")
+    await send_claimed(notifications)
+
+reminder_engine = reminders.ReminderEngine.from_env(fire_notifications)
+
+async def send_notification(task_id, user_id, text, task_type, attempts=0):
+    """Отправляет уже взятое в работу уведомление пользователю.
+
+    attempts - число предыдущих неудачных попыток (send_attempts).
+    """
     try:
         logger.info(f"🔔 Отправка {task_type} {task_id} пользователю {user_id}")
         
         if task_type == 'reminder':
             # Напоминание - отправляем и сразу архивируем
-            await bot.send_message(
+            await outbound.send_message(
+                bot,
                 chat_id=user_id,
                 text=f"🔔 *Напоминание!*\n\n{text}\n\n_Время выполнения наступило_",
                 parse_mode=ParseMode.MARKDOWN
             )
             
             # Помечаем напоминание как отправленное и архивируем
-            database.update_task_status(task_id, 'archived')
+            await database_async.mark_notification_sent(task_id, archive=True)
             logger.info(f"✅ Напоминание {task_id} отправлено и заархивировано")
             
         elif task_type == 'task':
@@ -320,35 +851,32 @@ async def send_notification(task_id, user_id, text, task_type):
                 ]
             ])
             
-            await bot.send_message(
+            await outbound.send_message(
+                bot,
                 chat_id=user_id,
                 text=f"📋 *Задача!*\n\n{text}\n\n_Выберите действие:_",
                 parse_mode=ParseMode.MARKDOWN,
                 reply_markup=keyboard
             )
+            await database_async.mark_notification_sent(task_id)
             logger.info(f"✅ Задача {task_id} отправлена с кнопками")
-        
-        # Удаляем задачу из планировщика
-        try:
-            scheduler.remove_job(f"notification_{task_id}")
-        except:
-            pass
             
     except Exception as e:
         logger.error(f"❌ Ошибка отправки уведомления {task_id}: {e}")
-        # Пробуем отправить позже (через 5 минут)
-        try:
-            retry_time = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(minutes=5)
-            scheduler.add_job(
-                send_notification,
-                trigger=DateTrigger(run_date=retry_time),
-                args=[task_id, user_id, text, task_type],
-                id=f"notification_retry_{task_id}_{datetime.now().timestamp()}",
-                replace_existing=True
-            )
-            logger.info(f"🔄 Уведомление {task_id} запланировано на повторную отправку")
-        except Exception as retry_error:
-            logger.error(f"❌ Ошибка планирования повторной отправки {task_id}: {retry_error}")
+        await handle_send_failure(task_id, user_id, attempts + 1, e)
+
+async def handle_send_failure(task_id, user_id, attempts, error):
+    """Повтор с паузой, dead-letter после исчерпания попыток или блокировка чата"""
+    decision = retry_policy.decide(attempts, error)
+    NOTIFICATION_FAILURES.inc(action=decision.action)
+    if decision.action == 'block':
+        # Чат недоступен навсегда: все его уведомления уходят в dead-letter одним запросом
+        await database_async.block_chat(user_id, decision.reason)
+    elif decision.action == 'dead':
+        await database_async.dead_letter_notifications([task_id], decision.reason)
+        logger.warning(f"☠️ Уведомление {task_id} перенесено в dead-letter после {attempts} попыток")
+    elif await database_async.release_notification(task_id, retry_in_seconds=decision.delay, error=decision.reason):
+        logger.info(f"🔄 Уведомление {task_id}: попытка {attempts + 1} через {decision.delay:.0f} с")
 
 # ========== ОБРАБОТКА КНОПОК ЗАДАЧ ==========
 @router.callback_query(F.data.startswith("task_"))
@@ -360,7 +888,7 @@ async def handle_task_action(callback: CallbackQuery):
         
         if action == "done":
             # Помечаем задачу как выполненную
-            database.update_task_status(task_id, 'completed')
+            await database_async.update_task_status(task_id, 'completed')
             
             await callback.answer("✅ Задача отмечена как выполненная")
             await callback.message.edit_text(
@@ -369,7 +897,7 @@ async def handle_task_action(callback: CallbackQuery):
             
         elif action == "progress":
             # Помечаем задачу как в процессе
-            database.update_task_status(task_id, 'in_progress')
+            await database_async.update_task_status(task_id, 'in_progress')
             
             await callback.answer("📝 Задача отмечена как в процессе")
             await callback.message.edit_text(
@@ -384,39 +912,172 @@ async def handle_task_action(callback: CallbackQuery):
 async def check_and_send_pending_notifications():
     """Проверяет и отправляет просроченные уведомления"""
     try:
-        notifications = database.get_pending_notifications()
-        
-        for notification in notifications:
-            try:
-                task_id = notification['id']
-                user_id = notification['user_id']
-                text = notification['text']
-                task_type = notification['task_type'] if notification['task_type'] else ('reminder' if notification['is_reminder'] else 'task')
-                
-                # Отправляем уведомление
-                await send_notification(task_id, user_id, text, task_type)
-                
-                # Небольшая задержка между отправками
-                await asyncio.sleep(0.5)
-                
-            except Exception as e:
-                logger.error(f"❌ Ошибка обработки уведомления {notification.get('id')}: {e}")
-                continue
-                
+        # Забираем уведомления пачками: параллельные воркеры и реплики не пересекаются
+        while True:
+            notifications = await database_async.claim_pending_notifications(NOTIFICATION_BATCH_SIZE)
+            if not notifications:
+                break
+            record_fire_lag(notifications, 'backlog')
+
+            # Темп отправки задает очередь исходящих сообщений
+            await send_claimed(notifications)
+
+            if len(notifications) < NOTIFICATION_BATCH_SIZE:
+                break
+
     except Exception as e:
         logger.error(f"❌ Критическая ошибка в check_and_send_pending_notifications: {e}")
 
+# ========== ПРИЕМ ОБНОВЛЕНИЙ WEBHOOK ==========
+def update_chat_id(update):
+    """Чат обновления: обновления одного чата обрабатываются по порядку"""
+    try:
+        event = update.event
+    except Exception:
+        return None
+    chat = getattr(event, 'chat', None)
+    if chat is None and getattr(event, 'message', None) is not None:
+        chat = event.message.chat
+    if chat is not None:
+        return chat.id
+    user = getattr(event, 'from_user', None)
+    return user.id if user else None
+
+async def process_update(update):
+    # Обновления, принятые во время запуска, ждут миграций и прогрева
+    await startup_event().wait()
+    await dp.feed_update(bot, update)
+
+update_queue = webhook_queue.UpdateQueue.from_env(process_update, update_chat_id)
+
+async def webhook_endpoint(request):
+    """Принимает обновление в очередь и сразу отвечает Telegram"""
+    token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(token.encode(), SECRET_TOKEN.encode()):
+        return web.Response(status=401)
+    try:
+        update = Update.model_validate(await request.json(), context={"bot": bot})
+    except Exception as e:
+        # Повторная доставка не поможет: отвечаем 200, чтобы Telegram не повторял
+        logger.warning(f"⚠️ Некорректное обновление webhook: {e}")
+        return web.Response()
+    if not await update_queue.put(update):
+        # Очередь переполнена: Telegram повторит доставку позже
+        logger.warning("⚠️ Очередь webhook переполнена, обновление отклонено")
+        return web.Response(status=503, headers={'Retry-After': '1'})
+    return web.Response()
+
+def register_webhook(app):
+    """Регистрирует маршрут WEBHOOK_PATH (фоновая очередь или обработка в запросе)"""
+    if WEBHOOK_BACKGROUND:
+        update_queue.start()
+        app.router.add_post(WEBHOOK_PATH, webhook_endpoint)
+    else:
+        SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=SECRET_TOKEN).register(app, path=WEBHOOK_PATH)
+    logger.info(f"📡 Webhook маршрут зарегистрирован: {WEBHOOK_PATH}")
+
 # ========== ЗАПУСК ПРИЛОЖЕНИЯ ==========
+# Запуск в два этапа: setup_routes() и открытие порта занимают доли секунды,
+# а миграции, настройка webhook и прогрев фоновых компонентов идут в
+# on_startup() уже при работающем HTTP; очередь просроченных уведомлений
+# разбирается отдельной фоновой задачей после готовности.
+_startup_ready = None
+startup_times = {'listening_s': None, 'ready_s': None, 'backlog_drained_s': None}
+_background_tasks = set()
+
+def startup_event():
+    """Событие готовности; создается в работающем event loop"""
+    global _startup_ready
+    if _startup_ready is None:
+        _startup_ready = asyncio.Event()
+    return _startup_ready
+
+def _mark_startup(stage):
+    startup_times[stage] = round(time.monotonic() - STARTED_AT, 3)
+    logger.info(f"⏱️ Запуск: {stage} = {startup_times[stage]} с")
+
+metrics.REGISTRY.gauge(
+    'startup_stage_seconds', 'Время от старта процесса до этапа запуска', ('stage',),
+    callback=lambda: dict(startup_times))
+metrics.REGISTRY.gauge(
+    'ready', 'Приложение завершило запуск (1) или еще прогревается (0)',
+    callback=lambda: int(startup_event().is_set()))
+
+def spawn(coro):
+    """Фоновая задача, которая держится до завершения и отменяется при остановке"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+def setup_routes():
+    # Регистрируем HTTP маршруты
+    app.router.add_get('/health', health_check)
+    app.router.add_get('/ready', readiness_check)
+    app.router.add_get('/metrics', metrics_handler)
+    app.router.add_get('/api/admin/queries', query_stats)
+    app.router.add_delete('/api/admin/queries', query_stats)
+    app.router.add_get('/api/tasks', get_tasks)
+    app.router.add_get('/api/tasks/export', export_tasks)
+    app.router.add_get('/api/tasks/changes', get_task_changes)
+    app.router.add_get('/api/events', task_events)
+    app.router.add_post('/api/new_task', create_task)
+    app.router.add_post('/api/tasks/batch', create_tasks_batch)
+    app.router.add_post('/api/update_task', update_task)
+    
+    # Корневой маршрут
+    async def api_info(request):
+        return web.json_response({
+            "app": "TaskFlow Bot API",
+            "status": "running",
+            "version": "1.0",
+            "timezone": "Europe/Moscow (UTC+3)",
+            "endpoints": {
+                "GET /health": "Liveness, readiness and component stats",
+                "GET /ready": "Readiness probe (503 until startup completes)",
+                "GET /metrics": "Prometheus metrics",
+                "GET|DELETE /api/admin/queries[?limit=N&order_by=total_ms]": "Query profiler stats (admin token)",
+                "GET /api/tasks?user_id=ID[&limit=N&cursor=C&archived=&category=&priority=&task_type=]": "Get user tasks",
+                "GET /api/tasks/changes?user_id=ID[&since=CURSOR&limit=N]": "Tasks changed since cursor",
+                "GET /api/events?user_id=ID": "Server-sent task change events",
+                "GET /api/tasks/export?user_id=ID[&format=ndjson|json|csv&include_archived=0]": "Stream all user tasks",
+                "POST /api/new_task": "Create new task",
+                "POST /api/tasks/batch": "Create up to 500 tasks at once",
+                "POST /api/update_task": "Update task or bulk complete/archive/delete/reschedule"
+            }
+        })
+    
+    app.router.add_get('/', api_info)
+    app.router.add_get('/api', api_info)
+
+    if WEBHOOK_HOST:
+        register_webhook(app)
+    else:
+        logger.warning("⚠️ WEBHOOK_HOST не указан, работаем без webhook")
+
+async def drain_backlog():
+    """Отправляет уведомления, накопившиеся за время простоя"""
+    try:
+        await check_and_send_pending_notifications()
+        logger.info("✅ Проверка отложенных уведомлений выполнена")
+    except Exception as e:
+        logger.error(f"❌ Ошибка проверки отложенных уведомлений: {e}")
+    _mark_startup('backlog_drained_s')
+
 async def on_startup():
+    """Прогрев после открытия порта; по завершении приложение готово (/ready)"""
     logger.info("=== Запуск бота ===")
     
     # Инициализируем БД
     try:
-        database.init_db()
+        await database_async.init_db()
         logger.info("✅ База данных инициализирована")
     except Exception as e:
         logger.error(f"❌ Ошибка инициализации БД: {e}")
 
+    # Запускаем очередь исходящих сообщений
+    outbound.start()
+
     # Запускаем планировщик
     try:
         scheduler.start()
@@ -424,25 +1085,16 @@ async def on_startup():
     except Exception as e:
         logger.error(f"❌ Ошибка запуска планировщика: {e}")
 
-    # Проверяем и отправляем отложенные уведомления
-    try:
-        await check_and_send_pending_notifications()
-        logger.info("✅ Проверка отложенных уведомлений выполнена")
-    except Exception as e:
-        logger.error(f"❌ Ошибка проверки отложенных уведомлений: {e}")
+    # Запускаем движок напоминаний (заменяет отдельные задачи планировщика)
+    reminder_engine.start()
+    # Push-канал изменений задач для открытых WebApp
+    push_hub.start()
 
     # Запускаем периодические задачи
     try:
+        # Обслуживание идет пачками через пул потоков БД и не блокирует event loop
         scheduler.add_job(
-            check_and_send_pending_notifications,
-            'interval',
-            minutes=5,
-            id='check_pending_notifications',
-            replace_existing=True
-        )
-        
-        scheduler.add_job(
-            lambda: database.archive_overdue_tasks(),
+            maintenance_engine.archive_overdue,
             'interval',
             hours=1,
             id='archive_tasks',
@@ -450,7 +1102,7 @@ async def on_startup():
         )
         
         scheduler.add_job(
-            lambda: database.cleanup_old_reminders(),
+            maintenance_engine.cleanup,
             'interval',
             days=1,
             id='cleanup_reminders',
@@ -460,30 +1112,6 @@ async def on_startup():
     except Exception as e:
         logger.error(f"❌ Ошибка добавления периодических задач: {e}")
 
-    # Регистрируем HTTP маршруты
-    app.router.add_get('/health', health_check)
-    app.router.add_get('/api/tasks', get_tasks)
-    app.router.add_post('/api/new_task', create_task)
-    app.router.add_post('/api/update_task', lambda r: web.json_response({"status": "ok"}))
-    
-    # Корневой маршрут
-    async def api_info(request):
-        return web.json_response({
-            "app": "TaskFlow Bot API",
-            "status": "running",
-            "version": "1.0",
-            "timezone": "Europe/Moscow (UTC+3)",
-            "endpoints": {
-                "GET /health": "Health check",
-                "GET /api/tasks?user_id=ID": "Get user tasks",
-                "POST /api/new_task": "Create new task",
-                "POST /api/update_task": "Update task"
-            }
-        })
-    
-    app.router.add_get('/', api_info)
-    app.router.add_get('/api', api_info)
-
     # Настраиваем webhook
     if WEBHOOK_HOST:
         try:
@@ -497,17 +1125,12 @@ async def on_startup():
                 
         except Exception as e:
             logger.error(f"❌ Ошибка настройки webhook: {e}")
-        
-        webhook_handler = SimpleRequestHandler(
-            dispatcher=dp,
-            bot=bot,
-            secret_token=SECRET_TOKEN
-        )
-        
-        webhook_handler.register(app, path=WEBHOOK_PATH)
-        logger.info(f"📡 Webhook маршрут зарегистрирован: {WEBHOOK_PATH}")
-    else:
-        logger.warning("⚠️ WEBHOOK_HOST не указан, работаем без webhook")
+
+    startup_event().set()
+    _mark_startup('ready_s')
+
+    # Просроченные уведомления разбираются в фоне: темп задает очередь отправки
+    spawn(drain_backlog())
     
     # Уведомление администратору
     admin_id = os.getenv('ADMIN_ID')
@@ -530,6 +1153,11 @@ async def on_startup():
 
 async def on_shutdown():
     logger.info("=== Остановка бота ===")
+
+    tasks = list(_background_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
     
     if WEBHOOK_HOST:
         try:
@@ -545,10 +1173,22 @@ async def on_shutdown():
     except Exception as e:
         logger.error(f"❌ Ошибка остановки планировщика: {e}")
 
-async def main():
+    # Принятые обновления дообрабатываются, пока пул БД и очередь отправки еще живы
+    await update_queue.stop()
+    await push_hub.stop()
+    await reminder_engine.stop()
+    await outbound.stop()
+    await dp.storage.close()
+
     try:
-        await on_startup()
+        database_async.shutdown()
+        database.close_pool()
+    except Exception as e:
+        logger.error(f"❌ Ошибка закрытия пула соединений: {e}")
 
+async def main():
+    try:
+        setup_routes()
         setup_application(app, dp, bot=bot)
         
         runner = web.AppRunner(app)
@@ -557,8 +1197,12 @@ async def main():
         port = int(os.getenv('PORT', 10000))
         logger.info(f"🚀 Запуск сервера на порту {port}")
         
+        # Порт открывается до прогрева: платформа сразу видит живой /health
         site = web.TCPSite(runner, '0.0.0.0', port)
         await site.start()
+        _mark_startup('listening_s')
+
+        await on_startup()
         
         bot_info = await bot.get_me()
         logger.info(f"🤖 Бот @{bot_info.username} запущен")
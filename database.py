@@ -1,14 +1,31 @@
 import os
+import json
+import time
+import base64
 import logging
+import functools
+import threading
+from collections import deque
 from datetime import datetime, timedelta, timezone
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import Json, RealDictCursor, execute_values
+
+import metrics
+import query_profiler
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def get_connection():
-    """Создает соединение с базой данных"""
+def _env_int(name, default):
+    """Читает целочисленную настройку из переменных окружения"""
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        logger.warning(f"⚠️ Некорректное значение {name}, используем {default}")
+        return default
+
+def _connect():
+    """Открывает новое физическое соединение с базой данных"""
     try:
         database_url = os.getenv('DATABASE_URL')
         if database_url:
@@ -27,71 +44,370 @@ def get_connection():
         logger.error(f"❌ Ошибка подключения к БД: {e}")
         raise
 
-def init_db():
-    """Инициализация таблиц в базе данных"""
-    conn = None
-    try:
-        conn = get_connection()
-        cur = conn.cursor()
-        
-        # Создаем таблицу задач (без колонки status сначала)
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS tasks (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL,
-                text TEXT NOT NULL,
-                category TEXT DEFAULT 'personal',
-                priority TEXT DEFAULT 'medium',
-                date DATE,
-                time TIME,
-                reminder INTEGER DEFAULT 0,
-                emoji TEXT DEFAULT '📝',
-                completed BOOLEAN DEFAULT FALSE,
-                deleted BOOLEAN DEFAULT FALSE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                completed_at TIMESTAMP,
-                deleted_at TIMESTAMP,
-                remind_at TIMESTAMP,
-                reminder_sent BOOLEAN DEFAULT FALSE,
-                is_reminder BOOLEAN DEFAULT FALSE,
-                archived BOOLEAN DEFAULT FALSE,
-                task_type TEXT DEFAULT 'task'
-            )
-        ''')
-        
-        # Проверяем наличие колонки status и добавляем если нет
+class PoolTimeout(Exception):
+    """Не удалось получить соединение из пула за отведенное время"""
+
+# Профилирование запросов (DB_PROFILE=1, см. query_profiler.py)
+profiler = query_profiler.QueryProfiler.from_env()
+
+class ProfilingCursor(RealDictCursor):
+    """Курсор, передающий каждый запрос в profiler"""
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
         try:
-            cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name='tasks' AND column_name='status'")
-            if not cur.fetchone():
-                cur.execute('ALTER TABLE tasks ADD COLUMN status TEXT DEFAULT \'active\'')
-                logger.info("✅ Добавлена колонка status")
-        except Exception as e:
-            logger.warning(f"⚠️ Ошибка проверки/добавления колонки status: {e}")
-        
-        # Создаем индексы
+            result = super().execute(query, vars)
+        except Exception:
+            profiler.record(self.connection, query, vars, time.perf_counter() - started, None, error=True)
+            raise
+        profiler.record(self.connection, query, vars, time.perf_counter() - started, self.rowcount)
+        return result
+
+class PooledConnection:
+    """Соединение из пула: close() возвращает его в пул вместо закрытия"""
+
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self._raw = raw
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def __setattr__(self, name, value):
+        if name in ('_pool', '_raw'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._raw, name, value)
+
+    def cursor(self, *args, **kwargs):
+        # Именованные (серверные) курсоры и явно заданные фабрики не профилируются
+        if profiler.enabled and not args and not kwargs:
+            return self._raw.cursor(cursor_factory=ProfilingCursor)
+        return self._raw.cursor(*args, **kwargs)
+
+    def close(self):
+        raw, self._raw = self._raw, None
+        if raw is not None:
+            self._pool.putconn(raw)
+
+    def __del__(self):
+        # Страховка на случай, если соединение забыли вернуть
+        if getattr(self, '_raw', None) is not None:
+            try:
+                self.close()
+            except Exception:
+                pass
+
+class ConnectionPool:
+    """Потокобезопасный пул соединений с проверкой здоровья и ротацией"""
+
+    def __init__(self, connect, minconn=1, maxconn=10, recycle=1800,
+                 timeout=30, check_idle=30):
+        self._connect = connect
+        self.minconn = max(0, minconn)
+        self.maxconn = max(1, maxconn, self.minconn)
+        self.recycle = recycle
+        self.timeout = timeout
+        self.check_idle = check_idle
+
+        self._cond = threading.Condition()
+        self._idle = deque()      # (conn, created_at, last_used)
+        self._created = {}        # id(conn) -> время открытия
+        self._size = 0
+        self._in_use = 0
+        self._waiting = 0
+        self._closed = False
+
+        self._checkouts = 0
+        self._timeouts = 0
+        self._opened = 0
+        self._recycled = 0
+        self._failed_checks = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def prefill(self):
+        """Открывает minconn соединений заранее"""
+        while True:
+            with self._cond:
+                if self._closed or self._size >= self.minconn:
+                    return
+                self._size += 1
+            try:
+                conn = self._open()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._idle.append((conn, self._created[id(conn)], time.monotonic()))
+                self._cond.notify()
+
+    def _open(self):
+        conn = self._connect()
+        with self._cond:
+            self._created[id(conn)] = time.monotonic()
+            self._opened += 1
+        return conn
+
+    def _discard(self, conn):
+        with self._cond:
+            self._created.pop(id(conn), None)
         try:
-            cur.execute('CREATE INDEX IF NOT EXISTS idx_tasks_user_id ON tasks(user_id)')
-            cur.execute('CREATE INDEX IF NOT EXISTS idx_tasks_remind_at ON tasks(remind_at)')
-        except Exception as e:
-            logger.warning(f"⚠️ Ошибка создания базовых индексов: {e}")
-        
-        # Пробуем создать индекс для status (может не существовать если колонка не добавилась)
+            conn.close()
+        except Exception:
+            pass
+
+    def _healthy(self, conn):
         try:
-            cur.execute('CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks(status)')
-        except:
-            pass  # Игнорируем ошибку если колонки status нет
-        
-        conn.commit()
-        logger.info("✅ База данных инициализирована")
-        
-    except Exception as e:
-        logger.error(f"❌ Ошибка инициализации БД: {e}")
-        if conn:
+            cur = conn.cursor()
+            cur.execute('SELECT 1')
+            cur.close()
             conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _validate(self, entry):
+        """Проверяет соединение из простоя и при необходимости заменяет его"""
+        conn, created_at, last_used = entry
+        now = time.monotonic()
+        if conn.closed or (self.recycle and now - created_at > self.recycle):
+            with self._cond:
+                self._recycled += 1
+            self._discard(conn)
+            return self._open()
+        if self.check_idle is not None and now - last_used >= self.check_idle:
+            if not self._healthy(conn):
+                with self._cond:
+                    self._failed_checks += 1
+                logger.warning("⚠️ Соединение из пула не прошло проверку, переподключаемся")
+                self._discard(conn)
+                return self._open()
+        return conn
+
+    def getconn(self):
+        """Выдает соединение из пула, ожидая освобождения при необходимости"""
+        started = time.monotonic()
+        deadline = started + self.timeout if self.timeout else None
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolTimeout("Пул соединений закрыт")
+                if self._idle:
+                    entry = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    self._size += 1
+                    entry = None
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout(
+                        f"Нет свободных соединений в пуле ({self.maxconn}) за {self.timeout} с"
+                    )
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            self._in_use += 1
+
+        try:
+            conn = self._open() if entry is None else self._validate(entry)
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+        waited = time.monotonic() - started
+        with self._cond:
+            self._checkouts += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        return conn
+
+    def putconn(self, conn):
+        """Возвращает соединение в пул, откатывая незавершенную транзакцию"""
+        keep = not conn.closed and not self._closed
+        if keep:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if conn.autocommit:
+                    conn.autocommit = False
+            except Exception:
+                keep = False
+        with self._cond:
+            created_at = self._created.get(id(conn), 0)
+            if keep and self.recycle and time.monotonic() - created_at > self.recycle:
+                self._recycled += 1
+                keep = False
+            self._in_use -= 1
+            if keep:
+                self._idle.append((conn, created_at, time.monotonic()))
+            else:
+                self._size -= 1
+            self._cond.notify()
+        if not keep:
+            self._discard(conn)
+
+    def closeall(self):
+        """Закрывает все простаивающие соединения и запрещает новые выдачи"""
+        with self._cond:
+            self._closed = True
+            idle, self._idle = list(self._idle), deque()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _, _ in idle:
+            self._discard(conn)
+
+    def stats(self):
+        """Снимок состояния пула"""
+        with self._cond:
+            checkouts = self._checkouts
+            return {
+                'min': self.minconn,
+                'max': self.maxconn,
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+                'waiting': self._waiting,
+                'checkouts': checkouts,
+                'timeouts': self._timeouts,
+                'opened': self._opened,
+                'recycled': self._recycled,
+                'failed_health_checks': self._failed_checks,
+                'wait_time_total_ms': round(self._wait_total * 1000, 3),
+                'wait_time_avg_ms': round(self._wait_total * 1000 / checkouts, 3) if checkouts else 0.0,
+                'wait_time_max_ms': round(self._wait_max * 1000, 3),
+            }
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Возвращает пул соединений, создавая его при первом обращении"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                pool = ConnectionPool(
+                    _connect,
+                    minconn=_env_int('DB_POOL_MIN', 1),
+                    maxconn=_env_int('DB_POOL_MAX', 10),
+                    recycle=_env_int('DB_POOL_RECYCLE', 1800),
+                    timeout=_env_int('DB_POOL_TIMEOUT', 30),
+                    check_idle=_env_int('DB_POOL_CHECK_IDLE', 30),
+                )
+                try:
+                    pool.prefill()
+                except Exception as e:
+                    logger.warning(f"⚠️ Не удалось заранее открыть соединения пула: {e}")
+                logger.info(f"✅ Пул соединений создан (min={pool.minconn}, max={pool.maxconn})")
+                _pool = pool
+    return _pool
+
+def get_pool_stats():
+    """Статистика пула: занятые, ожидающие, время ожидания выдачи"""
+    if _pool is None:
+        return None
+    return _pool.stats()
+
+def close_pool():
+    """Закрывает пул соединений (при остановке приложения)"""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.closeall()
+        logger.info("✅ Пул соединений закрыт")
+
+def get_connection():
+    """Выдает соединение из пула; close() возвращает его обратно"""
+    try:
+        pool = get_pool()
+        return PooledConnection(pool, pool.getconn())
+    except Exception as e:
+        logger.error(f"❌ Ошибка подключения к БД: {e}")
         raise
-    finally:
-        if conn:
-            conn.close()
+
+# Подписчики на изменения задач: fn(user_ids) вызывается после коммита
+_change_listeners = []
+
+def add_change_listener(listener):
+    """Подписывает listener(user_ids) на изменения задач пользователей"""
+    _change_listeners.append(listener)
+
+def _notify_changed(user_ids):
+    user_ids = {int(uid) for uid in user_ids if uid is not None}
+    if not user_ids:
+        return
+    for listener in _change_listeners:
+        try:
+            listener(user_ids)
+        except Exception as e:
+            logger.error(f"❌ Ошибка обработчика изменений задач: {e}")
+
+# Условие "по задаче нужно уведомление, и оно еще не отправлено".
+# Совпадает с предикатом частичного индекса idx_tasks_due_notifications (migrations.py).
+_NOTIFIABLE_WHERE = '''
+    remind_at IS NOT NULL
+    AND reminder_sent = FALSE
+    AND deleted = FALSE
+    AND completed = FALSE
+    AND archived = FALSE
+    AND (is_reminder = TRUE OR task_type = 'task')
+'''
+
+# Условие "уведомление пора отправить" (время в UTC)
+_DUE_NOTIFICATIONS_WHERE = _NOTIFIABLE_WHERE + '''
+    AND remind_at <= NOW() AT TIME ZONE 'UTC'
+'''
+
+_NOTIFICATION_COLUMNS = 'id, user_id, text, date, time, emoji, remind_at, task_type, is_reminder, send_attempts'
+
+# Взятое уведомление адресовано чату, который заблокировал бота (см. block_chat)
+_BLOCKED_COLUMN = 'EXISTS (SELECT 1 FROM blocked_chats b WHERE b.user_id = t.user_id) AS blocked'
+
+# Порядок списка задач: сначала с датой, затем по времени (NULL в конце).
+# Те же выражения стоят в индексах (migrations.py), поэтому список читается уже упорядоченным.
+_TASK_ORDER_DATE = "COALESCE(date, 'infinity'::date)"
+_TASK_ORDER_TIME = "COALESCE(time, '24:00'::time)"
+_TASK_ORDER = f"{_TASK_ORDER_DATE}, {_TASK_ORDER_TIME}, id"
+
+_TASK_COLUMNS = '''id, user_id, text, category, priority, date, time,
+                      reminder, completed, deleted, created_at, completed_at,
+                      deleted_at, emoji, is_reminder, archived, task_type,
+                      updated_at'''
+
+# Отметка изменения строки для дельта-синхронизации (naive UTC, как remind_at).
+# clock_timestamp(), а не NOW(): ближе к моменту фиксации длинной транзакции
+_TOUCH = "updated_at = clock_timestamp() AT TIME ZONE 'UTC'"
+
+# Поля, по которым список задач можно фильтровать на стороне БД
+TASK_FILTERS = ('category', 'priority', 'task_type')
+MAX_PAGE_SIZE = 500
+
+def init_db():
+    """Приводит схему БД к актуальной версии (см. migrations.py)"""
+    import migrations
+    return migrations.migrate()
+
+def _compute_remind_at(date, time, is_reminder, task_type):
+    """Время уведомления в UTC (naive) для задачи/напоминания с датой и временем"""
+    if not ((is_reminder or task_type == 'task') and date and time):
+        return None
+    try:
+        # Время приходит в MSK (UTC+3), вычитаем 3 часа для UTC
+        return datetime.strptime(f"{date} {time}", "%Y-%m-%d %H:%M") - timedelta(hours=3)
+    except Exception as e:
+        logger.error(f"❌ Ошибка преобразования времени: {e}")
+        return None
 
 def add_task(user_id, text, date=None, time=None, reminder=0, 
              category='personal', priority='medium', emoji='📝',
@@ -103,42 +419,22 @@ def add_task(user_id, text, date=None, time=None, reminder=0,
         cur = conn.cursor()
 
         # Рассчитываем remind_at для уведомлений
-        remind_at = None
-        if (is_reminder or task_type == 'task') and date and time:
-            try:
-                # Время приходит в MSK (UTC+3)
-                task_datetime = datetime.strptime(f"{date} {time}", "%Y-%m-%d %H:%M")
-                # Вычитаем 3 часа для UTC
-                task_datetime_utc = task_datetime - timedelta(hours=3)
-                remind_at = task_datetime_utc
-                logger.info(f"📅 Уведомление установлено на: {date} {time} MSK (UTC+3)")
-            except Exception as e:
-                logger.error(f"❌ Ошибка преобразования времени: {e}")
-                remind_at = None
-
-        # Пробуем вставить с колонкой status
-        try:
-            cur.execute('''
-                INSERT INTO tasks (user_id, text, category, priority, 
-                                  date, time, reminder, emoji, remind_at, 
-                                  is_reminder, task_type, status)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, 'active')
-                RETURNING id
-            ''', (user_id, text, category, priority, date, time, 
-                  reminder, emoji, remind_at, is_reminder, task_type))
-        except:
-            # Если нет колонки status, вставляем без нее
-            cur.execute('''
-                INSERT INTO tasks (user_id, text, category, priority, 
-                                  date, time, reminder, emoji, remind_at, 
-                                  is_reminder, task_type)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                RETURNING id
-            ''', (user_id, text, category, priority, date, time, 
-                  reminder, emoji, remind_at, is_reminder, task_type))
+        remind_at = _compute_remind_at(date, time, is_reminder, task_type)
+        if remind_at:
+            logger.info(f"📅 Уведомление установлено на: {date} {time} MSK (UTC+3)")
+
+        cur.execute('''
+            INSERT INTO tasks (user_id, text, category, priority, 
+                              date, time, reminder, emoji, remind_at, 
+                              is_reminder, task_type, status)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, 'active')
+            RETURNING id
+        ''', (user_id, text, category, priority, date, time, 
+              reminder, emoji, remind_at, is_reminder, task_type))
 
         task_id = cur.fetchone()['id']
         conn.commit()
+        _notify_changed([user_id])
 
         logger.info(f"✅ Задача {task_id} добавлена для user_id={user_id}, тип: {task_type}")
         return task_id
@@ -151,41 +447,80 @@ def add_task(user_id, text, date=None, time=None, reminder=0,
         if conn:
             conn.close()
 
+MAX_BATCH_SIZE = 500
+
+_INSERT_COLUMNS = ('user_id', 'text', 'category', 'priority', 'date', 'time',
+                   'reminder', 'emoji', 'is_reminder', 'task_type')
+
+def add_tasks(tasks):
+    """Добавляет пачку задач одним INSERT ... VALUES.
+
+    tasks - список dict с ключами _INSERT_COLUMNS. remind_at считается для
+    всех задач за один проход. Пачка вставляется целиком или не вставляется
+    вовсе; возвращает список {id, remind_at} в порядке tasks или None при
+    ошибке.
+    """
+    if not tasks:
+        return []
+    conn = None
+    try:
+        conn = get_connection()
+        cur = conn.cursor()
+
+        rows = [
+            tuple(task[column] for column in _INSERT_COLUMNS) + (
+                _compute_remind_at(task['date'], task['time'], task['is_reminder'], task['task_type']),
+            )
+            for task in tasks
+        ]
+        created = execute_values(cur, f'''
+            INSERT INTO tasks ({', '.join(_INSERT_COLUMNS)}, remind_at, status)
+            VALUES %s
+            RETURNING id, remind_at
+        ''', rows, template=f"({', '.join(['%s'] * (len(_INSERT_COLUMNS) + 1))}, 'active')",
+            page_size=len(rows), fetch=True)
+        conn.commit()
+        _notify_changed({task['user_id'] for task in tasks})
+
+        logger.info(f"✅ Добавлено {len(created)} задач одной пачкой")
+        return created
+    except Exception as e:
+        logger.error(f"❌ Ошибка пакетного добавления задач: {e}")
+        if conn:
+            conn.rollback()
+        return None
+    finally:
+        if conn:
+            conn.close()
+
 def get_tasks_by_user(user_id, include_archived=False):
-    """Получает задачи пользователя"""
+    """Получает задачи пользователя.
+
+    Активные задачи лежат в секции tasks_active, архив - в tasks_archive
+    (миграция 11): без include_archived читается только горячая секция,
+    с ним - обе, слиянием по индексам.
+    """
     conn = None
     try:
         conn = get_connection()
         cur = conn.cursor()
         
         if include_archived:
-            cur.execute('''
-                SELECT id, user_id, text, category, priority, date, time,
-                      reminder, completed, deleted, created_at, completed_at,
-                      deleted_at, emoji, is_reminder, archived, task_type
+            cur.execute(f'''
+                SELECT {_TASK_COLUMNS}
                 FROM tasks 
                 WHERE user_id = %s 
                 AND deleted = FALSE
-                ORDER BY 
-                    CASE WHEN date IS NULL THEN 1 ELSE 0 END,
-                    date,
-                    CASE WHEN time IS NULL THEN 1 ELSE 0 END,
-                    time
+                ORDER BY {_TASK_ORDER}
             ''', (user_id,))
         else:
-            cur.execute('''
-                SELECT id, user_id, text, category, priority, date, time,
-                      reminder, completed, deleted, created_at, completed_at,
-                      deleted_at, emoji, is_reminder, archived, task_type
+            cur.execute(f'''
+                SELECT {_TASK_COLUMNS}
                 FROM tasks 
                 WHERE user_id = %s 
                 AND deleted = FALSE
                 AND archived = FALSE
-                ORDER BY 
-                    CASE WHEN date IS NULL THEN 1 ELSE 0 END,
-                    date,
-                    CASE WHEN time IS NULL THEN 1 ELSE 0 END,
-                    time
+                ORDER BY {_TASK_ORDER}
             ''', (user_id,))
 
         tasks = cur.fetchall()
@@ -197,77 +532,407 @@ def get_tasks_by_user(user_id, include_archived=False):
         if conn:
             conn.close()
 
+def encode_task_cursor(task):
+    """Непрозрачный курсор keyset-пагинации: ключ сортировки последней задачи"""
+    key = [
+        task['date'].isoformat() if task['date'] else 'infinity',
+        task['time'].isoformat() if task['time'] else '24:00:00',
+        task['id'],
+    ]
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip('=')
+
+def decode_task_cursor(cursor):
+    """Разбирает курсор; ValueError если он поврежден"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        date_key, time_key, task_id = json.loads(base64.urlsafe_b64decode(padded))
+        if date_key != 'infinity':
+            datetime.strptime(date_key, '%Y-%m-%d')
+        if time_key != '24:00:00':
+            datetime.strptime(time_key.split('.')[0], '%H:%M:%S')
+        return date_key, time_key, int(task_id)
+    except Exception:
+        raise ValueError('invalid cursor')
+
+def get_tasks_page(user_id, limit=None, cursor=None, archived=False, **filters):
+    """Страница задач пользователя в порядке списка (keyset-пагинация).
+
+    archived: False - только активные, True - только архивные, None - все.
+    filters: category, priority, task_type. Возвращает (задачи, курсор
+    следующей страницы или None).
+    """
+    conn = None
+    try:
+        conn = get_connection()
+        cur = conn.cursor()
+
+        conditions = ['user_id = %s', 'deleted = FALSE']
+        params = [user_id]
+        if archived is not None:
+            # Литерал в запросе позволяет использовать частичный индекс активных задач
+            conditions.append('archived = TRUE' if archived else 'archived = FALSE')
+        for field in TASK_FILTERS:
+            if filters.get(field) is not None:
+                conditions.append(f'{field} = %s')
+                params.append(filters[field])
+        if cursor:
+            conditions.append(f'({_TASK_ORDER}) > (%s::date, %s::time, %s)')
+            params.extend(decode_task_cursor(cursor))
+
+        query = f'''
+            SELECT {_TASK_COLUMNS}
+            FROM tasks
+            WHERE {' AND '.join(conditions)}
+            ORDER BY {_TASK_ORDER}
+        '''
+        if limit is not None:
+            query += ' LIMIT %s'
+            params.append(limit + 1)
+
+        cur.execute(query, params)
+        tasks = cur.fetchall()
+
+        next_cursor = None
+        if limit is not None and len(tasks) > limit:
+            tasks = tasks[:limit]
+            next_cursor = encode_task_cursor(tasks[-1])
+        return tasks, next_cursor
+    except ValueError:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения страницы задач: {e}")
+        return [], None
+    finally:
+        if conn:
+            conn.close()
+
+def get_task_version(user_id):
+    """Версия набора задач пользователя (растет при каждом изменении); None при ошибке"""
+    conn = None
+    try:
+        conn = get_connection()
+        cur = conn.cursor()
+
+        cur.execute('SELECT version FROM task_versions WHERE user_id = %s', (user_id,))
+        row = cur.fetchone()
+        return row['version'] if row else 0
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения версии задач: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+# Сколько хранятся tombstone удаленных задач; более старый курсор требует полной синхронизации
+TOMBSTONE_RETENTION_DAYS = 30
+# Строки моложе этого не отдаются в дельте: транзакция, начавшая запись
+# раньше, могла еще не зафиксироваться, и курсор бы ее перескочил
+CHANGES_SAFETY_LAG = 2
+
+def encode_change_cursor(changed_at, task_id):
+    """Курсор дельта-синхронизации: (время изменения, id) последней отданной строки"""
+    key = [changed_at.isoformat(), task_id]
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip('=')
+
+def decode_change_cursor(cursor):
+    """Разбирает курсор изменений; ValueError если он поврежден"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        changed_at, task_id = json.loads(base64.urlsafe_b64decode(padded))
+        return datetime.fromisoformat(changed_at), int(task_id)
+    except Exception:
+        raise ValueError('invalid cursor')
+
+def get_task_changes(user_id, since=None, limit=MAX_PAGE_SIZE):
+    """Задачи пользователя, измененные после курсора since.
+
+    Возвращает dict: tasks (измененные строки), deleted (id удаленных),
+    cursor (передать в следующий вызов), has_more, reset (курсор старше
+    срока хранения tombstone - нужна полная синхронизация). None при ошибке.
+    Стоимость пропорциональна числу изменений (индексы по user_id, updated_at).
+    """
+    position = decode_change_cursor(since) if since else None
+    conn = None
+    try:
+        conn = get_connection()
+        cur = conn.cursor()
+
+        # Верхняя граница считается один раз: литерал в запросе дает чистый
+        # диапазон по индексу (user_id, updated_at, id) без сортировки
+        cur.execute('''
+            SELECT clock_timestamp() AT TIME ZONE 'UTC' - %s * INTERVAL '1 second' AS until,
+                   %s::timestamp < NOW() AT TIME ZONE 'UTC' - %s * INTERVAL '1 day' AS expired
+        ''', (CHANGES_SAFETY_LAG, position[0] if position else None, TOMBSTONE_RETENTION_DAYS))
+        bounds = cur.fetchone()
+        if bounds['expired']:
+            return {'tasks': [], 'deleted': [], 'cursor': None, 'has_more': False, 'reset': True}
+
+        params = [user_id, bounds['until']] + list(position or ()) + [limit]
+        cur.execute(f'''
+            SELECT {_TASK_COLUMNS}
+            FROM tasks
+            WHERE user_id = %s
+            AND updated_at <= %s
+            {'AND (updated_at, id) > (%s, %s)' if position else ''}
+            ORDER BY updated_at, id
+            LIMIT %s
+        ''', params)
+        rows = [(row['updated_at'], row['id'], row) for row in cur.fetchall()]
+        cur.execute(f'''
+            SELECT task_id, deleted_at
+            FROM task_tombstones
+            WHERE user_id = %s
+            AND deleted_at <= %s
+            {'AND (deleted_at, task_id) > (%s, %s)' if position else ''}
+            ORDER BY deleted_at, task_id
+            LIMIT %s
+        ''', params)
+        tombstones = [(row['deleted_at'], row['task_id'], None) for row in cur.fetchall()]
+
+        # Слияние двух упорядоченных потоков; лишнее уйдет в следующую страницу
+        has_more = len(rows) >= limit or len(tombstones) >= limit
+        changes = sorted(rows + tombstones, key=lambda change: change[:2])[:limit]
+
+        tasks, deleted = [], []
+        for changed_at, task_id, row in changes:
+            if row is None or row['deleted']:
+                deleted.append(task_id)
+            else:
+                tasks.append(row)
+        cursor = encode_change_cursor(*changes[-1][:2]) if changes else since
+        return {'tasks': tasks, 'deleted': deleted, 'cursor': cursor, 'has_more': has_more, 'reset': False}
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения изменений задач: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+EXPORT_BATCH_SIZE = 1000
+
+def _export_query(cur, user_id, include_archived):
+    archived = '' if include_archived else 'AND archived = FALSE'
+    return cur.mogrify(f'''
+        SELECT {_TASK_COLUMNS}
+        FROM tasks
+        WHERE user_id = %s
+        AND deleted = FALSE
+        {archived}
+        ORDER BY {_TASK_ORDER}
+    ''', (user_id,)).decode()
+
+def iter_task_batches(user_id, include_archived=True, batch_size=EXPORT_BATCH_SIZE):
+    """Генератор задач пользователя пачками по batch_size.
+
+    Строки читаются через серверный (именованный) курсор, поэтому в памяти
+    одновременно находится не больше одной пачки. Соединение занято, пока
+    генератор не исчерпан или не закрыт. Ошибки пробрасываются: обрезанный
+    экспорт не должен выглядеть как полный.
+    """
+    conn = None
+    try:
+        conn = get_connection()
+        cur = conn.cursor(name=f'tasks_export_{user_id}')
+        cur.itersize = batch_size
+        cur.execute(_export_query(conn.cursor(), user_id, include_archived))
+        while True:
+            tasks = cur.fetchmany(batch_size)
+            if not tasks:
+                break
+            yield tasks
+        cur.close()
+    except Exception as e:
+        logger.error(f"❌ Ошибка экспорта задач: {e}")
+        raise
+    finally:
+        if conn:
+            conn.close()
+
+def copy_tasks_csv(user_id, out, include_archived=True):
+    """Пишет задачи пользователя в out (объект с write) как CSV через COPY TO STDOUT"""
+    conn = None
+    try:
+        conn = get_connection()
+        cur = conn.cursor()
+        query = _export_query(cur, user_id, include_archived)
+        cur.copy_expert(f'COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)', out)
+        return cur.rowcount
+    except Exception as e:
+        logger.error(f"❌ Ошибка экспорта задач в CSV: {e}")
+        raise
+    finally:
+        if conn:
+            conn.close()
+
+# Колонки, которые можно менять через update_task; остальные (статус,
+# служебные поля уведомлений) меняются только специальными функциями
+UPDATABLE_COLUMNS = ('text', 'category', 'priority', 'date', 'time', 'reminder',
+                     'emoji', 'is_reminder', 'task_type')
+_SCHEDULE_COLUMNS = {'date': 'date', 'time': 'time', 'is_reminder': 'boolean', 'task_type': 'text'}
+
+BULK_ACTIONS = ('complete', 'archive', 'delete', 'reschedule')
+MAX_BULK_IDS = 1000
+
+def _remind_at_sql(values):
+    """SQL-выражение remind_at (как _compute_remind_at) с учетом новых значений.
+
+    В SET колонки ссылаются на старую строку, поэтому измененные поля
+    подставляются параметрами %(name)s из values.
+    """
+    ref = {
+        column: f'%({column})s::{sql_type}' if column in values else column
+        for column, sql_type in _SCHEDULE_COLUMNS.items()
+    }
+    return f'''CASE WHEN ({ref['is_reminder']} OR {ref['task_type']} = 'task')
+            AND {ref['date']} IS NOT NULL AND {ref['time']} IS NOT NULL
+            THEN ({ref['date']} + {ref['time']}) - INTERVAL '3 hours' END'''
+
+# Повторное планирование: уведомление снова ждет отправки
+_RESCHEDULE_SET = '''reminder_sent = FALSE,
+                claimed_until = NULL'''
+
 def update_task(task_id, user_id, updates):
-    """Обновляет задачу"""
+    """Обновляет поля задачи из UPDATABLE_COLUMNS.
+
+    Если меняются дата, время или тип, remind_at пересчитывается в том же
+    UPDATE. Возвращает {id, remind_at} или None, если задача не найдена.
+    ValueError - если передана колонка не из списка.
+    """
+    unknown = set(updates) - set(UPDATABLE_COLUMNS)
+    if unknown:
+        raise ValueError(f"cannot update: {', '.join(sorted(unknown))}")
+    if not updates:
+        raise ValueError("nothing to update")
+
     conn = None
     try:
         conn = get_connection()
         cur = conn.cursor()
         
-        set_clause = []
-        params = []
-        
-        for key, value in updates.items():
-            set_clause.append(f"{key} = %s")
-            params.append(value)
+        set_clause = [f"{column} = %({column})s" for column in updates] + [_TOUCH]
+        if set(updates) & set(_SCHEDULE_COLUMNS):
+            set_clause.append(f"remind_at = {_remind_at_sql(updates)}")
+            set_clause.append(_RESCHEDULE_SET)
         
-        params.extend([task_id, user_id])
-        
-        query = f'''
+        cur.execute(f'''
             UPDATE tasks 
             SET {', '.join(set_clause)}
-            WHERE id = %s AND user_id = %s
-            RETURNING id
-        '''
-        
-        cur.execute(query, params)
+            WHERE id = %(task_id)s AND user_id = %(user_id)s AND deleted = FALSE
+            RETURNING id, remind_at
+        ''', {**updates, 'task_id': task_id, 'user_id': user_id})
         result = cur.fetchone()
         conn.commit()
+        if result is not None:
+            _notify_changed([user_id])
         
-        return result is not None
+        return result
     except Exception as e:
         logger.error(f"❌ Ошибка обновления задачи: {e}")
         if conn:
             conn.rollback()
-        return False
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def bulk_update_tasks(user_id, task_ids, action, date=None, time=None):
+    """Массовое действие над задачами пользователя одним UPDATE.
+
+    action: complete, archive, delete или reschedule (новые date/time).
+    Возвращает список {id, remind_at} измененных задач или None при ошибке.
+    """
+    if action not in BULK_ACTIONS:
+        raise ValueError(f"unknown action: {action}")
+    params = {'ids': list(task_ids), 'user_id': user_id}
+    if action == 'complete':
+        set_clause = '''completed = TRUE,
+                completed_at = CURRENT_TIMESTAMP,
+                archived = TRUE'''
+    elif action == 'archive':
+        set_clause = 'archived = TRUE'
+    elif action == 'delete':
+        set_clause = '''deleted = TRUE,
+                deleted_at = CURRENT_TIMESTAMP'''
+    else:
+        params.update(date=date, time=time)
+        # Перенесенная невыполненная задача снова становится активной
+        set_clause = f'''date = %(date)s,
+                time = %(time)s,
+                remind_at = {_remind_at_sql(params)},
+                archived = completed AND archived,
+                {_RESCHEDULE_SET}'''
+
+    conn = None
+    try:
+        conn = get_connection()
+        cur = conn.cursor()
+
+        cur.execute(f'''
+            UPDATE tasks
+            SET {set_clause},
+                {_TOUCH}
+            WHERE id = ANY(%(ids)s) AND user_id = %(user_id)s AND deleted = FALSE
+            RETURNING id, remind_at
+        ''', params)
+        updated = cur.fetchall()
+        conn.commit()
+        if updated:
+            _notify_changed([user_id])
+
+        logger.info(f"✅ {action}: изменено {len(updated)} из {len(params['ids'])} задач user_id={user_id}")
+        return updated
+    except Exception as e:
+        logger.error(f"❌ Ошибка массового обновления задач ({action}): {e}")
+        if conn:
+            conn.rollback()
+        return None
     finally:
         if conn:
             conn.close()
 
 def update_task_status(task_id, status):
-    """Обновляет статус задачи"""
+    """Обновляет статус задачи.
+
+    Смена archived переносит строку между секциями tasks_active и
+    tasks_archive в том же UPDATE.
+    """
     conn = None
     try:
         conn = get_connection()
         cur = conn.cursor()
         
         if status == 'completed':
-            cur.execute('''
+            cur.execute(f'''
                 UPDATE tasks 
                 SET completed = TRUE,
                     completed_at = CURRENT_TIMESTAMP,
-                    archived = TRUE
+                    archived = TRUE,
+                    {_TOUCH}
                 WHERE id = %s
-                RETURNING id
+                RETURNING id, user_id
             ''', (task_id,))
         elif status == 'in_progress':
-            cur.execute('''
+            cur.execute(f'''
                 UPDATE tasks 
                 SET completed = FALSE,
-                    archived = FALSE
+                    archived = FALSE,
+                    {_TOUCH}
                 WHERE id = %s
-                RETURNING id
+                RETURNING id, user_id
             ''', (task_id,))
         elif status == 'archived':
-            cur.execute('''
+            cur.execute(f'''
                 UPDATE tasks 
-                SET archived = TRUE
+                SET archived = TRUE,
+                    {_TOUCH}
                 WHERE id = %s
-                RETURNING id
+                RETURNING id, user_id
             ''', (task_id,))
         
         result = cur.fetchone()
         conn.commit()
+        if result is not None:
+            _notify_changed([result['user_id']])
         
         logger.info(f"✅ Статус задачи {task_id} обновлен на {status}")
         return result is not None
@@ -288,16 +953,10 @@ def get_pending_notifications():
         cur = conn.cursor()
         
         # Ищем уведомления, у которых remind_at наступил (в UTC)
-        # Без условия на status, так как колонка может отсутствовать
-        cur.execute('''
-            SELECT id, user_id, text, date, time, emoji, remind_at, task_type, is_reminder
+        cur.execute(f'''
+            SELECT {_NOTIFICATION_COLUMNS}
             FROM tasks 
-            WHERE remind_at IS NOT NULL
-            AND remind_at <= NOW() AT TIME ZONE 'UTC'
-            AND deleted = FALSE
-            AND completed = FALSE
-            AND archived = FALSE
-            AND (is_reminder = TRUE OR task_type = 'task')
+            WHERE {_DUE_NOTIFICATIONS_WHERE}
             ORDER BY remind_at
         ''')
         
@@ -311,32 +970,235 @@ def get_pending_notifications():
         if conn:
             conn.close()
 
-def archive_overdue_tasks():
-    """Архивирует просроченные задачи"""
+def count_due_notifications():
+    """Число наступивших, но еще не отправленных уведомлений; None при ошибке"""
     conn = None
     try:
         conn = get_connection()
         cur = conn.cursor()
 
+        cur.execute(f'''
+            SELECT COUNT(*) AS due
+            FROM tasks
+            WHERE {_DUE_NOTIFICATIONS_WHERE}
+        ''')
+        return cur.fetchone()['due']
+    except Exception as e:
+        logger.error(f"❌ Ошибка подсчета уведомлений: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def claim_pending_notifications(limit=100, lease_seconds=300):
+    """Атомарно забирает пачку наступивших уведомлений в работу.
+
+    Строки блокируются через FOR UPDATE SKIP LOCKED, поэтому несколько
+    воркеров (и реплик) разбирают очередь параллельно без дублей. Взятые
+    уведомления арендуются на lease_seconds: если воркер упадет до
+    mark_notification_sent, после истечения аренды их заберет другой.
+    """
+    conn = None
+    try:
+        conn = get_connection()
+        cur = conn.cursor()
+
+        cur.execute(f'''
+            WITH due AS (
+                SELECT id
+                FROM tasks
+                WHERE {_DUE_NOTIFICATIONS_WHERE}
+                AND (claimed_until IS NULL OR claimed_until <= NOW() AT TIME ZONE 'UTC')
+                ORDER BY remind_at
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE tasks t
+            SET claimed_until = NOW() AT TIME ZONE 'UTC' + %s * INTERVAL '1 second'
+            FROM due
+            WHERE t.id = due.id
+            RETURNING {', '.join('t.' + c for c in _NOTIFICATION_COLUMNS.split(', '))}, {_BLOCKED_COLUMN}
+        ''', (limit, lease_seconds))
+
+        tasks = cur.fetchall()
+        conn.commit()
+        if tasks:
+            logger.info(f"🔔 Взято в отправку уведомлений: {len(tasks)}")
+        return tasks
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения уведомлений: {e}")
+        if conn:
+            conn.rollback()
+        return []
+    finally:
+        if conn:
+            conn.close()
+
+def claim_notifications(task_ids, lease_seconds=300):
+    """Забирает в работу наступившие уведомления из списка; уже взятые пропускаются"""
+    if not task_ids:
+        return []
+    conn = None
+    try:
+        conn = get_connection()
+        cur = conn.cursor()
+
+        cur.execute(f'''
+            WITH due AS (
+                SELECT id
+                FROM tasks
+                WHERE id = ANY(%s)
+                AND {_DUE_NOTIFICATIONS_WHERE}
+                AND (claimed_until IS NULL OR claimed_until <= NOW() AT TIME ZONE 'UTC')
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE tasks t
+            SET claimed_until = NOW() AT TIME ZONE 'UTC' + %s * INTERVAL '1 second'
+            FROM due
+            WHERE t.id = due.id
+            RETURNING {', '.join('t.' + c for c in _NOTIFICATION_COLUMNS.split(', '))}, {_BLOCKED_COLUMN}
+        ''', (list(task_ids), lease_seconds))
+
+        tasks = cur.fetchall()
+        conn.commit()
+        return tasks
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения уведомлений {task_ids}: {e}")
+        if conn:
+            conn.rollback()
+        return []
+    finally:
+        if conn:
+            conn.close()
+
+def get_upcoming_notifications(until, limit=10000):
+    """Ближайшие неотправленные уведомления со сроком до until (UTC).
+
+    Возвращает только id и момент срабатывания due_at: для повторной
+    попытки или истекающей аренды это claimed_until, иначе remind_at.
+    """
+    conn = None
+    try:
+        conn = get_connection()
+        cur = conn.cursor()
+
+        cur.execute(f'''
+            SELECT id, GREATEST(remind_at, COALESCE(claimed_until, remind_at)) AS due_at
+            FROM tasks
+            WHERE {_NOTIFIABLE_WHERE}
+            AND remind_at <= %(until)s
+            AND (claimed_until IS NULL OR claimed_until <= %(until)s)
+            ORDER BY remind_at
+            LIMIT %(limit)s
+        ''', {'until': until, 'limit': limit})
+
+        return cur.fetchall()
+    except Exception as e:
+        logger.error(f"❌ Ошибка загрузки ближайших уведомлений: {e}")
+        return []
+    finally:
+        if conn:
+            conn.close()
+
+def mark_notification_sent(task_id, archive=False):
+    """Отмечает уведомление отправленным (и архивирует напоминание)"""
+    conn = None
+    try:
+        conn = get_connection()
+        cur = conn.cursor()
+
+        # updated_at меняется, только если задача действительно уходит в архив:
+        # reminder_sent/claimed_until клиенту не видны
         cur.execute('''
-            UPDATE tasks 
-            SET archived = TRUE
-            WHERE date < CURRENT_DATE 
-            AND completed = FALSE 
-            AND deleted = FALSE 
-            AND is_reminder = FALSE
-            AND archived = FALSE
+            UPDATE tasks
+            SET reminder_sent = TRUE,
+                claimed_until = NULL,
+                updated_at = CASE WHEN %(archive)s AND NOT archived
+                    THEN clock_timestamp() AT TIME ZONE 'UTC' ELSE updated_at END,
+                archived = archived OR %(archive)s
+            WHERE id = %(task_id)s
+            RETURNING id, user_id
+        ''', {'archive': archive, 'task_id': task_id})
+
+        result = cur.fetchone()
+        conn.commit()
+        if result is not None and archive:
+            _notify_changed([result['user_id']])
+        return result is not None
+    except Exception as e:
+        logger.error(f"❌ Ошибка отметки уведомления {task_id}: {e}")
+        if conn:
+            conn.rollback()
+        return False
+    finally:
+        if conn:
+            conn.close()
+
+def release_notification(task_id, retry_in_seconds=0, error=None):
+    """Возвращает неотправленное уведомление в очередь через retry_in_seconds.
+
+    С error попытка считается неудачной: растет send_attempts, а текст
+    ошибки сохраняется в last_send_error.
+    """
+    conn = None
+    try:
+        conn = get_connection()
+        cur = conn.cursor()
+
+        cur.execute('''
+            UPDATE tasks
+            SET claimed_until = NOW() AT TIME ZONE 'UTC' + %(delay)s * INTERVAL '1 second',
+                send_attempts = send_attempts + (%(error)s IS NOT NULL)::int,
+                last_send_error = COALESCE(%(error)s, last_send_error)
+            WHERE id = %(task_id)s
+            AND reminder_sent = FALSE
             RETURNING id
-        ''')
-        
-        archived_tasks = cur.fetchall()
-        archived_count = len(archived_tasks)
-        
+        ''', {'delay': retry_in_seconds, 'error': error, 'task_id': task_id})
+
+        result = cur.fetchone()
         conn.commit()
-        logger.info(f"📦 Заархивировано {archived_count} просроченных задач")
-        return archived_count
+        return result is not None
     except Exception as e:
-        logger.error(f"❌ Ошибка архивации просроченных задач: {e}")
+        logger.error(f"❌ Ошибка возврата уведомления {task_id}: {e}")
+        if conn:
+            conn.rollback()
+        return False
+    finally:
+        if conn:
+            conn.close()
+
+# Уведомления уходят в notification_dead_letters и больше не отправляются.
+# reminder_sent/claimed_until клиенту не видны, поэтому updated_at не меняется
+_DEAD_LETTER_SQL = '''
+    WITH dead AS (
+        UPDATE tasks t
+        SET reminder_sent = TRUE,
+            claimed_until = NULL,
+            last_send_error = %(error)s
+        WHERE reminder_sent = FALSE
+        AND ({target})
+        RETURNING t.id, t.user_id, t.send_attempts
+    )
+    INSERT INTO notification_dead_letters (task_id, user_id, attempts, error)
+    SELECT id, user_id, send_attempts, %(error)s FROM dead
+'''
+
+def dead_letter_notifications(task_ids, error):
+    """Переносит уведомления в dead-letter (попытки исчерпаны); возвращает их число"""
+    if not task_ids:
+        return 0
+    conn = None
+    try:
+        conn = get_connection()
+        cur = conn.cursor()
+
+        cur.execute(_DEAD_LETTER_SQL.format(target='t.id = ANY(%(task_ids)s)'),
+                    {'task_ids': list(task_ids), 'error': error})
+        count = cur.rowcount
+        conn.commit()
+        return count
+    except Exception as e:
+        logger.error(f"❌ Ошибка переноса уведомлений {task_ids} в dead-letter: {e}")
         if conn:
             conn.rollback()
         return 0
@@ -344,29 +1206,308 @@ def archive_overdue_tasks():
         if conn:
             conn.close()
 
-def cleanup_old_reminders():
-    """Очищает старые отправленные напоминания (старше 7 дней)."""
+def block_chat(user_id, reason):
+    """Отмечает чат недоступным и одним запросом переносит в dead-letter все его
+    неотправленные уведомления; возвращает их число или None при ошибке"""
     conn = None
     try:
         conn = get_connection()
         cur = conn.cursor()
-        
+
         cur.execute('''
-            DELETE FROM tasks 
-            WHERE is_reminder = TRUE
-            AND archived = TRUE
-            AND remind_at < NOW() - INTERVAL '7 days'
-        ''')
-        
-        affected_rows = cur.rowcount
+            INSERT INTO blocked_chats (user_id, reason)
+            VALUES (%s, %s)
+            ON CONFLICT (user_id) DO UPDATE SET reason = EXCLUDED.reason
+        ''', (user_id, reason))
+        cur.execute(_DEAD_LETTER_SQL.format(target=f't.user_id = %(user_id)s AND {_NOTIFIABLE_WHERE}'),
+                    {'user_id': user_id, 'error': reason})
+        count = cur.rowcount
         conn.commit()
-        logger.info(f"🧹 Удалено {affected_rows} старых напоминаний")
-        return affected_rows
+        logger.info(f"🚫 Чат {user_id} недоступен ({reason}), уведомлений в dead-letter: {count}")
+        return count
     except Exception as e:
-        logger.error(f"❌ Ошибка очистки старых напоминаний: {e}")
+        logger.error(f"❌ Ошибка блокировки чата {user_id}: {e}")
         if conn:
             conn.rollback()
-        return 0
+        return None
     finally:
         if conn:
             conn.close()
+
+def unblock_chat(user_id):
+    """Снимает отметку недоступности (пользователь снова написал боту)"""
+    conn = None
+    try:
+        conn = get_connection()
+        cur = conn.cursor()
+
+        cur.execute('DELETE FROM blocked_chats WHERE user_id = %s', (user_id,))
+        removed = cur.rowcount > 0
+        conn.commit()
+        return removed
+    except Exception as e:
+        logger.error(f"❌ Ошибка разблокировки чата {user_id}: {e}")
+        if conn:
+            conn.rollback()
+        return False
+    finally:
+        if conn:
+            conn.close()
+
+# ---------- Хранилище FSM (см. fsm_storage.py) ----------
+# Ключ - (bot_id, chat_id, user_id, thread_id, business_connection_id, destiny)
+
+_FSM_KEY = 'bot_id, chat_id, user_id, thread_id, business_connection_id, destiny'
+_FSM_KEY_WHERE = '''bot_id = %s AND chat_id = %s AND user_id = %s
+    AND thread_id = %s AND business_connection_id = %s AND destiny = %s'''
+
+def get_fsm_record(key):
+    """Состояние и данные FSM по ключу: {'state', 'data'}; None при ошибке"""
+    conn = None
+    try:
+        conn = get_connection()
+        cur = conn.cursor()
+
+        cur.execute(f'SELECT state, data FROM fsm_storage WHERE {_FSM_KEY_WHERE}', tuple(key))
+        row = cur.fetchone()
+        return {'state': row['state'], 'data': row['data']} if row else {'state': None, 'data': {}}
+    except Exception as e:
+        logger.error(f"❌ Ошибка чтения состояния FSM: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def _set_fsm_field(key, column, value, empty):
+    conn = None
+    try:
+        conn = get_connection()
+        cur = conn.cursor()
+
+        cur.execute(f'''
+            INSERT INTO fsm_storage ({_FSM_KEY}, {column})
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT ({_FSM_KEY}) DO UPDATE
+            SET {column} = EXCLUDED.{column},
+                updated_at = clock_timestamp() AT TIME ZONE 'UTC'
+        ''', tuple(key) + (value,))
+        if empty:
+            # Пустая запись (ни состояния, ни данных) не хранится
+            cur.execute(f'''
+                DELETE FROM fsm_storage
+                WHERE {_FSM_KEY_WHERE}
+                AND state IS NULL AND data = '{{}}'::jsonb
+            ''', tuple(key))
+        conn.commit()
+        return True
+    except Exception as e:
+        logger.error(f"❌ Ошибка записи {column} FSM: {e}")
+        if conn:
+            conn.rollback()
+        return False
+    finally:
+        if conn:
+            conn.close()
+
+def set_fsm_state(key, state):
+    """Upsert состояния FSM; True при успехе"""
+    return _set_fsm_field(key, 'state', state, empty=state is None)
+
+def set_fsm_data(key, data):
+    """Upsert данных FSM (JSON-совместимый dict); True при успехе"""
+    return _set_fsm_field(key, 'data', Json(data), empty=not data)
+
+# ---------- Обслуживание пачками (см. maintenance.py) ----------
+# Условия совпадают с частичными индексами миграции 10
+
+_OVERDUE_WHERE = '''
+    date < CURRENT_DATE
+    AND completed = FALSE
+    AND deleted = FALSE
+    AND is_reminder = FALSE
+    AND archived = FALSE
+'''
+
+_OLD_REMINDERS_WHERE = '''
+    is_reminder = TRUE
+    AND archived = TRUE
+    AND remind_at < NOW() - INTERVAL '7 days'
+'''
+
+def _maintenance_batch(sql, params, statement_timeout_ms, notify=True):
+    """Выполняет одну пачку обслуживания в своей транзакции.
+
+    Запрос возвращает (user_id, rows) по затронутым пользователям. Пачка
+    ограничена по времени (statement_timeout) и не ждет чужих блокировок
+    дольше lock_timeout; строки, занятые другими транзакциями, пропускаются
+    (SKIP LOCKED) и достанутся следующему запуску. Возвращает (число строк,
+    список user_id); ошибки пробрасываются.
+    """
+    conn = None
+    try:
+        conn = get_connection()
+        cur = conn.cursor()
+
+        cur.execute(
+            "SELECT set_config('statement_timeout', %s, TRUE), set_config('lock_timeout', %s, TRUE)",
+            (str(statement_timeout_ms), str(max(1, statement_timeout_ms // 4)))
+        )
+        cur.execute(sql, params)
+        per_user = cur.fetchall()
+        conn.commit()
+
+        user_ids = [row['user_id'] for row in per_user]
+        if notify:
+            _notify_changed(user_ids)
+        return sum(row['rows'] for row in per_user), user_ids
+    except Exception:
+        if conn:
+            conn.rollback()
+        raise
+    finally:
+        if conn:
+            conn.close()
+
+def archive_overdue_batch(limit=1000, statement_timeout_ms=5000):
+    """Архивирует до limit просроченных задач; (число задач, user_id)"""
+    return _maintenance_batch(f'''
+        WITH batch AS (
+            SELECT id
+            FROM tasks
+            WHERE {_OVERDUE_WHERE}
+            ORDER BY date
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        ), archived AS (
+            UPDATE tasks t
+            SET archived = TRUE,
+                {_TOUCH}
+            FROM batch
+            WHERE t.id = batch.id
+            RETURNING t.user_id
+        )
+        SELECT user_id, COUNT(*) AS rows
+        FROM archived
+        GROUP BY user_id
+    ''', (limit,), statement_timeout_ms)
+
+def cleanup_reminders_batch(limit=1000, statement_timeout_ms=5000):
+    """Удаляет до limit отправленных напоминаний старше 7 дней; (число, user_id).
+
+    Удаленные задачи оставляют tombstone для дельта-синхронизации.
+    """
+    return _maintenance_batch(f'''
+        WITH batch AS (
+            SELECT id
+            FROM tasks
+            WHERE {_OLD_REMINDERS_WHERE}
+            ORDER BY remind_at
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        ), removed AS (
+            DELETE FROM tasks t
+            USING batch
+            WHERE t.id = batch.id
+            RETURNING t.id, t.user_id
+        ), buried AS (
+            INSERT INTO task_tombstones (task_id, user_id)
+            SELECT id, user_id FROM removed
+            ON CONFLICT (task_id) DO NOTHING
+        )
+        SELECT user_id, COUNT(*) AS rows
+        FROM removed
+        GROUP BY user_id
+    ''', (limit,), statement_timeout_ms)
+
+def prune_tombstones_batch(limit=1000, statement_timeout_ms=5000):
+    """Удаляет до limit tombstone старше срока хранения: таким клиентам нужна полная синхронизация"""
+    return _maintenance_batch('''
+        WITH batch AS (
+            SELECT task_id
+            FROM task_tombstones
+            WHERE deleted_at < NOW() AT TIME ZONE 'UTC' - %s * INTERVAL '1 day'
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        ), pruned AS (
+            DELETE FROM task_tombstones t
+            USING batch
+            WHERE t.task_id = batch.task_id
+            RETURNING t.user_id
+        )
+        SELECT user_id, COUNT(*) AS rows
+        FROM pruned
+        GROUP BY user_id
+    ''', (TOMBSTONE_RETENTION_DAYS, limit), statement_timeout_ms, notify=False)
+
+# ---------- Метрики (см. metrics.py) ----------
+# Функции ниже ловят свои исключения и возвращают None/[]/False, поэтому
+# ошибкой вызова считается и проброшенное исключение, и logger.error
+# этого модуля, записанный во время вызова.
+
+_DB_CALL_SECONDS = metrics.REGISTRY.histogram(
+    'db_call_duration_seconds', 'Длительность вызова функции database.py', ('function',))
+_DB_CALL_ERRORS = metrics.REGISTRY.counter(
+    'db_call_errors_total', 'Вызовы функций database.py, завершившиеся ошибкой', ('function',))
+
+_POOL_GAUGES = ('size', 'idle', 'in_use', 'waiting')
+_POOL_COUNTERS = ('checkouts', 'timeouts', 'opened', 'recycled', 'failed_health_checks')
+
+metrics.REGISTRY.gauge(
+    'db_pool_connections', 'Соединения пула БД по состоянию', ('state',),
+    callback=lambda: {name: (get_pool_stats() or {}).get(name) for name in _POOL_GAUGES})
+metrics.REGISTRY.gauge(
+    'db_pool_events', 'Накопительные счетчики пула БД', ('event',),
+    callback=lambda: {name: (get_pool_stats() or {}).get(name) for name in _POOL_COUNTERS})
+
+_call_state = threading.local()
+
+class _CallErrorHandler(logging.Handler):
+    """Отмечает текущий вызов ошибочным, если он записал ошибку в лог"""
+
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+
+    def emit(self, record):
+        calls = getattr(_call_state, 'calls', None)
+        if calls:
+            calls[-1][1] = True
+
+logger.addHandler(_CallErrorHandler())
+
+def _instrumented(func):
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        calls = getattr(_call_state, 'calls', None)
+        if calls is None:
+            calls = _call_state.calls = []
+        call = [name, False]
+        calls.append(call)
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            call[1] = True
+            raise
+        finally:
+            calls.pop()
+            _DB_CALL_SECONDS.observe(time.perf_counter() - started, function=name)
+            if call[1]:
+                _DB_CALL_ERRORS.inc(function=name)
+    return wrapper
+
+# Генераторы (iter_task_batches) и служебные функции пула не оборачиваются
+_INSTRUMENTED = (
+    'init_db', 'add_task', 'add_tasks', 'get_tasks_by_user', 'get_tasks_page',
+    'get_task_version', 'get_task_changes', 'copy_tasks_csv', 'update_task',
+    'bulk_update_tasks', 'update_task_status', 'get_pending_notifications',
+    'count_due_notifications', 'claim_pending_notifications', 'claim_notifications',
+    'get_upcoming_notifications', 'mark_notification_sent', 'release_notification',
+    'dead_letter_notifications', 'block_chat', 'unblock_chat',
+    'get_fsm_record', 'set_fsm_state', 'set_fsm_data',
+    'archive_overdue_batch', 'cleanup_reminders_batch', 'prune_tombstones_batch',
+)
+
+for _name in _INSTRUMENTED:
+    globals()[_name] = _instrumented(globals()[_name])
@@ -0,0 +1,138 @@
+"""Асинхронная обертка над database.py.
+
+Синхронные функции psycopg2 выполняются в ограниченном пуле потоков,
+поэтому медленный запрос не блокирует event loop aiohttp/aiogram.
+Имена функций совпадают с database.py, но вызываются через await.
+"""
+import asyncio
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+
+def get_executor():
+    """Пул потоков для запросов к БД (по умолчанию размером с пул соединений)"""
+    global _executor
+    if _executor is None:
+        workers = database._env_int('DB_EXECUTOR_WORKERS', database._env_int('DB_POOL_MAX', 10))
+        _executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='db')
+        logger.info(f"✅ Пул потоков БД создан (workers={workers})")
+    return _executor
+
+async def run(func, *args, **kwargs):
+    """Выполняет синхронную функцию в пуле потоков БД"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+
+def _async(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run(func, *args, **kwargs)
+    return wrapper
+
+def shutdown():
+    """Останавливает пул потоков (при остановке приложения)"""
+    global _executor
+    executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=False)
+
+async def iter_task_batches(user_id, include_archived=True, batch_size=database.EXPORT_BATCH_SIZE):
+    """Асинхронный генератор пачек задач (см. database.iter_task_batches)"""
+    batches = database.iter_task_batches(user_id, include_archived, batch_size)
+    try:
+        while True:
+            tasks = await run(next, batches, None)
+            if tasks is None:
+                break
+            yield tasks
+    finally:
+        await run(batches.close)
+
+class ExportAborted(Exception):
+    """Получатель экспорта отключился, COPY прерывается"""
+
+class _ChunkWriter:
+    """Файловый объект для copy_expert: передает куски в event loop.
+
+    Семафор ограничивает число непрочитанных кусков, так что поток БД
+    ждет медленного клиента, а не копит весь экспорт в памяти.
+    """
+
+    def __init__(self, loop, queue, max_chunks):
+        self.loop = loop
+        self.queue = queue
+        self.slots = threading.Semaphore(max_chunks)
+        self.max_chunks = max_chunks
+        self.aborted = False
+
+    def write(self, data):
+        self.slots.acquire()
+        if self.aborted:
+            raise ExportAborted("получатель экспорта отключился")
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, bytes(data))
+
+    def abort(self):
+        self.aborted = True
+        for _ in range(self.max_chunks):
+            self.slots.release()
+
+async def copy_tasks_csv(user_id, include_archived=True, max_chunks=64):
+    """Асинхронный генератор кусков CSV-экспорта (COPY TO STDOUT)"""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    writer = _ChunkWriter(loop, queue, max_chunks)
+    done = object()
+
+    def produce():
+        try:
+            return database.copy_tasks_csv(user_id, writer, include_archived)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, done)
+
+    future = loop.run_in_executor(get_executor(), produce)
+    try:
+        while True:
+            chunk = await queue.get()
+            if chunk is done:
+                break
+            writer.slots.release()
+            yield chunk
+        await future
+    finally:
+        if not future.done():
+            writer.abort()
+            await asyncio.gather(future, return_exceptions=True)
+
+init_db = _async(database.init_db)
+add_task = _async(database.add_task)
+add_tasks = _async(database.add_tasks)
+get_tasks_by_user = _async(database.get_tasks_by_user)
+get_tasks_page = _async(database.get_tasks_page)
+get_task_version = _async(database.get_task_version)
+get_task_changes = _async(database.get_task_changes)
+update_task = _async(database.update_task)
+bulk_update_tasks = _async(database.bulk_update_tasks)
+update_task_status = _async(database.update_task_status)
+get_pending_notifications = _async(database.get_pending_notifications)
+count_due_notifications = _async(database.count_due_notifications)
+claim_pending_notifications = _async(database.claim_pending_notifications)
+claim_notifications = _async(database.claim_notifications)
+get_upcoming_notifications = _async(database.get_upcoming_notifications)
+mark_notification_sent = _async(database.mark_notification_sent)
+release_notification = _async(database.release_notification)
+dead_letter_notifications = _async(database.dead_letter_notifications)
+block_chat = _async(database.block_chat)
+unblock_chat = _async(database.unblock_chat)
+get_fsm_record = _async(database.get_fsm_record)
+set_fsm_state = _async(database.set_fsm_state)
+set_fsm_data = _async(database.set_fsm_data)
+archive_overdue_batch = _async(database.archive_overdue_batch)
+cleanup_reminders_batch = _async(database.cleanup_reminders_batch)
+prune_tombstones_batch = _async(database.prune_tombstones_batch)
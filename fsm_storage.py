@@ -0,0 +1,122 @@
+"""Хранилище FSM aiogram в Postgres.
+
+Состояние и данные диалога лежат в таблице fsm_storage (миграция 13),
+поэтому переживают перезапуск и видны всем репликам за webhook. Запись
+идет upsert-ом в БД и сразу в локальный кэш (write-through), так что
+чтение только что записанного состояния - обычный путь обработчика -
+обходится без запроса к БД. Запись в кэше живет FSM_CACHE_TTL секунд:
+если следующее обновление чата обработает другая реплика, эта увидит
+его изменения не позже чем через TTL.
+"""
+import copy
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage
+
+import database_async
+
+logger = logging.getLogger(__name__)
+
+def _key(key):
+    """StorageKey -> ключ строки fsm_storage"""
+    return (
+        key.bot_id,
+        key.chat_id,
+        key.user_id,
+        key.thread_id or 0,
+        key.business_connection_id or '',
+        key.destiny,
+    )
+
+class PostgresStorage(BaseStorage):
+    """BaseStorage aiogram поверх fsm_storage с локальным LRU+TTL кэшем"""
+
+    def __init__(self, cache_ttl=5, cache_size=10000):
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self._cache = OrderedDict()      # ключ -> (state, data, expires_at)
+
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            cache_ttl=float(os.getenv('FSM_CACHE_TTL', 5)),
+            cache_size=int(os.getenv('FSM_CACHE_SIZE', 10000)),
+        )
+
+    # ---------- кэш ----------
+    def _cached(self, key):
+        entry = self._cache.get(key)
+        if entry is None or entry[2] <= time.monotonic():
+            return None
+        self._cache.move_to_end(key)
+        return entry
+
+    def _remember(self, key, state, data):
+        if self.cache_ttl <= 0:
+            return
+        self._cache[key] = (state, data, time.monotonic() + self.cache_ttl)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _load(self, key):
+        entry = self._cached(key)
+        if entry is not None:
+            self.hits += 1
+            return entry[0], entry[1]
+        self.misses += 1
+        record = await database_async.get_fsm_record(key)
+        if record is None:
+            # Ошибка БД: ведем себя как пустое состояние и ничего не кэшируем
+            return None, {}
+        self._remember(key, record['state'], record['data'])
+        return record['state'], record['data']
+
+    # ---------- BaseStorage ----------
+    # Запись обновляет кэш, только если вторая половина записи (данные или
+    # состояние) уже в нем: иначе следующее чтение все равно пойдет в БД
+    async def set_state(self, key, state=None):
+        key = _key(key)
+        state = state.state if isinstance(state, State) else state
+        if await database_async.set_fsm_state(key, state):
+            entry = self._cached(key)
+            if entry is not None:
+                self._remember(key, state, entry[1])
+        else:
+            self._cache.pop(key, None)
+
+    async def get_state(self, key):
+        state, _ = await self._load(_key(key))
+        return state
+
+    async def set_data(self, key, data):
+        key = _key(key)
+        data = copy.deepcopy(dict(data))
+        if await database_async.set_fsm_data(key, data):
+            entry = self._cached(key)
+            if entry is not None:
+                self._remember(key, entry[0], data)
+        else:
+            self._cache.pop(key, None)
+
+    async def get_data(self, key):
+        _, data = await self._load(_key(key))
+        # Копия: обработчик может менять словарь, не затрагивая кэш
+        return copy.deepcopy(data)
+
+    async def close(self):
+        self._cache.clear()
+
+    def stats(self):
+        return {
+            'cached': len(self._cache),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -0,0 +1,148 @@
+"""Фоновое обслуживание таблицы задач пачками.
+
+Архивация просроченных задач и очистка старых напоминаний выполняются не
+одним UPDATE/DELETE по всей таблице, а пачками по batch_size строк, каждая
+в своей короткой транзакции. Размер пачки подстраивается под бюджет
+времени (MAINTENANCE_BUDGET_MS): медленная пачка уменьшает следующую,
+быстрая - увеличивает. Между пачками делается пауза, чтобы не забивать
+диск и WAL, а весь запуск ограничен MAINTENANCE_MAX_RUN секундами -
+остаток доделает следующий запуск. Запросы идут через пул потоков БД,
+event loop не блокируется.
+"""
+import asyncio
+import logging
+import time
+
+import database
+import database_async
+
+logger = logging.getLogger(__name__)
+
+class MaintenanceJob:
+    """Задача обслуживания: функция пачки и ее метрики"""
+
+    def __init__(self, name, batch, batch_size):
+        self.name = name
+        self.batch = batch                # async batch(limit, statement_timeout_ms)
+        self.batch_size = batch_size
+        self.running = False
+
+        self.runs = 0
+        self.errors = 0
+        self.total_rows = 0
+        self.last_rows = 0
+        self.last_batches = 0
+        self.last_started_at = None
+        self.last_duration_s = 0.0
+        self.last_batch_ms = 0.0
+        self.max_batch_ms = 0.0
+        self.last_error = None
+
+    def stats(self):
+        return {
+            'running': self.running,
+            'runs': self.runs,
+            'errors': self.errors,
+            'total_rows': self.total_rows,
+            'last_rows': self.last_rows,
+            'last_batches': self.last_batches,
+            'last_started_at': self.last_started_at,
+            'last_duration_s': round(self.last_duration_s, 3),
+            'batch_size': self.batch_size,
+            'last_batch_ms': round(self.last_batch_ms, 1),
+            'max_batch_ms': round(self.max_batch_ms, 1),
+            'last_error': self.last_error,
+        }
+
+class MaintenanceEngine:
+    """Выполняет задачи обслуживания пачками с бюджетом времени"""
+
+    def __init__(self, batch_size=1000, min_batch=100, max_batch=10000,
+                 budget_ms=500, pause_ms=200, max_run=300):
+        self.min_batch = min_batch
+        self.max_batch = max(max_batch, min_batch)
+        self.budget_ms = budget_ms
+        self.pause = pause_ms / 1000
+        self.max_run = max_run
+        batch_size = min(max(batch_size, min_batch), self.max_batch)
+
+        self.jobs = {
+            job.name: job for job in (
+                MaintenanceJob('archive_overdue', database_async.archive_overdue_batch, batch_size),
+                MaintenanceJob('cleanup_reminders', database_async.cleanup_reminders_batch, batch_size),
+                MaintenanceJob('prune_tombstones', database_async.prune_tombstones_batch, batch_size),
+            )
+        }
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            batch_size=database._env_int('MAINTENANCE_BATCH', 1000),
+            budget_ms=database._env_int('MAINTENANCE_BUDGET_MS', 500),
+            pause_ms=database._env_int('MAINTENANCE_PAUSE_MS', 200),
+            max_run=database._env_int('MAINTENANCE_MAX_RUN', 300),
+        )
+
+    def _resize(self, job, elapsed_ms):
+        if elapsed_ms > self.budget_ms:
+            job.batch_size = max(self.min_batch, job.batch_size // 2)
+        elif elapsed_ms < self.budget_ms / 2:
+            job.batch_size = min(self.max_batch, job.batch_size * 2)
+
+    async def run(self, name):
+        """Один запуск задачи: пачки до опустошения очереди или конца max_run"""
+        job = self.jobs[name]
+        if job.running:
+            logger.warning(f"⚠️ Обслуживание {name} еще выполняется, запуск пропущен")
+            return 0
+        job.running = True
+        job.runs += 1
+        job.last_started_at = time.time()
+        started = time.monotonic()
+        rows = batches = 0
+        # Пачка не должна держать блокировки дольше нескольких бюджетов
+        statement_timeout_ms = max(1000, self.budget_ms * 10)
+        try:
+            while time.monotonic() - started < self.max_run:
+                limit = job.batch_size
+                batch_started = time.monotonic()
+                try:
+                    count, _ = await job.batch(limit, statement_timeout_ms)
+                except Exception as e:
+                    job.errors += 1
+                    job.last_error = str(e).strip()
+                    logger.error(f"❌ Ошибка пачки обслуживания {name}: {job.last_error}")
+                    # Уперлись в таймаут или блокировку: следующая пачка меньше
+                    job.batch_size = max(self.min_batch, job.batch_size // 2)
+                    break
+                elapsed_ms = (time.monotonic() - batch_started) * 1000
+                job.last_batch_ms = elapsed_ms
+                job.max_batch_ms = max(job.max_batch_ms, elapsed_ms)
+                rows += count
+                batches += 1
+                self._resize(job, elapsed_ms)
+                if count < limit:
+                    break
+                await asyncio.sleep(self.pause)
+        finally:
+            job.running = False
+            job.total_rows += rows
+            job.last_rows = rows
+            job.last_batches = batches
+            job.last_duration_s = time.monotonic() - started
+
+        logger.info(f"🧹 Обслуживание {name}: {rows} строк за {batches} пачек, {job.last_duration_s:.1f} с")
+        return rows
+
+    async def archive_overdue(self):
+        return await self.run('archive_overdue')
+
+    async def cleanup(self):
+        """Очистка старых напоминаний, затем устаревших tombstone"""
+        removed = await self.run('cleanup_reminders')
+        await self.run('prune_tombstones')
+        return removed
+
+    def stats(self):
+        """Метрики последних запусков по задачам"""
+        return {name: job.stats() for name, job in self.jobs.items()}
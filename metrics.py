@@ -0,0 +1,182 @@
+"""Метрики приложения в текстовом формате Prometheus.
+
+Небольшой реестр без внешних зависимостей: счетчики, гистограммы и
+gauge с метками. Значения обновляются из event loop и из потоков пула
+БД, поэтому каждая метрика защищена своей блокировкой. Gauge может
+вычисляться при каждом чтении (callback) - так экспортируются счетчики,
+которые компоненты уже ведут в своих stats().
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Границы гистограмм задержек по умолчанию, секунды
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Опоздание срабатывания напоминаний: от долей секунды до часов
+LAG_BUCKETS = (0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0, 3600.0)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: ожидались метки {self.labelnames}, получены {tuple(labels)}")
+        return tuple(labels[name] for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self._samples())
+        return lines
+
+class Counter(_Metric):
+    """Монотонно растущий счетчик"""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+
+class Gauge(_Metric):
+    """Текущее значение; callback() -> {значения меток: число} вычисляется при чтении"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+        self._values = {}
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _samples(self):
+        if self.callback is not None:
+            values = self.callback()
+            if not isinstance(values, dict):
+                values = {(): values}
+        else:
+            with self._lock:
+                values = dict(self._values)
+        for key, value in sorted(values.items()):
+            if value is None:
+                continue
+            key = key if isinstance(key, tuple) else (key,)
+            yield f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+
+class Histogram(_Metric):
+    """Распределение значений по кумулятивным корзинам, плюс сумма и число"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}    # метки -> [счетчики корзин..., +Inf], сумма
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Замеряет длительность блока with"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self):
+        with self._lock:
+            series = sorted((key, (list(counts), total)) for key, (counts, total) in self._series.items())
+        for key, (counts, total) in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(float(bound)))])
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _format_labels(self.labelnames, key)
+            yield f'{self.name}_sum{labels} {_format_value(total)}'
+            yield f'{self.name}_count{labels} {cumulative}'
+
+class Registry:
+    """Набор метрик, отдаваемых одним ответом /metrics"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                    raise ValueError(f"Метрика {metric.name} уже зарегистрирована с другим типом или метками")
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), callback=None):
+        return self._register(Gauge(name, documentation, labelnames, callback))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        """Все метрики в текстовом формате экспозиции Prometheus 0.0.4"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
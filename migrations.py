@@ -0,0 +1,448 @@
+"""Версионные миграции схемы БД.
+
+Каждая миграция - упорядоченный набор SQL-команд с номером версии.
+Примененные версии записываются в schema_migrations, поэтому при обычном
+старте выполняется один запрос (чтение текущей версии), а DDL - только
+когда появились новые миграции.
+
+Миграции с concurrent=True выполняются вне транзакции: индексы строятся
+через CREATE INDEX CONCURRENTLY и не блокируют запись в таблицу.
+SQL в миграциях намеренно записан литералами: уже примененная миграция
+не должна меняться вместе с кодом запросов.
+"""
+import logging
+from collections import namedtuple
+
+import psycopg2
+from psycopg2 import errors
+
+import database
+
+logger = logging.getLogger(__name__)
+
+Migration = namedtuple('Migration', 'version name statements concurrent')
+
+# Ключ advisory-блокировки, чтобы реплики не применяли миграции одновременно
+_LOCK_KEY = 7_231_001
+
+MIGRATIONS = [
+    Migration(1, 'create tasks', [
+        '''
+        CREATE TABLE IF NOT EXISTS tasks (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            text TEXT NOT NULL,
+            category TEXT DEFAULT 'personal',
+            priority TEXT DEFAULT 'medium',
+            date DATE,
+            time TIME,
+            reminder INTEGER DEFAULT 0,
+            emoji TEXT DEFAULT '📝',
+            completed BOOLEAN DEFAULT FALSE,
+            deleted BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            completed_at TIMESTAMP,
+            deleted_at TIMESTAMP,
+            remind_at TIMESTAMP,
+            reminder_sent BOOLEAN DEFAULT FALSE,
+            is_reminder BOOLEAN DEFAULT FALSE,
+            archived BOOLEAN DEFAULT FALSE,
+            task_type TEXT DEFAULT 'task'
+        )
+        ''',
+    ], False),
+    Migration(2, 'status column', [
+        "ALTER TABLE tasks ADD COLUMN IF NOT EXISTS status TEXT DEFAULT 'active'",
+    ], False),
+    Migration(3, 'notification lease', [
+        'ALTER TABLE tasks ADD COLUMN IF NOT EXISTS claimed_until TIMESTAMP',
+    ], False),
+    Migration(4, 'base indexes', [
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_tasks_remind_at ON tasks (remind_at)',
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_tasks_status ON tasks (status)',
+    ], True),
+    Migration(5, 'hot query indexes', [
+        '''
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_tasks_due_notifications
+        ON tasks (remind_at)
+        WHERE remind_at IS NOT NULL
+        AND reminder_sent = FALSE
+        AND deleted = FALSE
+        AND completed = FALSE
+        AND archived = FALSE
+        AND (is_reminder = TRUE OR task_type = 'task')
+        ''',
+        '''
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_tasks_user_active_order
+        ON tasks (user_id, (COALESCE(date, 'infinity'::date)), (COALESCE(time, '24:00'::time)), id)
+        WHERE deleted = FALSE AND archived = FALSE
+        ''',
+        '''
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_tasks_user_order
+        ON tasks (user_id, (COALESCE(date, 'infinity'::date)), (COALESCE(time, '24:00'::time)), id)
+        WHERE deleted = FALSE
+        ''',
+        'DROP INDEX CONCURRENTLY IF EXISTS idx_tasks_user_id',
+    ], True),
+    Migration(6, 'task set versions', [
+        '''
+        CREATE TABLE IF NOT EXISTS task_versions (
+            user_id BIGINT PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 0
+        )
+        ''',
+        # Счетчик изменений задач пользователя. Пользователи обрабатываются по
+        # возрастанию user_id, чтобы массовые UPDATE не ловили взаимоблокировки.
+        '''
+        CREATE OR REPLACE FUNCTION bump_task_versions() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            INSERT INTO task_versions AS v (user_id, version)
+            SELECT user_id, 1
+            FROM (SELECT DISTINCT user_id FROM changed_rows) AS changed
+            ORDER BY user_id
+            ON CONFLICT (user_id) DO UPDATE SET version = v.version + 1;
+            RETURN NULL;
+        END
+        $$
+        ''',
+        '''
+        CREATE TRIGGER tasks_version_insert AFTER INSERT ON tasks
+        REFERENCING NEW TABLE AS changed_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_task_versions()
+        ''',
+        '''
+        CREATE TRIGGER tasks_version_update AFTER UPDATE ON tasks
+        REFERENCING NEW TABLE AS changed_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_task_versions()
+        ''',
+        '''
+        CREATE TRIGGER tasks_version_delete AFTER DELETE ON tasks
+        REFERENCING OLD TABLE AS changed_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_task_versions()
+        ''',
+    ], False),
+    Migration(7, 'change tracking', [
+        'ALTER TABLE tasks ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP',
+        '''
+        UPDATE tasks
+        SET updated_at = COALESCE(deleted_at, completed_at, created_at, NOW() AT TIME ZONE 'UTC')
+        WHERE updated_at IS NULL
+        ''',
+        "ALTER TABLE tasks ALTER COLUMN updated_at SET DEFAULT (clock_timestamp() AT TIME ZONE 'UTC')",
+        'ALTER TABLE tasks ALTER COLUMN updated_at SET NOT NULL',
+        # Физически удаленные задачи, чтобы клиенты узнали об удалении из дельты
+        '''
+        CREATE TABLE IF NOT EXISTS task_tombstones (
+            task_id BIGINT PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            deleted_at TIMESTAMP NOT NULL DEFAULT (clock_timestamp() AT TIME ZONE 'UTC')
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_task_tombstones_user_deleted
+        ON task_tombstones (user_id, deleted_at, task_id)
+        ''',
+    ], False),
+    Migration(8, 'change tracking index', [
+        '''
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_tasks_user_updated
+        ON tasks (user_id, updated_at, id)
+        ''',
+    ], True),
+    Migration(9, 'task change notifications', [
+        # Общая часть триггеров: версии пользователей и NOTIFY для push-канала.
+        # Payload NOTIFY ограничен 8000 байт, поэтому id идут пачками по 500
+        '''
+        CREATE OR REPLACE FUNCTION record_task_changes(changed BIGINT[]) RETURNS void
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            IF changed IS NULL THEN
+                RETURN;
+            END IF;
+            INSERT INTO task_versions AS v (user_id, version)
+            SELECT user_id, 1
+            FROM unnest(changed) AS user_id
+            ORDER BY user_id
+            ON CONFLICT (user_id) DO UPDATE SET version = v.version + 1;
+            PERFORM pg_notify('task_changes', string_agg(user_id::text, ','))
+            FROM (
+                SELECT user_id, (row_number() OVER (ORDER BY user_id) - 1) / 500 AS chunk
+                FROM unnest(changed) AS user_id
+            ) AS numbered
+            GROUP BY chunk;
+        END
+        $$
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION bump_task_versions() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            PERFORM record_task_changes((SELECT array_agg(DISTINCT user_id) FROM changed_rows));
+            RETURN NULL;
+        END
+        $$
+        ''',
+        # UPDATE учитывается, только если изменились видимые клиенту данные:
+        # все такие пути обновляют updated_at, а служебные (захват и возврат
+        # уведомлений) - нет
+        '''
+        CREATE OR REPLACE FUNCTION bump_task_versions_on_update() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            PERFORM record_task_changes((
+                SELECT array_agg(DISTINCT n.user_id)
+                FROM changed_rows n
+                JOIN previous_rows o ON o.id = n.id
+                WHERE n.updated_at IS DISTINCT FROM o.updated_at
+            ));
+            RETURN NULL;
+        END
+        $$
+        ''',
+        'DROP TRIGGER IF EXISTS tasks_version_update ON tasks',
+        '''
+        CREATE TRIGGER tasks_version_update AFTER UPDATE ON tasks
+        REFERENCING OLD TABLE AS previous_rows NEW TABLE AS changed_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_task_versions_on_update()
+        ''',
+    ], False),
+    Migration(10, 'maintenance indexes', [
+        # Пачки обслуживания (database.archive_overdue_batch и
+        # cleanup_reminders_batch) находят строки по индексу, а не сканом таблицы
+        '''
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_tasks_overdue
+        ON tasks (date)
+        WHERE completed = FALSE AND deleted = FALSE AND is_reminder = FALSE AND archived = FALSE
+        ''',
+        '''
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_tasks_sent_reminders
+        ON tasks (remind_at)
+        WHERE is_reminder = TRUE AND archived = TRUE
+        ''',
+        '''
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_task_tombstones_deleted
+        ON task_tombstones (deleted_at)
+        ''',
+    ], True),
+    # Горячие и холодные задачи в разных секциях: tasks_active (не в архиве и
+    # не удалены) и tasks_archive (остальные). Запросы по-прежнему идут к tasks,
+    # условия archived = FALSE AND deleted = FALSE отсекают архивную секцию, а
+    # UPDATE при выполнении/архивации сам переносит строку между секциями.
+    # Таблица пересоздается целиком под эксклюзивной блокировкой; индексы
+    # секционированной таблицы нельзя строить CONCURRENTLY, поэтому они
+    # строятся здесь же, одним проходом после копирования данных.
+    Migration(11, 'hot/cold partitions', [
+        'LOCK TABLE tasks IN ACCESS EXCLUSIVE MODE',
+        'UPDATE tasks SET archived = FALSE WHERE archived IS NULL',
+        'UPDATE tasks SET deleted = FALSE WHERE deleted IS NULL',
+        '''
+        CREATE TABLE tasks_tiered (LIKE tasks INCLUDING DEFAULTS)
+        PARTITION BY RANGE (archived, deleted)
+        ''',
+        '''
+        ALTER TABLE tasks_tiered
+            ALTER COLUMN archived SET NOT NULL,
+            ALTER COLUMN deleted SET NOT NULL,
+            ADD PRIMARY KEY (id, archived, deleted)
+        ''',
+        '''
+        CREATE TABLE tasks_active PARTITION OF tasks_tiered
+        FOR VALUES FROM (FALSE, FALSE) TO (FALSE, TRUE)
+        ''',
+        '''
+        CREATE TABLE tasks_archive PARTITION OF tasks_tiered
+        FOR VALUES FROM (FALSE, TRUE) TO (MAXVALUE, MAXVALUE)
+        ''',
+        'INSERT INTO tasks_tiered SELECT * FROM tasks',
+        'ALTER SEQUENCE tasks_id_seq OWNED BY tasks_tiered.id',
+        'DROP TABLE tasks',
+        'ALTER TABLE tasks_tiered RENAME TO tasks',
+        'ALTER INDEX tasks_tiered_pkey RENAME TO tasks_pkey',
+        'CREATE INDEX idx_tasks_remind_at ON tasks (remind_at)',
+        'CREATE INDEX idx_tasks_status ON tasks (status)',
+        '''
+        CREATE INDEX idx_tasks_due_notifications
+        ON tasks (remind_at)
+        WHERE remind_at IS NOT NULL
+        AND reminder_sent = FALSE
+        AND deleted = FALSE
+        AND completed = FALSE
+        AND archived = FALSE
+        AND (is_reminder = TRUE OR task_type = 'task')
+        ''',
+        '''
+        CREATE INDEX idx_tasks_user_active_order
+        ON tasks (user_id, (COALESCE(date, 'infinity'::date)), (COALESCE(time, '24:00'::time)), id)
+        WHERE deleted = FALSE AND archived = FALSE
+        ''',
+        '''
+        CREATE INDEX idx_tasks_user_order
+        ON tasks (user_id, (COALESCE(date, 'infinity'::date)), (COALESCE(time, '24:00'::time)), id)
+        WHERE deleted = FALSE
+        ''',
+        'CREATE INDEX idx_tasks_user_updated ON tasks (user_id, updated_at, id)',
+        '''
+        CREATE INDEX idx_tasks_overdue
+        ON tasks (date)
+        WHERE completed = FALSE AND deleted = FALSE AND is_reminder = FALSE AND archived = FALSE
+        ''',
+        '''
+        CREATE INDEX idx_tasks_sent_reminders
+        ON tasks (remind_at)
+        WHERE is_reminder = TRUE AND archived = TRUE
+        ''',
+        '''
+        CREATE TRIGGER tasks_version_insert AFTER INSERT ON tasks
+        REFERENCING NEW TABLE AS changed_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_task_versions()
+        ''',
+        '''
+        CREATE TRIGGER tasks_version_update AFTER UPDATE ON tasks
+        REFERENCING OLD TABLE AS previous_rows NEW TABLE AS changed_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_task_versions_on_update()
+        ''',
+        '''
+        CREATE TRIGGER tasks_version_delete AFTER DELETE ON tasks
+        REFERENCING OLD TABLE AS changed_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_task_versions()
+        ''',
+        'ANALYZE tasks',
+    ], False),
+    # Повторные отправки уведомлений: claimed_until служит временем следующей
+    # попытки, send_attempts - счетчиком неудач. Постоянно недоступные чаты
+    # попадают в blocked_chats, а их уведомления - в notification_dead_letters
+    Migration(12, 'notification retries', [
+        'ALTER TABLE tasks ADD COLUMN IF NOT EXISTS send_attempts INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE tasks ADD COLUMN IF NOT EXISTS last_send_error TEXT',
+        '''
+        CREATE TABLE IF NOT EXISTS notification_dead_letters (
+            id BIGSERIAL PRIMARY KEY,
+            task_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            attempts INTEGER NOT NULL,
+            error TEXT,
+            failed_at TIMESTAMP NOT NULL DEFAULT (clock_timestamp() AT TIME ZONE 'UTC')
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_notification_dead_letters_user
+        ON notification_dead_letters (user_id, failed_at)
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS blocked_chats (
+            user_id BIGINT PRIMARY KEY,
+            reason TEXT NOT NULL,
+            blocked_at TIMESTAMP NOT NULL DEFAULT (clock_timestamp() AT TIME ZONE 'UTC')
+        )
+        ''',
+    ], False),
+    # Состояния FSM aiogram общие для всех реплик (fsm_storage.py)
+    Migration(13, 'fsm storage', [
+        '''
+        CREATE TABLE IF NOT EXISTS fsm_storage (
+            bot_id BIGINT NOT NULL,
+            chat_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            thread_id BIGINT NOT NULL DEFAULT 0,
+            business_connection_id TEXT NOT NULL DEFAULT '',
+            destiny TEXT NOT NULL DEFAULT 'default',
+            state TEXT,
+            data JSONB NOT NULL DEFAULT '{}'::jsonb,
+            updated_at TIMESTAMP NOT NULL DEFAULT (clock_timestamp() AT TIME ZONE 'UTC'),
+            PRIMARY KEY (bot_id, chat_id, user_id, thread_id, business_connection_id, destiny)
+        )
+        ''',
+    ], False),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+def _current_version(cur):
+    try:
+        cur.execute('SELECT MAX(version) AS version FROM schema_migrations')
+    except errors.UndefinedTable:
+        return 0
+    return cur.fetchone()['version'] or 0
+
+def _drop_invalid_indexes(cur):
+    """Удаляет невалидные индексы, оставшиеся от прерванного CONCURRENTLY"""
+    cur.execute('''
+        SELECT c.relname
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE NOT i.indisvalid
+        AND n.nspname = current_schema()
+    ''')
+    for row in cur.fetchall():
+        logger.warning(f"⚠️ Удаляем невалидный индекс {row['relname']}")
+        cur.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{row["relname"]}"')
+
+def _apply(conn, migration):
+    cur = conn.cursor()
+    if migration.concurrent:
+        conn.autocommit = True
+        _drop_invalid_indexes(cur)
+        for statement in migration.statements:
+            cur.execute(statement)
+        cur.execute(
+            'INSERT INTO schema_migrations (version, name) VALUES (%s, %s)',
+            (migration.version, migration.name)
+        )
+    else:
+        conn.autocommit = False
+        for statement in migration.statements:
+            cur.execute(statement)
+        cur.execute(
+            'INSERT INTO schema_migrations (version, name) VALUES (%s, %s)',
+            (migration.version, migration.name)
+        )
+        conn.commit()
+
+def migrate():
+    """Применяет недостающие миграции; возвращает текущую версию схемы"""
+    conn = database.get_connection()
+    try:
+        cur = conn.cursor()
+        version = _current_version(cur)
+        conn.rollback()
+        if version >= LATEST_VERSION:
+            logger.info(f"✅ Схема БД актуальна (версия {version})")
+            return version
+
+        conn.autocommit = True
+        cur.execute('SELECT pg_advisory_lock(%s)', (_LOCK_KEY,))
+        try:
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            # Пока ждали блокировку, миграции могла применить другая реплика
+            version = _current_version(cur)
+            for migration in MIGRATIONS:
+                if migration.version <= version:
+                    continue
+                logger.info(f"🔧 Миграция {migration.version}: {migration.name}")
+                _apply(conn, migration)
+                version = migration.version
+        finally:
+            if not conn.autocommit:
+                conn.rollback()
+                conn.autocommit = True
+            cur.execute('SELECT pg_advisory_unlock(%s)', (_LOCK_KEY,))
+
+        logger.info(f"✅ Схема БД обновлена до версии {version}")
+        return version
+    except Exception as e:
+        logger.error(f"❌ Ошибка миграции БД: {e}")
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            pass
+        raise
+    finally:
+        conn.close()
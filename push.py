@@ -0,0 +1,211 @@
+"""Push-уведомления об изменении задач (Server-Sent Events).
+
+PushHub держит подписки открытых WebApp: на каждое соединение приходится
+объект с asyncio.Event и флагом, без отдельных задач и таймеров, поэтому
+тысячи простаивающих соединений почти ничего не стоят. Один общий таймер
+раз в PUSH_HEARTBEAT секунд будит всех подписчиков для heartbeat-пинга.
+
+Источник событий:
+- postgres (по умолчанию) - LISTEN task_changes; NOTIFY отправляет триггер
+  версий задач, поэтому события видят все реплики;
+- local - шина внутри процесса (database.add_change_listener), для
+  запуска одной репликой.
+"""
+import asyncio
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+import database
+
+logger = logging.getLogger(__name__)
+
+# Канал NOTIFY из триггера версий (миграция 9)
+CHANNEL = 'task_changes'
+
+class Subscription:
+    """Подписка одного соединения на изменения задач пользователя"""
+
+    __slots__ = ('user_id', 'changed', 'closed', '_event')
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.changed = False
+        self.closed = False
+        self._event = asyncio.Event()
+
+    def wake(self, changed):
+        self.changed = self.changed or changed
+        self._event.set()
+
+    async def wait(self):
+        """Ждет события; True - задачи изменились, False - heartbeat"""
+        await self._event.wait()
+        self._event.clear()
+        changed, self.changed = self.changed, False
+        return changed
+
+class PushHub:
+    """Подписки по user_id и доставка им событий об изменениях"""
+
+    def __init__(self, backend='postgres', heartbeat=25, max_connections=10000):
+        self.backend = backend
+        self.heartbeat = heartbeat
+        self.max_connections = max_connections
+
+        self._subscribers = {}     # user_id -> set(Subscription)
+        self._count = 0
+        self._loop = None
+        self._tasks = []
+        self._listen_conn = None
+        self._connected = False
+
+        self._published = 0
+        self._delivered = 0
+        self._reconnects = 0
+        self._last_event_at = None
+
+    @classmethod
+    def from_env(cls):
+        backend = os.getenv('PUSH_BACKEND', 'postgres').lower()
+        if backend not in ('postgres', 'local'):
+            logger.warning(f"⚠️ Неизвестный PUSH_BACKEND={backend}, используем postgres")
+            backend = 'postgres'
+        return cls(
+            backend=backend,
+            heartbeat=database._env_int('PUSH_HEARTBEAT', 25),
+            max_connections=database._env_int('PUSH_MAX_CONNECTIONS', 10000),
+        )
+
+    # ---------- жизненный цикл ----------
+    def start(self):
+        if self._tasks:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._tasks.append(asyncio.create_task(self._heartbeat()))
+        if self.backend == 'postgres':
+            self._tasks.append(asyncio.create_task(self._listen()))
+        else:
+            database.add_change_listener(self.publish_threadsafe)
+        logger.info(f"✅ Push-канал запущен (источник: {self.backend})")
+
+    async def stop(self):
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for subscriptions in self._subscribers.values():
+            for subscription in subscriptions:
+                subscription.closed = True
+                subscription.wake(False)
+
+    # ---------- подписки ----------
+    def full(self):
+        return self._count >= self.max_connections
+
+    @contextmanager
+    def subscribe(self, user_id):
+        subscription = Subscription(user_id)
+        self._subscribers.setdefault(user_id, set()).add(subscription)
+        self._count += 1
+        try:
+            yield subscription
+        finally:
+            self._count -= 1
+            subscriptions = self._subscribers.get(user_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscribers[user_id]
+
+    # ---------- события ----------
+    def publish(self, user_ids):
+        """Будит подписчиков указанных пользователей (вызывать из event loop)"""
+        self._published += 1
+        self._last_event_at = time.time()
+        for user_id in user_ids:
+            for subscription in self._subscribers.get(user_id, ()):
+                subscription.wake(True)
+                self._delivered += 1
+
+    def publish_threadsafe(self, user_ids):
+        """publish из потока БД (слушатель изменений database.py)"""
+        if self._loop is not None and self._subscribers:
+            self._loop.call_soon_threadsafe(self.publish, list(user_ids))
+
+    def _publish_all(self):
+        # После переподключения часть NOTIFY могла потеряться: пусть все клиенты
+        # догонят изменения через дельту
+        self.publish(list(self._subscribers))
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            for subscriptions in self._subscribers.values():
+                for subscription in subscriptions:
+                    subscription.wake(False)
+
+    # ---------- LISTEN/NOTIFY ----------
+    def _open_listener(self):
+        conn = database._connect()
+        conn.autocommit = True
+        conn.cursor().execute(f'LISTEN {CHANNEL}')
+        return conn
+
+    def _on_readable(self, conn, lost):
+        try:
+            conn.poll()
+        except Exception as e:
+            if not lost.done():
+                lost.set_exception(e)
+            return
+        user_ids = []
+        while conn.notifies:
+            payload = conn.notifies.pop(0).payload
+            user_ids.extend(int(user_id) for user_id in payload.split(',') if user_id)
+        if user_ids:
+            self.publish(user_ids)
+
+    async def _listen(self):
+        delay = 1
+        while True:
+            conn = None
+            try:
+                conn = await self._loop.run_in_executor(None, self._open_listener)
+                lost = self._loop.create_future()
+                self._loop.add_reader(conn.fileno(), self._on_readable, conn, lost)
+                if self._reconnects:
+                    self._publish_all()
+                self._connected = True
+                delay = 1
+                logger.info(f"👂 LISTEN {CHANNEL} запущен")
+                try:
+                    await lost
+                finally:
+                    self._connected = False
+                    self._loop.remove_reader(conn.fileno())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Соединение LISTEN {CHANNEL} потеряно: {e}")
+            finally:
+                if conn is not None:
+                    conn.close()
+            self._reconnects += 1
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+
+    # ---------- статистика ----------
+    def stats(self):
+        """Число соединений и доставленных событий"""
+        return {
+            'backend': self.backend,
+            'connections': self._count,
+            'users': len(self._subscribers),
+            'listening': self._connected if self.backend == 'postgres' else None,
+            'published': self._published,
+            'delivered': self._delivered,
+            'reconnects': self._reconnects,
+            'last_event_at': self._last_event_at,
+        }
@@ -0,0 +1,211 @@
+"""Профилирование запросов к БД и журнал медленных запросов.
+
+Включается переменной DB_PROFILE=1. Курсоры database.py передают сюда
+каждый выполненный запрос: текст приводится к форме без литералов
+(одна форма на запрос, независимо от значений), параметры заменяются
+описанием типа и размера, а длительность и число строк копятся в
+статистике по форме. Запрос дольше DB_SLOW_QUERY_MS попадает в журнал
+медленных запросов вместе с планом: для чтения - EXPLAIN (ANALYZE,
+BUFFERS), то есть запрос выполняется повторно, для записи - только
+план без выполнения. План снимается не чаще раза в
+DB_SLOW_EXPLAIN_INTERVAL секунд на форму.
+"""
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+
+from psycopg2 import extensions
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE = re.compile(r'\s+')
+_COMMA = re.compile(r'\s*,\s*')
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'(?<![\w$])-?\d+(?:\.\d+)?\b')
+# VALUES (?, ?), (?, ?), ... от execute_values - один кортеж на форму
+_VALUES_LIST = re.compile(r'\(([^()]*)\)(?:, \(\1\))+')
+
+_EXPLAINABLE = re.compile(r'^\s*(SELECT|WITH|INSERT|UPDATE|DELETE)\b', re.IGNORECASE)
+# Запрос только читает: его можно выполнить повторно под EXPLAIN ANALYZE
+_READ_ONLY = re.compile(r'^\s*(SELECT|WITH)\b', re.IGNORECASE)
+_WRITES = re.compile(
+    r'\b(INSERT|UPDATE|DELETE|FOR\s+UPDATE|FOR\s+SHARE|set_config|pg_advisory\w*|pg_notify|nextval)\b',
+    re.IGNORECASE)
+
+def normalize_sql(query):
+    """Форма запроса: без литералов и лишних пробелов"""
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    shape = _WHITESPACE.sub(' ', query).strip()
+    shape = _STRING.sub('?', shape)
+    shape = _NUMBER.sub('?', shape)
+    shape = _COMMA.sub(', ', shape)
+    return _VALUES_LIST.sub(r'(\1), ...', shape)
+
+def _redact_value(value):
+    if value is None or isinstance(value, bool):
+        return repr(value)
+    if isinstance(value, (str, bytes)):
+        return f'<{type(value).__name__}:{len(value)}>'
+    if isinstance(value, (list, tuple, set)):
+        return f'<{type(value).__name__}:{len(value)}>'
+    return f'<{type(value).__name__}>'
+
+def redact_params(params):
+    """Параметры без значений: тип и размер вместо данных пользователя"""
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return {key: _redact_value(value) for key, value in params.items()}
+    return [_redact_value(value) for value in params]
+
+class _QueryStats:
+    __slots__ = ('calls', 'errors', 'rows', 'total_s', 'max_s', 'slow', 'last_explained')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.rows = 0
+        self.total_s = 0.0
+        self.max_s = 0.0
+        self.slow = 0
+        self.last_explained = 0.0
+
+class QueryProfiler:
+    """Статистика по формам запросов и журнал медленных запросов"""
+
+    def __init__(self, enabled=False, slow_ms=200, explain=True, explain_interval=60,
+                 slow_log_size=100, max_shapes=1000):
+        self.enabled = enabled
+        self.slow_ms = slow_ms
+        self.explain = explain
+        self.explain_interval = explain_interval
+        self.max_shapes = max_shapes
+
+        self._lock = threading.Lock()
+        self._stats = {}                        # форма -> _QueryStats
+        self._slow_log = deque(maxlen=slow_log_size)
+        self.dropped_shapes = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            enabled=os.getenv('DB_PROFILE', '0').lower() in ('1', 'true', 'yes'),
+            slow_ms=float(os.getenv('DB_SLOW_QUERY_MS', 200)),
+            explain=os.getenv('DB_SLOW_EXPLAIN', '1').lower() in ('1', 'true', 'yes'),
+            explain_interval=float(os.getenv('DB_SLOW_EXPLAIN_INTERVAL', 60)),
+            slow_log_size=int(os.getenv('DB_SLOW_LOG_SIZE', 100)),
+        )
+
+    def record(self, conn, query, params, duration, rowcount, error=False):
+        """Учитывает выполненный запрос; медленный пишет в журнал с планом"""
+        shape = normalize_sql(query)
+        slow = not error and duration * 1000 >= self.slow_ms
+        explain_due = False
+        with self._lock:
+            stats = self._stats.get(shape)
+            if stats is None:
+                if len(self._stats) >= self.max_shapes:
+                    self.dropped_shapes += 1
+                    stats = None
+                else:
+                    stats = self._stats[shape] = _QueryStats()
+            if stats is not None:
+                stats.calls += 1
+                stats.errors += error
+                stats.rows += max(rowcount or 0, 0)
+                stats.total_s += duration
+                stats.max_s = max(stats.max_s, duration)
+                if slow:
+                    stats.slow += 1
+                    now = time.monotonic()
+                    if self.explain and now - stats.last_explained >= self.explain_interval:
+                        stats.last_explained = now
+                        explain_due = True
+        if not slow:
+            return
+
+        plan = self._explain(conn, query, params) if explain_due else None
+        entry = {
+            'at': time.time(),
+            'shape': shape,
+            'params': redact_params(params),
+            'duration_ms': round(duration * 1000, 2),
+            'rows': rowcount,
+            'plan': plan,
+        }
+        with self._lock:
+            self._slow_log.append(entry)
+        logger.warning(
+            f"🐢 Медленный запрос {entry['duration_ms']} мс, строк {rowcount}: {shape[:500]}"
+            + (f"\n{plan}" if plan else '')
+        )
+
+    def _explain(self, conn, query, params):
+        """План медленного запроса; ошибки EXPLAIN не затрагивают транзакцию вызывающего"""
+        if isinstance(query, bytes):
+            query = query.decode('utf-8', 'replace')
+        if not _EXPLAINABLE.match(query):
+            return None
+        analyze = _READ_ONLY.match(query) and not _WRITES.search(query)
+        options = 'ANALYZE, BUFFERS' if analyze else 'COSTS'
+        status = conn.get_transaction_status()
+        if status == extensions.TRANSACTION_STATUS_INERROR:
+            return None
+        in_transaction = not conn.autocommit
+        cur = conn.cursor(cursor_factory=extensions.cursor)
+        try:
+            if in_transaction:
+                cur.execute('SAVEPOINT query_profiler_explain')
+            try:
+                cur.execute(f'EXPLAIN ({options}) {query}', params)
+                plan = '\n'.join(row[0] for row in cur.fetchall())
+            except Exception as e:
+                if in_transaction:
+                    cur.execute('ROLLBACK TO SAVEPOINT query_profiler_explain')
+                plan = f'EXPLAIN не удался: {e}'
+            if in_transaction:
+                cur.execute('RELEASE SAVEPOINT query_profiler_explain')
+            return plan
+        except Exception as e:
+            logger.error(f"❌ Ошибка получения плана запроса: {e}")
+            return None
+        finally:
+            cur.close()
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self._slow_log.clear()
+            self.dropped_shapes = 0
+
+    def stats(self, limit=50, order_by='total_ms'):
+        """Самые дорогие формы запросов и последние медленные запросы"""
+        with self._lock:
+            queries = [
+                {
+                    'shape': shape,
+                    'calls': s.calls,
+                    'errors': s.errors,
+                    'rows': s.rows,
+                    'slow': s.slow,
+                    'total_ms': round(s.total_s * 1000, 2),
+                    'avg_ms': round(s.total_s * 1000 / s.calls, 3) if s.calls else 0.0,
+                    'max_ms': round(s.max_s * 1000, 2),
+                }
+                for shape, s in self._stats.items()
+            ]
+            slow_log = list(self._slow_log)
+            dropped = self.dropped_shapes
+        queries.sort(key=lambda q: q.get(order_by, 0), reverse=True)
+        return {
+            'enabled': self.enabled,
+            'slow_ms': self.slow_ms,
+            'shapes': len(queries),
+            'dropped_shapes': dropped,
+            'queries': queries[:limit],
+            'slow_log': slow_log[::-1],
+        }
@@ -0,0 +1,198 @@
+"""Движок напоминаний на основе БД.
+
+Вместо отдельной задачи APScheduler на каждое уведомление в памяти
+держится только ближайшее окно срабатываний (по умолчанию 10 минут, не
+больше REMINDER_MAX_LOADED записей) в виде кучи. Окно регулярно
+перечитывается из БД, поэтому после перезапуска ничего не теряется, а
+память не зависит от общего числа будущих напоминаний.
+"""
+import asyncio
+import heapq
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+
+import database_async
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_ENGINE_LAG = metrics.REGISTRY.histogram(
+    'reminder_engine_lag_seconds', 'Опоздание срабатывания движка относительно due_at',
+    buckets=metrics.LAG_BUCKETS)
+_ENGINE_FIRED = metrics.REGISTRY.counter(
+    'reminder_engine_fired_total', 'Срабатывания движка напоминаний')
+_ENGINE_REFILLS = metrics.REGISTRY.counter(
+    'reminder_engine_refills_total', 'Подгрузки окна напоминаний из БД')
+
+def _utcnow():
+    # remind_at хранится в БД как naive UTC
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+class ReminderEngine:
+    """Куча ближайших срабатываний, подгружаемая из БД окнами"""
+
+    def __init__(self, fire, window=600, max_loaded=10000, refill_interval=60,
+                 batch_size=100, max_inflight=4):
+        self.fire = fire                      # async fire(task_ids)
+        self.window = timedelta(seconds=window)
+        self.max_loaded = max_loaded
+        self.refill_interval = min(refill_interval, window)
+        # Не больше max_inflight пачек одновременно: остальные ждут в куче,
+        # а не висят взятыми в БД, пока очередь отправки их не догонит
+        self.batch_size = batch_size
+        self.max_inflight = max_inflight
+
+        self._heap = []                       # (due_at, task_id)
+        self._due = {}                        # task_id -> актуальный due_at
+        self._horizon = None                  # до какого момента окно загружено
+        self._wakeup = None
+        self._task = None
+        self._pending = set()
+
+        self._fired = 0
+        self._refills = 0
+        self._last_lag = 0.0
+        self._max_lag = 0.0
+
+    @classmethod
+    def from_env(cls, fire):
+        return cls(
+            fire,
+            window=int(os.getenv('REMINDER_WINDOW', 600)),
+            max_loaded=int(os.getenv('REMINDER_MAX_LOADED', 10000)),
+            refill_interval=int(os.getenv('REMINDER_REFILL', 60)),
+        )
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"✅ Движок напоминаний запущен (окно {int(self.window.total_seconds())} с)")
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    def schedule(self, task_id, due_at):
+        """Регистрирует новое срабатывание, если оно попадает в загруженное окно"""
+        if self._horizon is None or due_at > self._horizon:
+            # Подхватится при следующей подгрузке окна
+            return False
+        self._push(task_id, due_at)
+        if self._wakeup is not None and self._heap[0][1] == task_id:
+            self._wakeup.set()
+        return True
+
+    def schedule_many(self, items):
+        """Регистрирует пачку (task_id, due_at) за один проход; возвращает число принятых.
+
+        due_at=None или время за горизонтом снимает прежнее срабатывание задачи
+        из окна: его запись в куче станет устаревшей.
+        """
+        if self._horizon is None:
+            return 0
+        accepted = 0
+        for task_id, due_at in items:
+            if due_at is None or due_at > self._horizon:
+                self._due.pop(task_id, None)
+                continue
+            self._push(task_id, due_at)
+            accepted += 1
+        if accepted and self._wakeup is not None:
+            self._wakeup.set()
+        return accepted
+
+    def _push(self, task_id, due_at):
+        self._due[task_id] = due_at
+        heapq.heappush(self._heap, (due_at, task_id))
+
+    async def _refill(self):
+        now = _utcnow()
+        horizon = now + self.window
+        rows = await database_async.get_upcoming_notifications(horizon, self.max_loaded)
+
+        self._heap = [(row['due_at'], row['id']) for row in rows]
+        heapq.heapify(self._heap)
+        self._due = {task_id: due_at for due_at, task_id in self._heap}
+        if len(rows) >= self.max_loaded:
+            # Окно обрезано лимитом: дальше последней загруженной записи не заглядываем
+            horizon = max(now, max(due_at for due_at, _ in self._heap))
+        self._horizon = horizon
+        self._refills += 1
+        _ENGINE_REFILLS.inc()
+
+    def _pop_due(self, now):
+        task_ids = []
+        while self._heap and self._heap[0][0] <= now and len(task_ids) < self.batch_size:
+            due_at, task_id = heapq.heappop(self._heap)
+            if self._due.get(task_id) != due_at:
+                continue  # запись устарела (время было изменено)
+            del self._due[task_id]
+            task_ids.append(task_id)
+            lag = (now - due_at).total_seconds()
+            self._last_lag = lag
+            self._max_lag = max(self._max_lag, lag)
+            _ENGINE_LAG.observe(max(0.0, lag))
+        return task_ids
+
+    async def _fire(self, task_ids):
+        try:
+            await self.fire(task_ids)
+        except Exception as e:
+            logger.error(f"❌ Ошибка срабатывания напоминаний {task_ids}: {e}")
+
+    def _on_fired(self, task):
+        self._pending.discard(task)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_refill = 0.0
+        while True:
+            try:
+                # Окно перечитывается по таймеру или досрочно, когда обрезанное
+                # лимитом окно уже разобрано
+                drained = not self._heap and self._horizon is not None and _utcnow() >= self._horizon
+                if loop.time() >= next_refill or drained:
+                    await self._refill()
+                    next_refill = loop.time() + self.refill_interval
+
+                while len(self._pending) < self.max_inflight:
+                    task_ids = self._pop_due(_utcnow())
+                    if not task_ids:
+                        break
+                    self._fired += len(task_ids)
+                    _ENGINE_FIRED.inc(len(task_ids))
+                    task = asyncio.create_task(self._fire(task_ids))
+                    self._pending.add(task)
+                    task.add_done_callback(self._on_fired)
+
+                timeout = next_refill - loop.time()
+                if self._heap and len(self._pending) < self.max_inflight:
+                    timeout = min(timeout, (self._heap[0][0] - _utcnow()).total_seconds())
+                self._wakeup.clear()
+                if timeout > 0:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Ошибка в движке напоминаний: {e}")
+                await asyncio.sleep(1)
+
+    def stats(self):
+        """Размер загруженного окна и задержка срабатываний"""
+        return {
+            'loaded': len(self._due),
+            'horizon': self._horizon.isoformat() if self._horizon else None,
+            'fired': self._fired,
+            'refills': self._refills,
+            'last_lag_s': round(self._last_lag, 3),
+            'max_lag_s': round(self._max_lag, 3),
+        }
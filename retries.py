@@ -0,0 +1,85 @@
+"""Политика повторной отправки уведомлений.
+
+Временная ошибка откладывает уведомление с экспоненциальной паузой и
+случайным разбросом (jitter), чтобы повторы после сбоя не приходили
+одной волной. Если Telegram вернул RetryAfter, ждем ровно столько,
+сколько он попросил. Постоянные ошибки (бот заблокирован, чат не
+найден, пользователь удален) не повторяются: чат отмечается
+недоступным, а его уведомления уходят в dead-letter. После
+max_attempts неудач уведомление тоже уходит в dead-letter.
+"""
+import os
+import random
+from collections import namedtuple
+
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNotFound,
+    TelegramRetryAfter,
+)
+
+# action: 'retry' (delay - пауза, с), 'dead' (попытки исчерпаны), 'block' (чат недоступен)
+Decision = namedtuple('Decision', 'action delay reason')
+
+# Фрагменты описаний TelegramBadRequest, после которых отправка в чат не удастся никогда
+_PERMANENT_BAD_REQUESTS = (
+    'chat not found',
+    'user not found',
+    'user is deactivated',
+    'bot was blocked',
+    'bot was kicked',
+    'bot can\'t initiate conversation',
+    'peer_id_invalid',
+)
+
+def error_reason(error):
+    """Короткое описание ошибки для БД и метрик"""
+    message = getattr(error, 'message', None) or str(error)
+    return f"{type(error).__name__}: {message}"[:500]
+
+def is_permanent(error):
+    if isinstance(error, (TelegramForbiddenError, TelegramNotFound)):
+        return True
+    if isinstance(error, TelegramBadRequest):
+        message = (getattr(error, 'message', None) or str(error)).lower()
+        return any(fragment in message for fragment in _PERMANENT_BAD_REQUESTS)
+    return False
+
+class RetryPolicy:
+    """Решает, что делать с уведомлением после неудачной отправки"""
+
+    def __init__(self, base_delay=30, factor=2.0, max_delay=6 * 3600, max_attempts=8,
+                 jitter=0.5, rnd=None):
+        self.base_delay = base_delay
+        self.factor = factor
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.jitter = jitter
+        self._random = rnd or random.Random()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            base_delay=float(os.getenv('NOTIFY_RETRY_BASE', 30)),
+            factor=float(os.getenv('NOTIFY_RETRY_FACTOR', 2)),
+            max_delay=float(os.getenv('NOTIFY_RETRY_MAX_DELAY', 6 * 3600)),
+            max_attempts=int(os.getenv('NOTIFY_RETRY_MAX_ATTEMPTS', 8)),
+            jitter=float(os.getenv('NOTIFY_RETRY_JITTER', 0.5)),
+        )
+
+    def backoff(self, attempts):
+        """Пауза перед попыткой после attempts неудач: base * factor^(attempts-1) с разбросом вниз"""
+        delay = min(self.max_delay, self.base_delay * self.factor ** max(0, attempts - 1))
+        return delay * (1 - self.jitter * self._random.random())
+
+    def decide(self, attempts, error):
+        """attempts - число неудачных попыток с учетом этой"""
+        reason = error_reason(error)
+        if is_permanent(error):
+            return Decision('block', None, reason)
+        if attempts >= self.max_attempts:
+            return Decision('dead', None, reason)
+        if isinstance(error, TelegramRetryAfter):
+            return Decision('retry', float(error.retry_after), reason)
+        return Decision('retry', self.backoff(attempts), reason)
@@ -0,0 +1,338 @@
+"""Очередь исходящих сообщений Telegram.
+
+Все вызовы sendMessage/editMessageText проходят через единую очередь:
+глобальный token bucket (~30 сообщений/с), лимит на чат, приоритетные
+полосы (ответы пользователю идут раньше массовых уведомлений) и
+соблюдение RetryAfter от Telegram. Внутри полосы сообщения одного чата
+уходят в порядке постановки: пока сообщение ждет лимита чата или повтора
+после RetryAfter, чат остается занятым, и следующие сообщения ждут за ним.
+"""
+import asyncio
+import contextvars
+import itertools
+import logging
+import os
+import time
+from collections import deque
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import EditMessageText, SendMessage
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Приоритетные полосы: меньше - раньше
+INTERACTIVE = 0
+BULK = 1
+
+LANES = {INTERACTIVE: 'interactive', BULK: 'bulk'}
+
+_QUEUED_METHODS = (SendMessage, EditMessageText)
+
+_SEND_SECONDS = metrics.REGISTRY.histogram(
+    'telegram_send_duration_seconds', 'Длительность запроса к Bot API', ('lane', 'outcome'))
+_QUEUE_SECONDS = metrics.REGISTRY.histogram(
+    'telegram_send_latency_seconds', 'Время от постановки в очередь до ответа Bot API', ('lane',))
+_SEND_FAILURES = metrics.REGISTRY.counter(
+    'telegram_send_failures_total', 'Неудачные отправки сообщений', ('lane', 'reason'))
+_RETRY_AFTER = metrics.REGISTRY.counter(
+    'telegram_retry_after_total', 'Ответы RetryAfter от Telegram')
+
+# Полоса для вызовов bot.* из текущей задачи (по умолчанию - интерактивная)
+_lane = contextvars.ContextVar('outbound_lane', default=INTERACTIVE)
+
+class QueueStopped(Exception):
+    """Очередь остановлена, сообщение не отправлено"""
+
+def _env_float(name, default):
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        logger.warning(f"⚠️ Некорректное значение {name}, используем {default}")
+        return default
+
+class TokenBucket:
+    """Классический token bucket: rate токенов в секунду, не больше capacity"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now=None):
+        """Забирает токен; возвращает 0 или сколько секунд ждать до следующего"""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def refund(self):
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+class _Entry:
+    __slots__ = ('chat_id', 'factory', 'future', 'lane', 'seq', 'enqueued_at', 'retries')
+
+    def __init__(self, chat_id, factory, future, lane, seq):
+        self.chat_id = chat_id
+        self.factory = factory
+        self.future = future
+        self.lane = lane
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.retries = 0
+
+    def __lt__(self, other):
+        return (self.lane, self.seq) < (other.lane, other.seq)
+
+class OutboundQueue(BaseRequestMiddleware):
+    """Центральная очередь исходящих сообщений.
+
+    Подключается как middleware сессии бота, поэтому перехватывает и
+    bot.send_message, и message.answer/edit_text в обработчиках.
+    """
+
+    def __init__(self, rate=30.0, per_chat_rate=1.0, per_chat_burst=3,
+                 workers=16, max_retry_after=5):
+        self.rate = rate
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.workers = workers
+        self.max_retry_after = max_retry_after
+
+        self._bucket = TokenBucket(rate, max(1.0, rate))
+        self._chat_buckets = {}
+        self._chat_busy = set()
+        self._parked = {}
+        self._delayed = {}        # отложенное сообщение -> таймер повтора
+        self._stopped = False
+        self._queue = None
+        self._tasks = []
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+
+        self._depth = {lane: 0 for lane in LANES}
+        self._in_flight = 0
+        self._sent = 0
+        self._failed = 0
+        self._retry_after = 0
+        self._latency = deque(maxlen=1000)
+        self._send_time = deque(maxlen=1000)
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            rate=_env_float('OUTBOUND_RATE', 30),
+            per_chat_rate=_env_float('OUTBOUND_PER_CHAT_RATE', 1),
+            per_chat_burst=_env_float('OUTBOUND_PER_CHAT_BURST', 3),
+            workers=int(_env_float('OUTBOUND_WORKERS', 16)),
+            max_retry_after=int(_env_float('OUTBOUND_MAX_RETRY_AFTER', 5)),
+        )
+
+    # ---------- жизненный цикл ----------
+    def start(self):
+        if self._tasks:
+            return
+        self._stopped = False
+        self._queue = asyncio.PriorityQueue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(f"✅ Очередь исходящих сообщений запущена ({self.rate:g} сообщ/с, workers={self.workers})")
+
+    async def stop(self):
+        """Останавливает воркеров; ожидающие отправки завершаются QueueStopped"""
+        self._stopped = True
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        pending = list(self._delayed)
+        for handle in self._delayed.values():
+            handle.cancel()
+        self._delayed.clear()
+        for entries in self._parked.values():
+            pending.extend(entries)
+        self._parked.clear()
+        self._chat_busy.clear()
+        while self._queue is not None and not self._queue.empty():
+            pending.append(self._queue.get_nowait())
+        for entry in pending:
+            self._abandon(entry, QueueStopped("очередь исходящих сообщений остановлена"))
+        if pending:
+            logger.warning(f"⚠️ Очередь исходящих остановлена, не отправлено сообщений: {len(pending)}")
+
+    # ---------- API ----------
+    async def __call__(self, make_request, bot, method):
+        if not isinstance(method, _QUEUED_METHODS) or method.chat_id is None:
+            return await make_request(bot, method)
+        return await self.submit(method.chat_id, lambda: make_request(bot, method), _lane.get())
+
+    async def submit(self, chat_id, factory, lane=INTERACTIVE):
+        """Ставит отправку в очередь и ждет ее результата"""
+        if self._stopped:
+            raise QueueStopped("очередь исходящих сообщений остановлена")
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        entry = _Entry(chat_id, factory, future, lane, next(self._seq))
+        self._depth[lane] += 1
+        self._queue.put_nowait(entry)
+        return await future
+
+    async def send_message(self, bot, chat_id, text, lane=BULK, **kwargs):
+        """bot.send_message через указанную полосу очереди"""
+        token = _lane.set(lane)
+        try:
+            return await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+        finally:
+            _lane.reset(token)
+
+    # ---------- обработка ----------
+    def _chat_delay(self, chat_id, now):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                self._chat_buckets = {
+                    cid: b for cid, b in self._chat_buckets.items() if not b.full(now)
+                }
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+        return bucket.take(now)
+
+    def _requeue_later(self, entry, delay):
+        # Чат занят до повтора: следующие сообщения чата паркуются за этим
+        self._chat_busy.add(entry.chat_id)
+        self._delayed[entry] = asyncio.get_running_loop().call_later(delay, self._resume, entry)
+
+    def _resume(self, entry):
+        del self._delayed[entry]
+        self._queue.put_nowait(entry)
+        self._release_chat(entry.chat_id)
+
+    def _release_chat(self, chat_id):
+        self._chat_busy.discard(chat_id)
+        parked = self._parked.pop(chat_id, None)
+        if parked:
+            for entry in parked:
+                self._queue.put_nowait(entry)
+
+    async def _worker(self):
+        while True:
+            entry = await self._queue.get()
+
+            # Глобальная пауза после RetryAfter
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                self._queue.put_nowait(entry)
+                await asyncio.sleep(pause)
+                continue
+
+            # Строгий порядок внутри чата: одно сообщение в полете на чат
+            if entry.chat_id in self._chat_busy:
+                self._parked.setdefault(entry.chat_id, []).append(entry)
+                continue
+
+            now = time.monotonic()
+            delay = self._chat_delay(entry.chat_id, now)
+            if delay:
+                self._requeue_later(entry, delay)
+                continue
+
+            delay = self._bucket.take(now)
+            if delay:
+                self._chat_buckets[entry.chat_id].refund()
+                # Возвращаем сообщение: после паузы первым уйдет самое приоритетное
+                self._queue.put_nowait(entry)
+                await asyncio.sleep(delay)
+                continue
+
+            self._chat_busy.add(entry.chat_id)
+            self._in_flight += 1
+            started = time.monotonic()
+            retry = False
+            try:
+                result = await entry.factory()
+            except TelegramRetryAfter as e:
+                self._retry_after += 1
+                _RETRY_AFTER.inc()
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                logger.warning(f"⏳ Telegram RetryAfter {e.retry_after} с (chat_id={entry.chat_id})")
+                entry.retries += 1
+                if entry.retries > self.max_retry_after:
+                    self._finish(entry, started, error=e)
+                else:
+                    retry = True
+                    self._requeue_later(entry, e.retry_after)
+            except asyncio.CancelledError:
+                self._finish(entry, started, error=asyncio.CancelledError())
+                raise
+            except Exception as e:
+                self._finish(entry, started, error=e)
+            else:
+                self._finish(entry, started, result=result)
+            finally:
+                self._in_flight -= 1
+                if not retry:
+                    self._release_chat(entry.chat_id)
+
+    def _finish(self, entry, started, result=None, error=None):
+        now = time.monotonic()
+        lane = LANES[entry.lane]
+        self._depth[entry.lane] -= 1
+        self._send_time.append(now - started)
+        self._latency.append(now - entry.enqueued_at)
+        _SEND_SECONDS.observe(now - started, lane=lane, outcome='ok' if error is None else 'error')
+        _QUEUE_SECONDS.observe(now - entry.enqueued_at, lane=lane)
+        if error is None:
+            self._sent += 1
+            if not entry.future.done():
+                entry.future.set_result(result)
+        else:
+            self._failed += 1
+            _SEND_FAILURES.inc(lane=lane, reason=type(error).__name__)
+            if not entry.future.done():
+                entry.future.set_exception(error)
+
+    def _abandon(self, entry, error):
+        """Завершает неотправленное сообщение ошибкой (без метрик отправки)"""
+        self._depth[entry.lane] -= 1
+        self._failed += 1
+        _SEND_FAILURES.inc(lane=LANES[entry.lane], reason=type(error).__name__)
+        if not entry.future.done():
+            entry.future.set_exception(error)
+
+    # ---------- статистика ----------
+    @staticmethod
+    def _percentiles(values):
+        if not values:
+            return {'p50_ms': 0.0, 'p95_ms': 0.0, 'max_ms': 0.0}
+        ordered = sorted(values)
+        pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+        return {
+            'p50_ms': round(pick(0.50) * 1000, 2),
+            'p95_ms': round(pick(0.95) * 1000, 2),
+            'max_ms': round(ordered[-1] * 1000, 2),
+        }
+
+    def stats(self):
+        """Глубина очереди по полосам, счетчики и задержки отправки"""
+        return {
+            'depth': {name: self._depth[lane] for lane, name in LANES.items()},
+            'in_flight': self._in_flight,
+            'sent': self._sent,
+            'failed': self._failed,
+            'retry_after': self._retry_after,
+            'paused_for_s': round(max(0.0, self._paused_until - time.monotonic()), 2),
+            'latency': self._percentiles(self._latency),
+            'send_time': self._percentiles(self._send_time),
+        }
@@ -0,0 +1,70 @@
+"""Сериализация задач в JSON.
+
+Колонки таблицы tasks известны заранее, поэтому вместо рекурсивного
+обхода с isinstance/hasattr на каждое значение преобразуются только
+поля даты/времени. JSON-бэкенд подключаемый: orjson, если установлен
+(он сам кодирует date/time/datetime), иначе стандартный json.
+Выбор можно зафиксировать переменной JSON_BACKEND=orjson|json.
+"""
+import json
+import logging
+import os
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson необязателен
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+DATE_FIELDS = ('date',)
+TIME_FIELDS = ('time',)
+TIMESTAMP_FIELDS = ('created_at', 'completed_at', 'deleted_at', 'remind_at', 'updated_at')
+TEMPORAL_FIELDS = DATE_FIELDS + TIME_FIELDS + TIMESTAMP_FIELDS
+
+def _select_backend():
+    name = os.getenv('JSON_BACKEND', 'orjson' if orjson else 'json').lower()
+    if name == 'orjson' and orjson is None:
+        logger.warning("⚠️ JSON_BACKEND=orjson, но orjson не установлен; используем json")
+        name = 'json'
+    return name
+
+BACKEND = _select_backend()
+
+def serialize_task(task):
+    """Строка задачи -> dict с датами/временем в ISO-формате"""
+    task_dict = dict(task)
+    for field in TEMPORAL_FIELDS:
+        value = task_dict.get(field)
+        if value is not None:
+            task_dict[field] = value.isoformat()
+    return task_dict
+
+def serialize_tasks(tasks):
+    return [serialize_task(task) for task in tasks]
+
+def _default(value):
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dumps(obj):
+    """JSON в байтах; date/time/datetime кодируются в ISO-формате"""
+    if BACKEND == 'orjson':
+        return orjson.dumps(obj)
+    return json.dumps(obj, default=_default).encode()
+
+def encode_tasks(tasks, **extra):
+    """Тело ответа {"status": "ok", "tasks": [...], **extra} в байтах"""
+    if BACKEND == 'orjson':
+        # orjson сам кодирует даты так же, как isoformat(): промежуточные dict не нужны
+        return orjson.dumps({"status": "ok", "tasks": tasks, **extra})
+    return json.dumps({"status": "ok", "tasks": serialize_tasks(tasks), **extra}).encode()
+
+def encode_ndjson(tasks):
+    """Задачи по одной на строку (NDJSON) в байтах"""
+    return b''.join(dumps(task) + b'\n' for task in tasks)
+
+def encode_items(tasks):
+    """Задачи через запятую - фрагмент JSON-массива без скобок"""
+    return b','.join(dumps(task) for task in tasks)
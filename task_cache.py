@@ -0,0 +1,125 @@
+"""Кэш сериализованных списков задач пользователей.
+
+LRU с TTL и ограничением по памяти: хранит готовое JSON-тело ответа
+/api/tasks по ключу (user_id, include_archived) вместе с его ETag.
+Сбрасывается при любом изменении задач пользователя через
+database.add_change_listener, а запись с устаревшим ETag (данные
+изменила другая реплика) считается промахом.
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+class TaskListCache:
+    """Потокобезопасный LRU+TTL кэш, ограниченный числом записей и байтами"""
+
+    def __init__(self, ttl=60, max_entries=10000, max_bytes=32 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()    # key -> (body, etag, expires_at)
+        self._bytes = 0
+        # Поколение пользователя растет при каждой инвалидации: ответ, прочитанный
+        # из БД до изменения, не попадет в кэш после него
+        self._generations = {}
+        self._epoch = 0
+        self._counter = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            ttl=float(os.getenv('TASK_CACHE_TTL', 60)),
+            max_entries=int(os.getenv('TASK_CACHE_MAX_ENTRIES', 10000)),
+            max_bytes=int(os.getenv('TASK_CACHE_MAX_BYTES', 32 * 1024 * 1024)),
+        )
+
+    def generation(self, user_id):
+        """Метка состояния пользователя; передается в put() после чтения из БД"""
+        with self._lock:
+            return (self._epoch, self._generations.get(user_id, 0))
+
+    def get(self, user_id, include_archived, etag=None):
+        key = (user_id, include_archived)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            body, cached_etag, expires_at = entry
+            if cached_etag != etag:
+                self._remove(key)
+                self.misses += 1
+                return None
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def put(self, user_id, include_archived, body, generation, etag=None):
+        size = len(body)
+        if size > self.max_bytes:
+            return False
+        key = (user_id, include_archived)
+        with self._lock:
+            if generation != (self._epoch, self._generations.get(user_id, 0)):
+                return False
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (body, etag, time.monotonic() + self.ttl)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+            return True
+
+    def _remove(self, key):
+        body, _, _ = self._entries.pop(key)
+        self._bytes -= len(body)
+
+    def invalidate_users(self, user_ids):
+        """Сбрасывает списки задач пользователей (подписчик database)"""
+        with self._lock:
+            if len(self._generations) > self.max_entries * 4:
+                # Не даем словарю поколений расти бесконечно: новая эпоха
+                # делает недействительными все ранее выданные метки
+                self._generations.clear()
+                self._epoch += 1
+            for user_id in user_ids:
+                self._counter += 1
+                self._generations[user_id] = self._counter
+                for include_archived in (False, True):
+                    key = (user_id, include_archived)
+                    if key in self._entries:
+                        self._remove(key)
+                        self.invalidations += 1
+
+    def stats(self):
+        """Счетчики попаданий/промахов/вытеснений и занятая память"""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
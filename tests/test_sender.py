@@ -0,0 +1,122 @@
+"""Очередь исходящих сообщений: token bucket, порядок внутри чата, остановка"""
+import asyncio
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+import sender
+
+def test_bucket_spends_burst_then_asks_to_wait():
+    bucket = sender.TokenBucket(rate=2.0, capacity=3)
+    now = bucket.updated
+    assert [bucket.take(now) for _ in range(3)] == [0.0, 0.0, 0.0]
+    # Токен восстанавливается за 1 / rate секунд
+    assert bucket.take(now) == pytest.approx(0.5)
+
+def test_bucket_refills_over_time_up_to_capacity():
+    bucket = sender.TokenBucket(rate=2.0, capacity=3)
+    now = bucket.updated
+    for _ in range(3):
+        bucket.take(now)
+    assert bucket.take(now + 0.5) == 0.0
+    assert bucket.take(now + 0.5) == pytest.approx(0.5)
+    assert not bucket.full(now + 1.0)
+    assert bucket.full(now + 10.0)
+    assert bucket.tokens == 3
+
+def test_bucket_refund_returns_token():
+    bucket = sender.TokenBucket(rate=1.0, capacity=1)
+    now = bucket.updated
+    bucket.take(now)
+    bucket.refund()
+    assert bucket.take(now) == 0.0
+
+def _recorder(sent):
+    def factory(n):
+        async def send():
+            sent.append(n)
+            return n
+        return send
+    return factory
+
+def test_chat_order_kept_when_chat_limit_delays():
+    async def scenario():
+        queue = sender.OutboundQueue(rate=1000, per_chat_rate=50, per_chat_burst=1, workers=4)
+        sent = []
+        make = _recorder(sent)
+        results = await asyncio.gather(*(queue.submit(1, make(n)) for n in range(5)))
+        await queue.stop()
+        return sent, results
+
+    sent, results = asyncio.run(scenario())
+    assert sent == [0, 1, 2, 3, 4]
+    assert results == [0, 1, 2, 3, 4]
+
+def test_chat_order_kept_after_retry_after():
+    async def scenario():
+        queue = sender.OutboundQueue(rate=1000, per_chat_rate=1000, per_chat_burst=10, workers=4)
+        sent = []
+        attempts = []
+
+        async def flooded():
+            attempts.append('first')
+            if len(attempts) == 1:
+                raise TelegramRetryAfter(SendMessage(chat_id=1, text='x'), 'Flood', 0.05)
+            sent.append('first')
+
+        async def second():
+            sent.append('second')
+
+        first = asyncio.ensure_future(queue.submit(1, flooded))
+        await asyncio.sleep(0)
+        await asyncio.gather(first, queue.submit(1, second))
+        await queue.stop()
+        return sent, queue.stats()
+
+    sent, stats = asyncio.run(scenario())
+    assert sent == ['first', 'second']
+    assert stats['retry_after'] == 1
+    assert stats['sent'] == 2
+
+def test_stop_fails_pending_sends():
+    async def scenario():
+        queue = sender.OutboundQueue(rate=1000, per_chat_rate=0.01, per_chat_burst=1, workers=2)
+        sent = []
+        make = _recorder(sent)
+        first = await queue.submit(1, make(0))
+        # Второе сообщение ждет лимита чата (100 с), третье - за ним
+        waiting = [asyncio.ensure_future(queue.submit(1, make(n))) for n in (1, 2)]
+        await asyncio.sleep(0.05)
+        await queue.stop()
+        outcomes = await asyncio.gather(*waiting, return_exceptions=True)
+        with pytest.raises(sender.QueueStopped):
+            await queue.submit(1, make(3))
+        return first, sent, outcomes, queue.stats()
+
+    first, sent, outcomes, stats = asyncio.run(scenario())
+    assert first == 0
+    assert sent == [0]
+    assert all(isinstance(outcome, sender.QueueStopped) for outcome in outcomes)
+    assert stats['depth'] == {'interactive': 0, 'bulk': 0}
+    assert stats['failed'] == 2
+
+def test_lanes_send_interactive_first():
+    async def scenario():
+        queue = sender.OutboundQueue(rate=1000, per_chat_rate=1000, per_chat_burst=10, workers=1)
+        sent = []
+        make = _recorder(sent)
+        # Очередь еще не разбирается: единственный воркер стартует после постановки
+        pending = [
+            asyncio.ensure_future(queue.submit(chat_id, make(name), lane))
+            for chat_id, name, lane in (
+                (1, 'bulk-1', sender.BULK),
+                (2, 'bulk-2', sender.BULK),
+                (3, 'reply', sender.INTERACTIVE),
+            )
+        ]
+        await asyncio.gather(*pending)
+        await queue.stop()
+        return sent
+
+    assert asyncio.run(scenario()) == ['reply', 'bulk-1', 'bulk-2']
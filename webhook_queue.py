@@ -0,0 +1,160 @@
+"""Фоновая обработка входящих обновлений webhook.
+
+Webhook отвечает Telegram сразу после постановки обновления в очередь, а
+обработчики aiogram выполняет пул воркеров. Обновления разных чатов
+обрабатываются параллельно, одного чата - строго по порядку: в работе
+всегда не больше одного обновления на чат. Очередь ограничена: когда она
+заполнена, put() ждет освобождения места не дольше put_timeout, после
+чего обновление отклоняется - webhook отвечает ошибкой, и Telegram
+доставит его повторно позже.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_QUEUE_WAIT = metrics.REGISTRY.histogram(
+    'webhook_queue_wait_seconds', 'Время обновления в очереди webhook до начала обработки')
+_PROCESS_SECONDS = metrics.REGISTRY.histogram(
+    'webhook_update_duration_seconds', 'Длительность обработки обновления', ('outcome',))
+_REJECTED = metrics.REGISTRY.counter(
+    'webhook_updates_rejected_total', 'Обновления, отклоненные из-за переполнения очереди')
+
+class UpdateQueue:
+    """Ограниченная очередь обновлений с порядком внутри чата"""
+
+    def __init__(self, process, key, maxsize=1000, workers=16, put_timeout=1.0):
+        self.process = process                # async process(update)
+        self.key = key                        # key(update) -> id чата или None
+        self.maxsize = maxsize
+        self.workers = workers
+        self.put_timeout = put_timeout
+
+        self._chats = {}                      # ключ -> deque((update, enqueued_at))
+        self._ready = None                    # ключи чатов, которые ждут воркера
+        self._space = None
+        self._size = 0
+        self._tasks = []
+        self._busy = 0
+
+        self.accepted = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_depth = 0
+
+    @classmethod
+    def from_env(cls, process, key):
+        return cls(
+            process,
+            key,
+            maxsize=int(os.getenv('WEBHOOK_QUEUE_SIZE', 1000)),
+            workers=int(os.getenv('WEBHOOK_WORKERS', 16)),
+            put_timeout=float(os.getenv('WEBHOOK_PUT_TIMEOUT', 1.0)),
+        )
+
+    # ---------- жизненный цикл ----------
+    def start(self):
+        if self._tasks:
+            return
+        self._ready = asyncio.Queue()
+        self._space = asyncio.Condition()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(f"✅ Очередь webhook запущена (размер {self.maxsize}, workers={self.workers})")
+
+    async def stop(self, drain_timeout=10):
+        """Дожидается обработки очереди (не дольше drain_timeout) и останавливает воркеров"""
+        deadline = time.monotonic() + drain_timeout
+        while self._size and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._size:
+            logger.warning(f"⚠️ Очередь webhook остановлена, необработанных обновлений: {self._size}")
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    # ---------- API ----------
+    async def put(self, update):
+        """Ставит обновление в очередь; False - очередь переполнена, обновление не принято"""
+        self.start()
+        if self._size >= self.maxsize:
+            async with self._space:
+                try:
+                    await asyncio.wait_for(
+                        self._space.wait_for(lambda: self._size < self.maxsize), self.put_timeout
+                    )
+                except asyncio.TimeoutError:
+                    self.rejected += 1
+                    _REJECTED.inc()
+                    return False
+
+        key = self.key(update)
+        if key is None:
+            # Обновление без чата не упорядочивается ни с чем
+            key = ('update', id(update))
+        self._size += 1
+        self.max_depth = max(self.max_depth, self._size)
+        self.accepted += 1
+        pending = self._chats.get(key)
+        if pending is None:
+            self._chats[key] = deque([(update, time.monotonic())])
+            self._ready.put_nowait(key)
+        else:
+            # Чат уже в очереди или в работе: обновление дождется предыдущих
+            pending.append((update, time.monotonic()))
+        return True
+
+    # ---------- обработка ----------
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            pending = self._chats[key]
+            update, enqueued_at = pending[0]
+            started = time.monotonic()
+            _QUEUE_WAIT.observe(started - enqueued_at)
+            self._busy += 1
+            outcome = 'ok'
+            try:
+                await self.process(update)
+                self.processed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                outcome = 'error'
+                self.failed += 1
+                logger.error(f"❌ Ошибка обработки обновления webhook: {e}")
+            finally:
+                self._busy -= 1
+                _PROCESS_SECONDS.observe(time.monotonic() - started, outcome=outcome)
+                pending.popleft()
+                self._size -= 1
+                if pending:
+                    # Следующее обновление чата - в конец очереди, чтобы чаты чередовались
+                    self._ready.put_nowait(key)
+                else:
+                    del self._chats[key]
+                await self._notify_space()
+
+    async def _notify_space(self):
+        async with self._space:
+            self._space.notify()
+
+    def stats(self):
+        """Глубина очереди и счетчики обработки"""
+        return {
+            'depth': self._size,
+            'chats': len(self._chats),
+            'busy': self._busy,
+            'max_depth': self.max_depth,
+            'maxsize': self.maxsize,
+            'accepted': self.accepted,
+            'processed': self.processed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+        }